@@ -13,4 +13,5 @@
 #                                                                                 #
 ###################################################################################
 
-__all__ = ["agent", "netinterface", "patches", "peopleplaces"]
\ No newline at end of file
+__all__ = ["agent", "agentpack", "checkpoint", "communicator", "netinterface", "patches",
+           "peopleplaces"]
\ No newline at end of file
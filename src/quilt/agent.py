@@ -16,7 +16,7 @@
 ###################################################################################
 
 import sys
-from collections import deque
+from collections import deque, OrderedDict
 from greenlet import greenlet
 from random import randint
 import logging
@@ -37,23 +37,68 @@ except:
     pass
 
 
+class InteractantRegistry(object):
+    """
+    Each MainLoop owns one of these.  It holds weak references to the interactants which
+    belong to the loop, and tracks the set of those interactants which are currently locked
+    by a timeless agent while non-timeless agents wait in their lock queues.  Interactants
+    report changes to that condition as they happen, so the loop can tell whether any of its
+    interactants is holding up the date change without scanning them all.
+    """
+
+    def __init__(self):
+        self._members = weaklist.WeakList()
+        self._blocking = set()
+
+    def add(self, iact):
+        self._members.append(iact)
+
+    def __iter__(self):
+        return iter(self._members)
+
+    def __len__(self):
+        return len(self._members)
+
+    def setBlocking(self, iact, blocking):
+        if blocking:
+            self._blocking.add(iact)
+        else:
+            self._blocking.discard(iact)
+
+    def nBlocking(self):
+        return len(self._blocking)
+
+    def getBlocking(self):
+        return list(self._blocking)
+
+
 class Sequencer(object):
 
-    def __init__(self, name, checkpointer=None):
+    def __init__(self, name, checkpointer=None, interactants=None):
+        """
+        interactants is the InteractantRegistry of the owning MainLoop, if any.  Without one,
+        doneWithToday() must fall back to scanning every live Interactant in the process.
+        """
         self._timeQueues = {}
+        self._nNotTimeless = {}  # per-day count of enqueued agents which are not timeless
         self._timeNow = 0
         self._name = name
         self.checkpointer = checkpointer
+        self._interactants = interactants
         self._logger = logging.getLogger(__name__ + '.Sequencer')
 
     def __iter__(self):
         while self._timeQueues:
             todayQueue = self._timeQueues[self._timeNow]
             if todayQueue:
-                yield (todayQueue.popleft(), self._timeNow)
+                agent = todayQueue.popleft()
+                if not agent.timeless:
+                    self._nNotTimeless[self._timeNow] -= 1
+                yield (agent, self._timeNow)
             else:
                 if self._timeNow in self._timeQueues:
                     del self._timeQueues[self._timeNow]
+                    del self._nNotTimeless[self._timeNow]
                 self._timeNow += 1
                 if self.checkpointer is not None:
                     self.checkpointer.checkpoint(self._timeNow)
@@ -65,7 +110,10 @@ class Sequencer(object):
         assert whenInfo >= self._timeNow, '%s: cannot schedule things in the past' % self._name
         if whenInfo not in self._timeQueues:
             self._timeQueues[whenInfo] = deque()
+            self._nNotTimeless[whenInfo] = 0
         self._timeQueues[whenInfo].append(agent)
+        if not agent.timeless:
+            self._nNotTimeless[whenInfo] += 1
 
     def unenqueue(self, agent, expectedWakeTime):
         assert isinstance(expectedWakeTime, int), (('%s: cannot unenqueue %s: time %s'
@@ -74,6 +122,8 @@ class Sequencer(object):
                                                                  expectedWakeTime))
         if expectedWakeTime in self._timeQueues and agent in self._timeQueues[expectedWakeTime]:
             self._timeQueues[expectedWakeTime].remove(agent)
+            if not agent.timeless:
+                self._nNotTimeless[expectedWakeTime] -= 1
         else:
             wakeTime = self.getAgentWakeTime(agent)
             if wakeTime is not None:
@@ -81,9 +131,7 @@ class Sequencer(object):
                                    % (self._name, agent.name, wakeTime, expectedWakeTime))
 
     def getAgentWakeTime(self, agent):
-        kL = self._timeQueues.keys()
-        kL.sort()
-        for t in kL:
+        for t in sorted(self._timeQueues.keys()):
             if agent in self._timeQueues[t]:
                 return t
         return None
@@ -91,11 +139,35 @@ class Sequencer(object):
     def getTimeNow(self):
         return self._timeNow
 
+    def setTimeNow(self, timeNow):
+        """
+        Set the date of a sequencer which has nothing enqueued, for example one which is
+        about to take over the agents of another.
+        """
+        assert not self._timeQueues, '%s: cannot reset the date with agents enqueued' % self._name
+        self._timeNow = timeNow
+
+    def getScheduled(self):
+        """
+        Returns a list of (agent, wakeTime) tuples for all enqueued agents, in the order in
+        which they will run.
+        """
+        return [(agent, t) for t in sorted(self._timeQueues.keys())
+                for agent in self._timeQueues[t]]
+
     def getNWaitingNow(self):
-        if self._timeNow in self._timeQueues:
-            return len([a for a in self._timeQueues[self._timeNow] if not a.timeless])
-        else:
-            return 0
+        """
+        Returns the number of agents which are not timeless in today's queue.  The count is
+        maintained as agents are enqueued and dequeued, so this assumes an agent's 'timeless'
+        flag does not change while it is in the queue.
+        """
+        return self._nNotTimeless.get(self._timeNow, 0)
+
+    def onlyTimelessToday(self):
+        """
+        Returns True if all of the agents remaining in today's queue are timeless.
+        """
+        return not self._nNotTimeless.get(self._timeNow, 0)
 
     def getWaitingCensus(self, time=None):
         if time is None:
@@ -121,13 +193,17 @@ class Sequencer(object):
         """
         self._logger.info('%s: bump time %s -> %s' % (self._name, self._timeNow, self._timeNow+1))
         oldDay = self._timeQueues[self._timeNow]
+        oldNNotTimeless = self._nNotTimeless[self._timeNow]
         del self._timeQueues[self._timeNow]
+        del self._nNotTimeless[self._timeNow]
         self._timeNow += 1
         if self.checkpointer is not None:
             self.checkpointer.checkpoint(self._timeNow)
         if self._timeNow not in self._timeQueues:
             self._timeQueues[self._timeNow] = deque()
+            self._nNotTimeless[self._timeNow] = 0
         self._timeQueues[self._timeNow].extend(oldDay)
+        self._nNotTimeless[self._timeNow] += oldNNotTimeless
 
     def doneWithToday(self):
         """
@@ -135,16 +211,117 @@ class Sequencer(object):
         will return True; otherwise False.  Note that this condition can be reversed if
         a new agent is inserted into today's loop.
         """
-        for iact in Interactant.getLiveList():
-            if (iact._lockingAgent is not None and iact._lockingAgent.timeless
-                    and iact.getNWaiting()):
-                self._logger.debug('doneWithToday is false because %s has %d waiting: %s' %
-                                   (iact, iact.getNWaiting(), iact.getWaitingDetails()))
+        if self._interactants is not None:
+            if self._interactants.nBlocking():
+                if self._logger.isEnabledFor(logging.DEBUG):
+                    for iact in self._interactants.getBlocking():
+                        self._logger.debug('doneWithToday is false because %s has %d waiting: %s'
+                                           % (iact, iact.getNWaiting(),
+                                              iact.getWaitingDetails()))
                 return False
-        return all([a.timeless for a in self._timeQueues[self._timeNow]])
+        else:
+            for iact in Interactant.getLiveList():
+                if (iact._lockingAgent is not None and iact._lockingAgent.timeless
+                        and iact.getNWaiting()):
+                    self._logger.debug('doneWithToday is false because %s has %d waiting: %s' %
+                                       (iact, iact.getNWaiting(), iact.getWaitingDetails()))
+                    return False
+        return self.onlyTimelessToday()
+
+
+class IndexedSequencer(Sequencer):
+    """
+    A Sequencer which keeps each day's queue as an OrderedDict and maintains an index
+    giving the wake time of every enqueued agent.  This makes getAgentWakeTime() and
+    unenqueue() (and thus Agent.nextWakeTime() and Interactant.suspend()) O(1) rather
+    than requiring a scan of every day's queue.  FIFO order within a day is preserved.
+
+    Unlike the base Sequencer, an agent may only be enqueued once at a time.
+    """
+
+    def __init__(self, name, checkpointer=None, interactants=None):
+        Sequencer.__init__(self, name, checkpointer, interactants)
+        self._wakeTimes = {}
+
+    def __iter__(self):
+        while self._timeQueues:
+            todayQueue = self._timeQueues.get(self._timeNow)
+            if todayQueue:
+                agent = todayQueue.popitem(last=False)[0]
+                del self._wakeTimes[agent]
+                if not agent.timeless:
+                    self._nNotTimeless[self._timeNow] -= 1
+                yield (agent, self._timeNow)
+            else:
+                if self._timeNow in self._timeQueues:
+                    del self._timeQueues[self._timeNow]
+                    del self._nNotTimeless[self._timeNow]
+                self._timeNow += 1
+                if self.checkpointer is not None:
+                    self.checkpointer.checkpoint(self._timeNow)
+
+    def enqueue(self, agent, whenInfo=0):
+        assert isinstance(whenInfo, int), (('%s: cannot enqueue %s: time %s is'
+                                            ' not an integer')
+                                           % (self._name, agent.name, whenInfo))
+        assert whenInfo >= self._timeNow, '%s: cannot schedule things in the past' % self._name
+        assert agent not in self._wakeTimes, ('%s: %s is already enqueued at %s'
+                                              % (self._name, agent.name,
+                                                 self._wakeTimes.get(agent)))
+        if whenInfo not in self._timeQueues:
+            self._timeQueues[whenInfo] = OrderedDict()
+            self._nNotTimeless[whenInfo] = 0
+        self._timeQueues[whenInfo][agent] = None
+        self._wakeTimes[agent] = whenInfo
+        if not agent.timeless:
+            self._nNotTimeless[whenInfo] += 1
+
+    def unenqueue(self, agent, expectedWakeTime):
+        assert isinstance(expectedWakeTime, int), (('%s: cannot unenqueue %s: time %s'
+                                                    ' is not an integer')
+                                                   % (self._name, agent.name,
+                                                      expectedWakeTime))
+        wakeTime = self._wakeTimes.get(agent)
+        if wakeTime == expectedWakeTime:
+            del self._timeQueues[wakeTime][agent]
+            del self._wakeTimes[agent]
+            if not agent.timeless:
+                self._nNotTimeless[wakeTime] -= 1
+        elif wakeTime is not None:
+            raise RuntimeError('%s cannot unenqueue %s: enqueued to wake at %s not %s'
+                               % (self._name, agent.name, wakeTime, expectedWakeTime))
+
+    def getAgentWakeTime(self, agent):
+        return self._wakeTimes.get(agent)
+
+    def bumpTime(self):
+        """
+        Move time forward by a day, shifting all agents from the old 'today' queue to the new one.
+
+        Normally, all of the remaining agents in the 'today' queue will be timeless when this
+        method is called.
+        """
+        self._logger.info('%s: bump time %s -> %s' % (self._name, self._timeNow, self._timeNow+1))
+        oldDay = self._timeQueues[self._timeNow]
+        oldNNotTimeless = self._nNotTimeless[self._timeNow]
+        del self._timeQueues[self._timeNow]
+        del self._nNotTimeless[self._timeNow]
+        self._timeNow += 1
+        if self.checkpointer is not None:
+            self.checkpointer.checkpoint(self._timeNow)
+        if self._timeNow not in self._timeQueues:
+            self._timeQueues[self._timeNow] = OrderedDict()
+            self._nNotTimeless[self._timeNow] = 0
+        newDay = self._timeQueues[self._timeNow]
+        for a in oldDay:
+            newDay[a] = None
+            self._wakeTimes[a] = self._timeNow
+        self._nNotTimeless[self._timeNow] += oldNNotTimeless
 
 
 class Agent(greenlet):
+    isFSM = False  # see FSMAgent
+
     def __init__(self, name, ownerLoop, debug=False):
         self.name = name
         self.ownerLoop = ownerLoop
@@ -187,6 +364,111 @@ class Agent(greenlet):
         return self.ownerLoop.sequencer.getAgentWakeTime(self)
 
 
+class FSMAgent(object):
+    """
+    An FSMAgent is a lightweight agent which is not a greenlet.  Rather than having a run
+    method which is switched into, it has a step method which the MainLoop calls as an
+    ordinary function.  step() examines the agent's explicit state (typically self.fsmstate),
+    updates it, and returns a tuple (action, arg) telling the MainLoop what to do next:
+
+        (FSMAgent.LOCK, interactant)    lock the interactant.  If the lock is granted
+                                        immediately step() is called again; otherwise the
+                                        agent waits in the interactant's lock queue until it
+                                        is unlocked or awakened.
+        (FSMAgent.UNLOCK, interactant)  unlock the interactant, which the agent must hold.
+        (FSMAgent.SLEEP, nDays)         sleep for nDays; 0 simply yields to other agents.
+        (FSMAgent.FINISH, None)         the agent is done and will not be scheduled again.
+
+    Because there is no greenlet, an FSMAgent costs no stack and no thread switches, which
+    makes it a good fit for short-lived message agents.  Its state must be entirely explicit,
+    so FSMAgents are always serializable via __getstate__ and __setstate__.
+    """
+    isFSM = True
+
+    LOCK = 0
+    UNLOCK = 1
+    SLEEP = 2
+    FINISH = 3
+
+    def __init__(self, name, ownerLoop, debug=False):
+        self.name = name
+        self.ownerLoop = ownerLoop
+        self.timeless = False
+        self.debug = debug
+
+    def step(self, timeNow):
+        raise RuntimeError('Derived class must subclass this method!')
+
+    def __getstate__(self):
+        return {'name': self.name, 'timeless': self.timeless,
+                'debug': self.debug}
+
+    def __setstate__(self, stateDict):
+        for k, v in stateDict.items():
+            setattr(self, k, v)
+
+    def __str__(self):
+        return '<%s>' % self.name
+
+    def kill(self):
+        """
+        An FSMAgent has no thread to terminate, so this simply does nothing.  An agent which
+        is not enqueued anywhere will never run again.
+        """
+        pass
+
+    def nextWakeTime(self):
+        """
+        Returns the time at which the agent is next expected to wake, or None if it is not
+        scheduled.
+        """
+        return self.ownerLoop.sequencer.getAgentWakeTime(self)
+
+
+class LockQueue(object):
+    """
+    The FIFO of agents waiting on an Interactant.  It is backed by an OrderedDict keyed by
+    agent, so appending, popping the head, testing membership and removing an arbitrary
+    agent are all O(1).  An agent can appear in a given LockQueue only once.
+    """
+
+    def __init__(self, agents=()):
+        self._agents = OrderedDict()
+        for a in agents:
+            self.append(a)
+
+    def append(self, agent):
+        assert agent not in self._agents, '%s is already in this lock queue' % agent
+        self._agents[agent] = None
+
+    def popleft(self):
+        return self._agents.popitem(last=False)[0]
+
+    def remove(self, agent):
+        del self._agents[agent]
+
+    def __contains__(self, agent):
+        return agent in self._agents
+
+    def __len__(self):
+        return len(self._agents)
+
+    def __iter__(self):
+        return iter(self._agents)
+
+    def __getitem__(self, idx):
+        """Indexing other than with 0 (the head of the queue) is O(n)"""
+        if idx == 0 and self._agents:
+            return next(iter(self._agents))
+        return list(self._agents)[idx]
+
+    def __getstate__(self):
+        return {'agents': list(self._agents)}
+
+    def __setstate__(self, stateDict):
+        self._agents = OrderedDict((a, None) for a in stateDict['agents'])
+
+
 class Interactant(object):
     counter = 0
     _liveInstances = weaklist.WeakList()
@@ -199,10 +481,11 @@ class Interactant(object):
         self._name = name
         self._ownerLoop = ownerLoop
         self._lockingAgent = None
-        self._lockQueue = []
+        self._lockQueue = LockQueue()
         self._debug = debug
         self._nEnqueued = 0  # counts only things which are not 'timeless'
         self._liveInstances.append(self)
+        ownerLoop.interactants.add(self)
         self.id = Interactant.counter
         Interactant.counter += 1
 
@@ -228,6 +511,17 @@ class Interactant(object):
     def __str__(self):
         return '<%s>' % self._name
 
+    def _updateBlocking(self):
+        """
+        An interactant locked by a timeless agent with non-timeless agents waiting in its
+        queue prevents the date from changing.  This must be called whenever the lock holder
+        or the waiting count changes, so that the owning loop's registry stays current.
+        """
+        self._ownerLoop.interactants.setBlocking(self,
+                                                 (self._lockingAgent is not None
+                                                  and self._lockingAgent.timeless
+                                                  and self.getNWaiting() > 0))
+
     def lock(self, lockingAgent, debug=False):
         """
         Agents always lock interactants before modifying their state.  This can be thought of as
@@ -237,21 +531,29 @@ class Interactant(object):
         Thus interactants can serve as queues; agents can enqueue themselves by locking the
         interactant and some other agent can modify them while they are in the locked state.
         """
+        changed = self._ownerLoop.changed
+        if changed is not None:
+            changed.add(self)
         timeNow = self._ownerLoop.sequencer.getTimeNow()
         if ((self._lockingAgent is None and not self._lockQueue)
                 or self._lockingAgent == lockingAgent):
             self._lockingAgent = lockingAgent
+            self._updateBlocking()
             if self._debug or lockingAgent.debug:
                 logger.debug('%s fast lock of %s' % (lockingAgent, self._name))
             return timeNow
         else:
-            assert lockingAgent == greenlet.getcurrent(), 'Agents may not lock other agents'
+            assert lockingAgent.isFSM or lockingAgent == greenlet.getcurrent(), \
+                'Agents may not lock other agents'
             self._lockQueue.append(lockingAgent)
             if not lockingAgent.timeless:
                 self._nEnqueued += 1
+                self._updateBlocking()
             if self._debug or lockingAgent.debug:
                 logger.debug('%s slow lock of %s (%d in queue)' %
                              (lockingAgent, self._name, self._nEnqueued))
+            if lockingAgent.isFSM:
+                return None  # The agent waits in the queue; MainLoop moves on
             timeNow = self._ownerLoop.switch('%s is %d in %s queue' %
                                              (lockingAgent, len(self._lockQueue), self._name))
             return timeNow
@@ -261,28 +563,41 @@ class Interactant(object):
         This method will typically be called by an active agent which holds a lock on the
         interactant.  The lock is broken, causing the first agent which is suspended waiting
         for a lock to become active.
+
+        If the unlocking agent is an FSMAgent and another agent was waiting, both are enqueued
+        and None is returned, signaling that the FSMAgent has yielded.
         """
-        assert oldLockingAgent == greenlet.getcurrent(), ('%s unlock of %s with current thread %s'
-                                                          % (self._name, oldLockingAgent.name,
-                                                             greenlet.getcurrent().name))
+        assert (oldLockingAgent.isFSM
+                or oldLockingAgent == greenlet.getcurrent()), ('%s unlock of %s with current'
+                                                               ' thread %s'
+                                                               % (self._name,
+                                                                  oldLockingAgent.name,
+                                                                  greenlet.getcurrent().name))
         if self._lockingAgent != oldLockingAgent:
             raise RuntimeError('%s is not the lock of %s' % (oldLockingAgent, self._name))
+        changed = self._ownerLoop.changed
+        if changed is not None:
+            changed.add(self)
         timeNow = self._ownerLoop.sequencer.getTimeNow()
         if self._lockQueue:
-            newAgent = self._lockQueue.pop(0)
+            newAgent = self._lockQueue.popleft()
             if not newAgent.timeless:
                 self._nEnqueued -= 1
             if self._debug:
                 logger.debug('%s unlock of %s awakens %s (%d still in queue)' %
                              (self._name, oldLockingAgent, newAgent, self._nEnqueued))
             self._lockingAgent = newAgent
+            self._updateBlocking()
             self._ownerLoop.sequencer.enqueue(newAgent, timeNow)
             self._ownerLoop.sequencer.enqueue(oldLockingAgent, timeNow)
+            if oldLockingAgent.isFSM:
+                return None
             timeNow = self._ownerLoop.switch("%s and %s enqueued" % (newAgent, oldLockingAgent))
         else:
             if self._debug:
                 logger.debug('%s fast unlock of %s' % (self._name, oldLockingAgent))
             self._lockingAgent = None
+            self._updateBlocking()
         return timeNow
 
     def awaken(self, agent):
@@ -300,9 +615,13 @@ class Interactant(object):
         if agent not in self._lockQueue:
             raise RuntimeError("%s does not hold %s in its lock queue; cannot awaken" %
                                (self._name, agent.name))
+        changed = self._ownerLoop.changed
+        if changed is not None:
+            changed.add(self)
         self._lockQueue.remove(agent)
         if not agent.timeless:
             self._nEnqueued -= 1
+            self._updateBlocking()
         if self._debug:
             logger.debug('%s removes %s from lock queue and awakens it (%d still in queue)' %
                          (self._name, agent.name, self._nEnqueued))
@@ -322,10 +641,14 @@ class Interactant(object):
         timeNow = self._ownerLoop.sequencer.getTimeNow()
         if self.isLocked(agent):
             raise RuntimeError("%s is locked by %s; cannot suspend" % (self._name, agent.name))
+        changed = self._ownerLoop.changed
+        if changed is not None:
+            changed.add(self)
         self._ownerLoop.sequencer.unenqueue(agent, timeNow)
         self._lockQueue.append(agent)
         if not agent.timeless:
             self._nEnqueued += 1
+            self._updateBlocking()
         if self._debug:
             logger.debug('%s suspends %s and adds to lock queue (%d still in queue)' %
                          (self._name, agent.name, self._nEnqueued))
@@ -340,6 +663,16 @@ class Interactant(object):
         """
         return (self._lockingAgent == agent or agent in self._lockQueue)
 
+    def getLiveLockedAgents(self):
+        """Returns a list of the agents which hold a lock on this interactant"""
+        if self._lockingAgent is None:
+            return []
+        return [self._lockingAgent]
+
+    def getQueuedAgents(self):
+        """Returns a list of the agents waiting in this interactant's lock queue"""
+        return list(self._lockQueue)
+
 
 class MultiInteractant(Interactant):
     """
@@ -362,6 +695,9 @@ class MultiInteractant(Interactant):
         Works like the lock() method of a standard Interactant, except that the first
         'count' agents to lock the interactant remain active.
         """
+        changed = self._ownerLoop.changed
+        if changed is not None:
+            changed.add(self)
         timeNow = self._ownerLoop.sequencer.getTimeNow()
         if lockingAgent in self._lockingAgentSet:
             if self._debug or lockingAgent.debug:
@@ -373,28 +709,37 @@ class MultiInteractant(Interactant):
                 logger.debug('%s fast locked by %s' % (self._name, lockingAgent))
             return timeNow
         else:
-            assert lockingAgent == greenlet.getcurrent(), 'Agents may not lock other agents'
+            assert lockingAgent.isFSM or lockingAgent == greenlet.getcurrent(), \
+                'Agents may not lock other agents'
             self._lockQueue.append(lockingAgent)
             if not lockingAgent.timeless:
                 self._nEnqueued += 1
             if self._debug or lockingAgent.debug:
                 logger.debug('%s slow lock by %s (%d in queue)' %
                              (self._name, lockingAgent, self._nEnqueued))
-            if lockingAgent == greenlet.getcurrent():
+            if lockingAgent.isFSM:
+                return None
+            elif lockingAgent == greenlet.getcurrent():
                 timeNow = self._ownerLoop.switch('%s is %d in %s queue' %
                                                  (lockingAgent, len(self._lockQueue), self._name))
             return timeNow
 
     def unlock(self, oldLockingAgent):
-        assert oldLockingAgent == greenlet.getcurrent(), ('%s unlock of %s with current thread %s'
-                                                          % (self._name, oldLockingAgent.name,
-                                                             greenlet.getcurrent().name))
+        assert (oldLockingAgent.isFSM
+                or oldLockingAgent == greenlet.getcurrent()), ('%s unlock of %s with current'
+                                                               ' thread %s'
+                                                               % (self._name,
+                                                                  oldLockingAgent.name,
+                                                                  greenlet.getcurrent().name))
         if oldLockingAgent not in self._lockingAgentSet:
             raise RuntimeError('%s is not a lock of %s' % (oldLockingAgent, self._name))
+        changed = self._ownerLoop.changed
+        if changed is not None:
+            changed.add(self)
         timeNow = self._ownerLoop.sequencer.getTimeNow()
         self._lockingAgentSet.remove(oldLockingAgent)
         if self._lockQueue:
-            newAgent = self._lockQueue.pop(0)
+            newAgent = self._lockQueue.popleft()
             if not newAgent.timeless:
                 self._nEnqueued -= 1
             if self._debug:
@@ -403,6 +748,8 @@ class MultiInteractant(Interactant):
             self._lockingAgentSet.add(newAgent)
             self._ownerLoop.sequencer.enqueue(newAgent, timeNow)
             self._ownerLoop.sequencer.enqueue(oldLockingAgent, timeNow)
+            if oldLockingAgent.isFSM:
+                return None
             timeNow = self._ownerLoop.switch("%s and %s enqueued" % (newAgent, oldLockingAgent))
         else:
             if self._debug:
@@ -468,7 +815,12 @@ class MainLoop(greenlet):
     def everyDayCB(loop, timeNow):
         loop.logger.debug('%s: time is now %s' % (loop.name, timeNow))
 
-    def __init__(self, name=None, safety=None, checkpointer=None):
+    def __init__(self, name=None, safety=None, checkpointer=None, sequencerClass=None):
+        """
+        sequencerClass selects the scheduling engine; it defaults to Sequencer.  Pass
+        IndexedSequencer for O(1) wake time lookup and unenqueue with large populations of
+        sleeping agents.
+        """
         self.newAgents = [MainLoop.ClockAgent(self)]
         self.perTickCallbacks = []
         self.perEventCallbacks = []
@@ -479,13 +831,18 @@ class MainLoop(greenlet):
             self.name = 'MainLoop'
         else:
             self.name = name
-        self.sequencer = Sequencer(self.name + ".Sequencer", checkpointer)
+        if sequencerClass is None:
+            sequencerClass = Sequencer
+        self.interactants = InteractantRegistry()
+        self.sequencer = sequencerClass(self.name + ".Sequencer", checkpointer,
+                                        interactants=self.interactants)
         self.dateFrozen = False
         self.counter = 0
         self.addPerDayCallback(MainLoop.everyDayCB)
         if self.safety is not None:
             self.addPerEventCallback(MainLoop.everyEventCB)
         self.stopNow = False
+        self.changed = None  # see takeChanges()
         self.logger = logging.getLogger(__name__ + '.MainLoop')
 
     def stopRunning(self):
@@ -505,6 +862,39 @@ class MainLoop(greenlet):
     def addPerEventCallback(self, cb):
         self.perEventCallbacks.append(cb)
 
+    def markChanged(self, thing):
+        """
+        Record that an agent or interactant of this loop has changed.  This is only needed
+        for changes which takeChanges() cannot see, such as one agent altering another
+        which is asleep without holding a lock on an interactant it waits on.
+        """
+        if self.changed is not None:
+            self.changed.add(thing)
+
+    def takeChanges(self):
+        """
+        Returns the set of agents and interactants of this loop which may have changed
+        since the previous call, and starts tracking changes afresh.  Nothing is tracked
+        before the first call, which returns None.
+
+        An agent has changed if it has run.  An interactant has changed if it has been
+        locked, unlocked, awakened from or suspended into, or if it is locked by an agent
+        which has run, since agents modify interactants only while holding their locks.
+        The agents holding or waiting on a changed interactant are counted as changed,
+        since the holder of a lock may modify the agents in its queue.
+        """
+        changed = self.changed
+        self.changed = set()
+        if changed is None:
+            return None
+        for iact in self.interactants:
+            holders = iact.getLiveLockedAgents()
+            if iact in changed or any([a in changed for a in holders]):
+                changed.add(iact)
+                changed.update(holders)
+                changed.update(iact.getQueuedAgents())
+        return changed
+
     def freezeDate(self):
         self.dateFrozen = True
 
@@ -514,7 +904,7 @@ class MainLoop(greenlet):
     def run(self):
         for a in self.newAgents:
             a.parent = self  # so dead agents return here
-            self.sequencer.enqueue(a)
+            self.sequencer.enqueue(a, self.sequencer.getTimeNow())
         self.newAgents = []
         logDebug = self.logger.isEnabledFor(logging.DEBUG)
         for agent, timeNow in self.sequencer:
@@ -522,13 +912,42 @@ class MainLoop(greenlet):
                 self.logger.debug('%s Stepping %s at %d' % (self.name, agent, timeNow))
             for cb in self.perEventCallbacks:
                 cb(self, timeNow)
-            reply = agent.switch(timeNow)  # @UnusedVariable
+            if self.changed is not None:
+                self.changed.add(agent)
+            if agent.isFSM:
+                reply = self.stepFSMAgent(agent, timeNow)  # @UnusedVariable
+            else:
+                reply = agent.switch(timeNow)  # @UnusedVariable
             if logDebug:
                 self.logger.debug('Stepped %s at %d; reply was %s' % (agent, timeNow, reply))
             if self.stopNow:
                 break
         return '%s exiting' % self.name
 
+    def stepFSMAgent(self, agent, timeNow):
+        """
+        Give an FSMAgent its time slice.  This happens in the MainLoop's own greenlet; the
+        agent's step method is called until the agent waits in a lock queue, sleeps,
+        yields or finishes.  The return value is the last action taken.
+        """
+        while True:
+            action, arg = agent.step(timeNow)
+            if action == FSMAgent.LOCK:
+                if arg.lock(agent) is None:
+                    return action
+            elif action == FSMAgent.UNLOCK:
+                if arg.unlock(agent) is None:
+                    return action
+            elif action == FSMAgent.SLEEP:
+                assert isinstance(arg, int), 'nDays should be an integer'
+                assert arg >= 0, 'No sleeping for negative time'
+                self.sequencer.enqueue(agent, timeNow + arg)
+                return action
+            elif action == FSMAgent.FINISH:
+                return action
+            else:
+                raise RuntimeError('%s: unknown action %s from %s' % (self.name, action, agent))
+
     def sleep(self, agent, nDays):
         assert isinstance(nDays, int), 'nDays should be an integer'
         assert nDays >= 0, 'No sleeping for negative time'
@@ -542,7 +961,7 @@ class MainLoop(greenlet):
             print('%s: Census at tick %s date %s:' %
                   (self.name, tickNum, self.sequencer.getTimeNow()))
         censusDict = {}
-        for iact in Interactant.getLiveList():
+        for iact in self.interactants:
             for k, v in iact.getWaitingDetails().items():
                 if k in censusDict:
                     censusDict[k] += v
@@ -0,0 +1,282 @@
+#! /usr/bin/env python
+
+###################################################################################
+# Copyright   2015, Pittsburgh Supercomputing Center (PSC).  All Rights Reserved. #
+# =============================================================================== #
+#                                                                                 #
+# Permission to use, copy, and modify this software and its documentation without #
+# fee for personal use within your organization is hereby granted, provided that  #
+# the above copyright notice is preserved in all copies and that the copyright    #
+# and this permission notice appear in supporting documentation.  All other       #
+# restrictions and obligations are defined in the GNU Affero General Public       #
+# License v3 (AGPL-3.0) located at http://www.gnu.org/licenses/agpl-3.0.html  A   #
+# copy of the license is also provided in the top level of the source directory,  #
+# in the file LICENSE.txt.                                                        #
+#                                                                                 #
+###################################################################################
+
+_rhea_svn_id_ = "$Id$"
+
+"""
+Compact serialization of mobile agents for shipment through gates.
+
+An agent class registers a schema listing the keys of its __getstate__() dict and their
+kinds.  A batch of agents is then packed as fixed-size binary records, one per agent,
+plus a small pickled table holding the classes, strings and arbitrary objects referenced
+by the records.  Each class and each distinct string is stored once per batch, and global
+addresses are stored as their rank and unsigned lclCode (see netinterface.GblAddr).  Any
+keys of the state dict which are not in the schema (for example those added by a derived
+class) travel in a pickled 'extras' dict, so derived classes inherit the schema of their
+nearest registered base class.
+
+Field kinds are:
+
+    'int'    a Python int
+    'float'  a Python float
+    'bool'   a boolean
+    'str'    a string or None
+    'addr'   a GblAddr or None
+    'obj'    anything picklable
+"""
+
+import sys
+import struct
+import pickle
+import logging
+
+from quilt.netinterface import GblAddr
+
+logger = logging.getLogger(__name__)
+
+AGENT_FIELDS = [('name', 'str'), ('timeless', 'bool'), ('debug', 'bool')]
+
+_NONE_IDX = 0xffffffff
+
+_kindCodes = {'int': 'q', 'float': 'd', 'bool': '?', 'str': 'I', 'addr': 'iQ', 'obj': 'I'}
+
+_hdrStruct = struct.Struct('<II')  # length of pickled tables, number of agents
+_clsStruct = struct.Struct('<H')   # index into the class table, at the start of each record
+
+
+class _Tables(object):
+    """The per-batch class, string and object tables"""
+    def __init__(self, classes=None, strings=None, objects=None):
+        self.classes = [] if classes is None else classes
+        self.strings = [] if strings is None else strings
+        self.objects = [] if objects is None else objects
+        self._clsIdx = {}
+        self._strIdx = {}
+
+    def classIdx(self, cls):
+        if cls not in self._clsIdx:
+            self._clsIdx[cls] = len(self.classes)
+            self.classes.append(cls)
+        return self._clsIdx[cls]
+
+    def strIdx(self, s):
+        if s is None:
+            return _NONE_IDX
+        if s not in self._strIdx:
+            self._strIdx[s] = len(self.strings)
+            self.strings.append(s)
+        return self._strIdx[s]
+
+    def objIdx(self, obj):
+        self.objects.append(obj)
+        return len(self.objects) - 1
+
+
+def _packAddr(addr):
+    if addr is None:
+        return (-1, 0)
+    return (addr.rank, addr.lclCode)
+
+
+def _unpackAddr(rank, lcl):
+    if rank < 0:
+        return None
+    return GblAddr.decode((rank << 64) | lcl)
+
+
+class AgentSchema(object):
+    def __init__(self, fields):
+        """
+        fields is a list of (key, kind) tuples, where key is a key of the agent's state dict
+        and kind is one of the kinds listed in the module docstring.
+        """
+        for key, kind in fields:
+            assert kind in _kindCodes, 'unknown field kind %s for %s' % (kind, key)
+        self.fields = list(fields)
+        self.keySet = frozenset([key for key, kind in fields])
+        # Records are laid out by kind rather than in field order, so that each kind can
+        # be converted in bulk.
+        self._plainKeys = [key for key, kind in fields if kind in ('int', 'float', 'bool')]
+        self._strKeys = [key for key, kind in fields if kind == 'str']
+        self._addrKeys = [key for key, kind in fields if kind == 'addr']
+        self._objKeys = [key for key, kind in fields if kind == 'obj']
+        kindDict = dict(fields)
+        # The leading 'I' is the object table index of the extras dict
+        self.struct = struct.Struct('<I'
+                                    + ''.join([_kindCodes[kindDict[k]] for k in self._plainKeys])
+                                    + 'I' * len(self._strKeys)
+                                    + 'iQ' * len(self._addrKeys)
+                                    + 'I' * len(self._objKeys))
+
+    def pack(self, agent, tables):
+        d = agent.__getstate__()
+        if len(d) > len(self.fields):
+            extras = dict([(k, v) for k, v in d.items() if k not in self.keySet])
+            vals = [tables.objIdx(extras)]
+        else:
+            vals = [_NONE_IDX]
+        vals.extend([d[k] for k in self._plainKeys])
+        strIdx = tables.strIdx
+        vals.extend([strIdx(d[k]) for k in self._strKeys])
+        for k in self._addrKeys:
+            vals.extend(_packAddr(d[k]))
+        objIdx = tables.objIdx
+        vals.extend([objIdx(d[k]) for k in self._objKeys])
+        return self.struct.pack(*vals)
+
+    def unpack(self, cls, buf, offset, tables):
+        vals = self.struct.unpack_from(buf, offset)
+        if vals[0] == _NONE_IDX:
+            d = {}
+        else:
+            d = dict(tables.objects[vals[0]])
+        i = 1
+        for k in self._plainKeys:
+            d[k] = vals[i]
+            i += 1
+        strings = tables.strings
+        for k in self._strKeys:
+            idx = vals[i]
+            d[k] = None if idx == _NONE_IDX else strings[idx]
+            i += 1
+        for k in self._addrKeys:
+            d[k] = _unpackAddr(vals[i], vals[i + 1])
+            i += 2
+        objects = tables.objects
+        for k in self._objKeys:
+            d[k] = objects[vals[i]]
+            i += 1
+        agent = cls.__new__(cls)
+        agent.__setstate__(d)
+        return agent
+
+
+_schemaDict = {}  # registered schemas by class
+_resolvedDict = {}  # cache of getSchema() results
+
+
+def registerSchema(cls, fields):
+    """
+    Register the packing schema for an agent class.  The same schema must be registered on
+    every rank, which is naturally the case if registration happens at module import time.
+    """
+    _schemaDict[cls] = AgentSchema(fields)
+    _resolvedDict.clear()
+
+
+def getSchema(cls):
+    """
+    Returns the schema of cls or of its nearest registered base class, or None if there is
+    none.
+    """
+    try:
+        return _resolvedDict[cls]
+    except KeyError:
+        schema = None
+        for base in cls.__mro__:
+            if base in _schemaDict:
+                schema = _schemaDict[base]
+                break
+        _resolvedDict[cls] = schema
+        return schema
+
+
+def canPack(agentList):
+    """Returns True if every agent in the list has a schema"""
+    for a in agentList:
+        if getSchema(type(a)) is None:
+            return False
+    return True
+
+
+def packAgents(agentList):
+    """Returns a bytes object holding the packed agents"""
+    tables = _Tables()
+    recs = []
+    for a in agentList:
+        cls = type(a)
+        recs.append(_clsStruct.pack(tables.classIdx(cls)))
+        recs.append(getSchema(cls).pack(a, tables))
+    tblBytes = pickle.dumps((tables.classes, tables.strings, tables.objects),
+                            pickle.HIGHEST_PROTOCOL)
+    return b''.join([_hdrStruct.pack(len(tblBytes), len(agentList)), tblBytes] + recs)
+
+
+def unpackAgents(buf):
+    """Inverse of packAgents(); returns a list of agents"""
+    tblLen, nAgents = _hdrStruct.unpack_from(buf, 0)
+    offset = _hdrStruct.size
+    classes, strings, objects = pickle.loads(buf[offset:offset + tblLen])
+    tables = _Tables(classes, strings, objects)
+    offset += tblLen
+    result = []
+    for i in range(nAgents):  # @UnusedVariable
+        clsIdx, = _clsStruct.unpack_from(buf, offset)
+        offset += _clsStruct.size
+        cls = classes[clsIdx]
+        schema = getSchema(cls)
+        result.append(schema.unpack(cls, buf, offset, tables))
+        offset += schema.struct.size
+    return result
+
+
+def describeSelf():
+    print("Usage: agentpack.py")
+
+
+class _TestAgent(object):
+    def __init__(self, name, home, dest):
+        self.name = name
+        self.home = home
+        self.dest = dest
+        self.count = 0
+
+    def __getstate__(self):
+        return self.__dict__.copy()
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+
+
+def _selfTest():
+    registerSchema(_TestAgent, [('name', 'str'), ('home', 'addr'), ('dest', 'addr'),
+                                ('count', 'int')])
+    # Patch ids of 2**31 or more give lclCodes which do not fit in a signed 64-bit field
+    addrs = [None, GblAddr(0, 3), GblAddr(2, (5, 7)), GblAddr(1, 2**31 + 5),
+             GblAddr(1, (2**31 + 5, 7)), GblAddr(3, (2**32 - 1, 0))]
+    agents = []
+    for i, home in enumerate(addrs):
+        a = _TestAgent('agent_%d' % i, home, addrs[-1 - i])
+        a.count = -i
+        agents.append(a)
+    for a, b in zip(agents, unpackAgents(packAgents(agents))):
+        assert b.__dict__ == a.__dict__, '%s != %s' % (b.__dict__, a.__dict__)
+    print('ok')
+
+
+def main():
+    if len(sys.argv) > 1:
+        describeSelf()
+        sys.exit('no arguments are expected')
+    _selfTest()
+
+############
+# Main hook
+############
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+#! /usr/bin/env python
+
+###################################################################################
+# Copyright   2015, Pittsburgh Supercomputing Center (PSC).  All Rights Reserved. #
+# =============================================================================== #
+#                                                                                 #
+# Permission to use, copy, and modify this software and its documentation without #
+# fee for personal use within your organization is hereby granted, provided that  #
+# the above copyright notice is preserved in all copies and that the copyright    #
+# and this permission notice appear in supporting documentation.  All other       #
+# restrictions and obligations are defined in the GNU Affero General Public       #
+# License v3 (AGPL-3.0) located at http://www.gnu.org/licenses/agpl-3.0.html  A   #
+# copy of the license is also provided in the top level of the source directory,  #
+# in the file LICENSE.txt.                                                        #
+#                                                                                 #
+###################################################################################
+
+_rhea_svn_id_ = "$Id$"
+
+"""
+Checkpoint and restart of a running PatchGroup.
+
+A Checkpointer is handed to the PatchGroup, which passes it on to the Sequencer of every
+patch.  The Sequencers call checkpoint(timeNow) as each day begins, but at that moment a
+patch is in the middle of changing date and other patches may still be running, so the
+call only notes that a day boundary has been reached.  The snapshot itself is taken by
+the PatchGroup just after a collective date change, when every patch on every rank has
+moved to the new day and nothing is in flight between them.  This is the same moment at
+which patches can migrate, and each patch is saved with Patch.packForCheckpoint(); the
+requirements on migratable patches thus apply to checkpointed ones.  In particular
+greenlet agents resume at the start of their run methods after a restart.
+
+Snapshots are incremental.  Every agent and interactant is saved as a separate record,
+and the MainLoop of each patch tracks which of them may have changed (see
+MainLoop.takeChanges()).  Only those are pickled again; the rest of the snapshot refers
+to the records saved by earlier snapshots.  Every 'fullEvery' snapshots everything is
+pickled afresh, so that old files can be dropped.
+
+Pickling the changed records is all that holds up the simulation.  Compressing and
+writing the pickled bytes is handed to a writer thread, so the next day starts at once;
+zlib and file I/O release the interpreter lock while they work.  Only one writer runs at
+a time; if the previous one is still busy when the next snapshot is due, the rank waits
+for it.
+
+The snapshots of each rank go in their own directory:
+
+    <ckptDir>/rank_<rank>/day_<day>.manifest
+    <ckptDir>/rank_<rank>/seg_<day>.z
+
+The segment file of a day holds the records pickled that day, compressed.  The manifest
+is a pickle holding the headers of the patches on the rank, the location of each of
+their records, and the state of the PatchGroup and of the random module.  The manifest
+is written last, and files are written under a temporary name and then renamed, so a
+crash while writing leaves the earlier snapshots intact.  Only the newest 'keep'
+snapshots and the segments they use are retained.
+
+To restart, build a fresh PatchGroup with the same number of ranks and a Checkpointer for
+the same directory, call restore() in place of creating the patches, and then call
+start() as usual.
+"""
+
+import os
+import zlib
+import random
+import pickle
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def _writeFile(path, data):
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'wb') as f:
+        f.write(data)
+    os.rename(tmpPath, path)
+
+
+def _writeSnapshot(ckpt, rank, day, segment, manifestBuf):
+    """The work of the writer thread"""
+    rankDir = ckpt._rankDir(rank)
+    if not os.path.isdir(rankDir):
+        os.makedirs(rankDir)
+    if segment:
+        _writeFile(ckpt._segmentPath(rank, day), zlib.compress(segment, ckpt.compressLevel))
+    _writeFile(ckpt._manifestPath(rank, day), manifestBuf)
+    ckpt._prune(rank)
+
+
+class _Writer(threading.Thread):
+    """A thread running _writeSnapshot(), which notes whether it failed"""
+    def __init__(self, args, name):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.args = args
+        self.failed = False
+
+    def run(self):
+        try:
+            _writeSnapshot(*self.args)
+        except Exception:
+            logger.exception('checkpoint writer %s failed' % self.name)
+            self.failed = True
+
+
+class Checkpointer(object):
+    """
+    Writes snapshots of a PatchGroup and restores them; see the module docstring.  The
+    snapshots are written by a thread rather than by a process forked from the rank,
+    because MPI implementations and many fabrics (for example verbs or UCX with registered
+    memory) do not support fork() from an initialized MPI process.
+    """
+    manifestPrefix = 'day_'
+    manifestSuffix = '.manifest'
+    segmentPrefix = 'seg_'
+    segmentSuffix = '.z'
+    compressLevel = 1
+
+    def __init__(self, ckptDir, interval=1, keep=2, fullEvery=10, background=True):
+        """
+        A snapshot is written every 'interval' days, and the newest 'keep' snapshots are
+        retained.  Every 'fullEvery' snapshots all records are written again.  If
+        background is False the snapshots are written in line rather than by a writer
+        thread.
+        """
+        self.ckptDir = ckptDir
+        self.interval = interval
+        self.keep = keep
+        self.fullEvery = fullEvery
+        self.dayReached = None  # set by the Sequencers; see checkpoint()
+        self.nDateChanges = 0  # since the last snapshot; see writeIfDue()
+        self.nSinceFull = 0  # snapshots since the last full one
+        self.nWritten = 0  # records pickled
+        self.nReused = 0  # records found to be unchanged
+        self._saved = {}  # id(thing) -> (thing, loc, refs) for the records of the last snapshot
+        self._writer = None
+        self.background = background
+
+    def checkpoint(self, timeNow):
+        """
+        The Sequencer hook, called as each patch begins day timeNow.  The snapshot is taken
+        later, by writeIfDue().
+        """
+        if self.dayReached is None or timeNow > self.dayReached:
+            self.dayReached = timeNow
+
+    def _rankDir(self, rank):
+        return os.path.join(self.ckptDir, 'rank_%d' % rank)
+
+    def _manifestPath(self, rank, day):
+        return os.path.join(self._rankDir(rank),
+                            '%s%06d%s' % (self.manifestPrefix, day, self.manifestSuffix))
+
+    def _segmentPath(self, rank, day):
+        return os.path.join(self._rankDir(rank),
+                            '%s%06d%s' % (self.segmentPrefix, day, self.segmentSuffix))
+
+    def _readManifest(self, rank, day):
+        with open(self._manifestPath(rank, day), 'rb') as f:
+            return pickle.load(f)
+
+    def availableDays(self, rank):
+        """Returns a sorted list of the days for which rank has a complete snapshot"""
+        try:
+            names = os.listdir(self._rankDir(rank))
+        except OSError:
+            return []
+        result = []
+        for nm in names:
+            if nm.startswith(self.manifestPrefix) and nm.endswith(self.manifestSuffix):
+                result.append(int(nm[len(self.manifestPrefix):-len(self.manifestSuffix)]))
+        result.sort()
+        return result
+
+    def writeIfDue(self, patchGroup):
+        """
+        Called by the PatchGroup on every rank just after each collective date change.  Every
+        'interval' calls a snapshot is written, provided that every patch on every rank can
+        be packed; otherwise the attempt is repeated at the next date change.  The decision
+        depends only on the number of calls and on collective results, so all ranks make
+        it together.  Returns True if a snapshot was started.
+        """
+        self.nDateChanges += 1
+        if self.nDateChanges < self.interval:
+            return False
+        ready = all([p.canMigrate() for p in patchGroup.patches])
+        replies = patchGroup.nI.comm.allgather((ready, self.dayReached))
+        days = [d for r, d in replies if d is not None]  # @UnusedVariable
+        if not days:
+            return False  # no rank has any patches
+        day = max(days)
+        if not all([r for r, d in replies]):  # @UnusedVariable
+            logger.info('%s: checkpoint for day %d postponed' % (patchGroup.name, day))
+            return False
+        self.write(patchGroup, day)
+        self.nDateChanges = 0
+        return True
+
+    def write(self, patchGroup, day):
+        """
+        Pickle the records which may have changed since the last snapshot and start writing
+        the snapshot of this rank for the given day.
+        """
+        rank = patchGroup.nI.comm.rank
+        self.flush()
+        full = not self._saved or self.nSinceFull + 1 >= self.fullEvery
+        saved = self._saved
+        newSaved = {}
+        pieces = []
+        segLength = 0
+        patchList = []
+        nWritten = nReused = 0
+        for p in patchGroup.patches:
+            changed = p.loop.takeChanges()
+            if full or changed is None:
+                def isClean(thing):
+                    return None
+            else:
+                changedIds = set([id(thing) for thing in changed])
+
+                def isClean(thing, changedIds=changedIds):
+                    entry = saved.get(id(thing))
+                    if entry is None or entry[0] is not thing or id(thing) in changedIds:
+                        return None
+                    return entry[2]
+            header, buf, stateLength, index = p.packForCheckpoint(isClean)
+            records = []
+            for thing, offset, length, refs in index:
+                if offset is None:
+                    loc = saved[id(thing)][1]
+                    nReused += 1
+                else:
+                    loc = (day, segLength + offset, length)
+                    nWritten += 1
+                newSaved[id(thing)] = (thing, loc, refs)
+                records.append((id(thing), type(thing), loc))
+            patchList.append((header, (day, segLength, stateLength), records))
+            pieces.append(buf)
+            segLength += len(buf)
+        self._saved = newSaved
+        self.nWritten += nWritten
+        self.nReused += nReused
+        self.nSinceFull = 0 if full else self.nSinceFull + 1
+        manifest = {'day': day, 'nRanks': patchGroup.nI.comm.size, 'patches': patchList,
+                    'groupState': patchGroup.getCheckpointState(),
+                    'randomState': random.getstate()}
+        args = (self, rank, day, b''.join(pieces),
+                pickle.dumps(manifest, pickle.HIGHEST_PROTOCOL))
+        if self.background:
+            self._writer = _Writer(args, 'checkpoint_%d_%d' % (rank, day))
+            self._writer.start()
+        else:
+            _writeSnapshot(*args)
+        logger.info('%s: checkpoint for day %d has %d records pickled and %d unchanged'
+                    % (patchGroup.name, day, nWritten, nReused))
+
+    def flush(self):
+        """
+        Wait for the writer thread, if any, to finish.  If it failed, the next snapshot
+        pickles everything again rather than refer to records which may not have been
+        written.
+        """
+        if self._writer is not None:
+            self._writer.join()
+            if self._writer.failed:
+                self._saved = {}
+            self._writer = None
+
+    def _prune(self, rank):
+        """Drop all but the newest 'keep' snapshots, and any segments they do not use"""
+        days = self.availableDays(rank)
+        if len(days) <= self.keep:
+            return
+        for day in days[:-self.keep]:
+            os.remove(self._manifestPath(rank, day))
+        inUse = set()
+        for day in days[-self.keep:]:
+            manifest = self._readManifest(rank, day)
+            for header, stateLoc, records in manifest['patches']:  # @UnusedVariable
+                inUse.add(stateLoc[0])
+                inUse.update([loc[0] for key, cls, loc in records])  # @UnusedVariable
+        rankDir = self._rankDir(rank)
+        for fname in os.listdir(rankDir):
+            if fname.startswith(self.segmentPrefix) and fname.endswith(self.segmentSuffix):
+                if int(fname[len(self.segmentPrefix):-len(self.segmentSuffix)]) not in inUse:
+                    os.remove(os.path.join(rankDir, fname))
+
+    def restore(self, patchGroup, day=None):
+        """
+        Rebuild the patches of this rank in patchGroup, which must be freshly constructed
+        and have no patches, from the newest snapshot which every rank has, or from the
+        snapshot of the given day.  Every rank must call this, and the PatchGroup must then
+        be started with the same neighbors as the original run.  Returns the day restored.
+        """
+        comm = patchGroup.nI.comm
+        assert not patchGroup.patches, 'restore requires a PatchGroup with no patches'
+        common = None
+        for days in comm.allgather(self.availableDays(comm.rank)):
+            common = set(days) if common is None else common.intersection(days)
+        if day is None:
+            if not common:
+                raise RuntimeError('%s: no checkpoint is available in %s'
+                                   % (patchGroup.name, self.ckptDir))
+            day = max(common)
+        elif day not in common:
+            raise RuntimeError('%s: there is no complete checkpoint for day %s in %s'
+                               % (patchGroup.name, day, self.ckptDir))
+        manifest = self._readManifest(comm.rank, day)
+        if manifest['nRanks'] != comm.size:
+            raise RuntimeError('%s: the checkpoint was written by %d ranks, not %d'
+                               % (patchGroup.name, manifest['nRanks'], comm.size))
+        patchGroup.setCheckpointState(manifest['groupState'])
+        random.setstate(manifest['randomState'])
+        segDict = {}
+
+        def fetch(loc):
+            segDay, offset, length = loc
+            if segDay not in segDict:
+                with open(self._segmentPath(comm.rank, segDay), 'rb') as f:
+                    segDict[segDay] = zlib.decompress(f.read())
+            return segDict[segDay][offset:offset + length]
+
+        for header, stateLoc, records in manifest['patches']:
+            # Gates and routes are rebuilt by PatchGroup.start()
+            header = dict(header)
+            header['gatesTo'] = []
+            header['gatesFrom'] = []
+            header['nextHopDict'] = {}
+            patch = patchGroup.unpackCheckpoint(header, fetch(stateLoc),
+                                                [(key, cls, fetch(loc))
+                                                 for key, cls, loc in records])
+            logger.info('%s: restored patch %s' % (patchGroup.name, patch.name))
+        self.dayReached = day
+        self.nDateChanges = 0
+        logger.info('%s: restored checkpoint for day %d' % (patchGroup.name, day))
+        return day
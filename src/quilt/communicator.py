@@ -0,0 +1,424 @@
+#! /usr/bin/env python
+
+###################################################################################
+# Copyright   2015, Pittsburgh Supercomputing Center (PSC).  All Rights Reserved. #
+# =============================================================================== #
+#                                                                                 #
+# Permission to use, copy, and modify this software and its documentation without #
+# fee for personal use within your organization is hereby granted, provided that  #
+# the above copyright notice is preserved in all copies and that the copyright    #
+# and this permission notice appear in supporting documentation.  All other       #
+# restrictions and obligations are defined in the GNU Affero General Public       #
+# License v3 (AGPL-3.0) located at http://www.gnu.org/licenses/agpl-3.0.html  A   #
+# copy of the license is also provided in the top level of the source directory,  #
+# in the file LICENSE.txt.                                                        #
+#                                                                                 #
+###################################################################################
+
+_rhea_svn_id_ = "$Id$"
+
+"""
+Communicators which let quilt run without MPI.
+
+A Communicator provides the few operations quilt needs to pass Python objects between
+ranks: non-blocking tagged sends, polled and blocking receives, and the allgather and
+barrier collectives.  Its rank, size, allgather(), Barrier() and Abort() mirror those of
+an mpi4py communicator, so code which only uses those works with either.  A PatchGroup
+constructed with a Communicator rather than an MPI communicator uses
+netinterface.CommNetworkInterface.
+
+LocalCommunicator is a single rank in the current process.  Anything it sends to itself
+is handed over by reference, and its collectives are trivial.
+
+ProcessCommunicator connects ranks in separate processes on one host, started with
+runProcesses().  Each rank creates a ShmRing to every other rank, through which pickled
+messages flow; netinterface.SharedMemoryNetworkInterface uses the same rings.  Messages
+from a given rank arrive in the order they were sent, and any which do not match the tag
+being waited for are queued until they are wanted.
+"""
+
+import os
+import sys
+import time
+import struct
+import pickle
+import logging
+import multiprocessing
+from collections import deque
+import numpy as np
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None  # Python before 3.8; no shared memory transports are available
+
+logger = logging.getLogger(__name__)
+
+
+class Communicator(object):
+    """
+    The interface shared by the communicators in this module.  Tags are non-negative
+    integers; the negative ones are reserved for the collectives.
+    """
+    TAG_COLLECTIVE = -1
+
+    def __init__(self, rank, size):
+        self.rank = rank
+        self.size = size
+
+    def send(self, obj, dest, tag):
+        """
+        Send obj to rank dest without waiting for it to be received.  An implementation
+        may keep a reference to obj rather than a copy, so the caller must not modify it
+        afterwards.
+        """
+        raise RuntimeError('Derived class must subclass this method!')
+
+    def poll(self, source, tag):
+        """
+        Returns (True, obj) for the next message from rank source with the given tag if
+        one has arrived, and (False, None) otherwise.
+        """
+        raise RuntimeError('Derived class must subclass this method!')
+
+    def progress(self):
+        """
+        Move pending sends and receives along; returns True if anything moved.  Anything
+        which waits should call this, so that its partners are not left waiting on it.
+        """
+        return False
+
+    def hasPendingSends(self):
+        return False
+
+    def recv(self, source, tag):
+        """Wait for the next message from rank source with the given tag, and return it"""
+        nIdle = 0
+        while True:
+            ok, obj = self.poll(source, tag)
+            if ok:
+                return obj
+            nIdle = 0 if self.progress() else nIdle + 1
+            self.idle(nIdle)
+
+    def flush(self):
+        """Wait until every message sent so far has left this rank"""
+        nIdle = 0
+        while self.hasPendingSends():
+            nIdle = 0 if self.progress() else nIdle + 1
+            self.idle(nIdle)
+
+    def idle(self, nIdle):
+        """Called by waiting loops after nIdle consecutive polls without progress"""
+        pass
+
+    def allgather(self, obj):
+        for dest in range(self.size):
+            if dest != self.rank:
+                self.send(obj, dest, Communicator.TAG_COLLECTIVE)
+        return [obj if src == self.rank else self.recv(src, Communicator.TAG_COLLECTIVE)
+                for src in range(self.size)]
+
+    def Barrier(self):
+        self.allgather(None)
+
+    def Abort(self, errorcode=1):
+        logger.critical('rank %d: abort with error code %s' % (self.rank, errorcode))
+        os._exit(errorcode)
+
+    def close(self):
+        """Release any resources held by this communicator; it cannot be used afterwards"""
+        pass
+
+
+class LocalCommunicator(Communicator):
+    """A single rank, with messages to itself passed by reference"""
+    def __init__(self):
+        super(LocalCommunicator, self).__init__(0, 1)
+        self.queues = {}  # message deques by tag
+
+    def send(self, obj, dest, tag):
+        assert dest == 0, 'a LocalCommunicator has only rank 0'
+        self.queues.setdefault(tag, deque()).append(obj)
+
+    def poll(self, source, tag):
+        q = self.queues.get(tag)
+        if q:
+            return (True, q.popleft())
+        else:
+            return (False, None)
+
+    def recv(self, source, tag):
+        ok, obj = self.poll(source, tag)
+        if not ok:
+            raise RuntimeError('rank 0 would wait forever for a message with tag %s' % tag)
+        return obj
+
+
+class ShmRing(object):
+    """
+    A single-producer, single-consumer ring of bytes in a shared memory segment.  The
+    segment starts with two 64-bit counters, the total bytes ever written and the total
+    bytes ever read; each is stored only by its own side, after the data it covers has
+    been copied.  The rest of the segment holds the data.
+
+    The creator of a ring gives its size; the other side attaches to it by name.
+    """
+    hdrBytes = 16
+
+    def __init__(self, name, size=None):
+        if size is None:
+            # Attaching would register the segment with this process's resource tracker,
+            # which would then unlink it at exit; the creator is responsible for that.
+            if sys.version_info >= (3, 13):
+                self.shm = shared_memory.SharedMemory(name=name, track=False)
+            else:
+                self.shm = shared_memory.SharedMemory(name=name)
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+        else:
+            self.shm = shared_memory.SharedMemory(name=name, create=True,
+                                                  size=size + ShmRing.hdrBytes)
+        self.owner = size is not None
+        self.counters = np.ndarray((2,), dtype=np.uint64, buffer=self.shm.buf)
+        if self.owner:
+            self.counters[:] = 0
+        self.data = self.shm.buf[ShmRing.hdrBytes:]
+        self.capacity = len(self.data)
+
+    def write(self, view):
+        """Copy as much of view into the ring as will fit; returns the number of bytes copied"""
+        head = int(self.counters[0])
+        n = min(len(view), self.capacity - (head - int(self.counters[1])))
+        if n > 0:
+            pos = head % self.capacity
+            first = min(n, self.capacity - pos)
+            self.data[pos:pos + first] = view[:first]
+            if first < n:
+                self.data[:n - first] = view[first:n]
+            self.counters[0] = head + n
+        return n
+
+    def read(self, view):
+        """Copy as many bytes as are available, up to len(view); returns the number copied"""
+        tail = int(self.counters[1])
+        n = min(len(view), int(self.counters[0]) - tail)
+        if n > 0:
+            pos = tail % self.capacity
+            first = min(n, self.capacity - pos)
+            view[:first] = self.data[pos:pos + first]
+            if first < n:
+                view[first:n] = self.data[:n - first]
+            self.counters[1] = tail + n
+        return n
+
+    def close(self):
+        self.data.release()
+        del self.counters
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class ProcessCommunicator(Communicator):
+    """
+    One of a set of ranks in separate processes on the same host, connected by a full
+    mesh of shared memory rings.  The rings are named with prefix, which must be the same
+    for every rank and unique to the set; runProcesses() takes care of this.  Ring
+    creation does not synchronize the ranks, so a rank simply retries attaching to a
+    partner's ring until the partner has created it.
+    """
+    ringBytes = 4 * 1024 * 1024
+    spinsBeforeSleep = 100
+    idleSleepSeconds = 0.0001
+    _hdrStruct = struct.Struct('<iQ')  # tag, length of pickled message
+
+    def __init__(self, rank, size, prefix):
+        if shared_memory is None:
+            raise RuntimeError('ProcessCommunicator requires multiprocessing.shared_memory')
+        super(ProcessCommunicator, self).__init__(rank, size)
+        self.prefix = prefix
+        self.sendRings = dict([(dest, ShmRing(self._ringName(rank, dest), size=self.ringBytes))
+                               for dest in range(size) if dest != rank])
+        self.recvRings = {}  # by source rank, attached on first use
+        self.pendingWrites = dict([(dest, deque()) for dest in self.sendRings])
+        self.partialReads = {}  # by source rank, [hdrBuf, nHdrRead, buf, nRead]
+        self.queues = {}  # deques of received messages by (source, tag)
+
+    def _ringName(self, srcRank, destRank):
+        return '%s_%d_%d' % (self.prefix, srcRank, destRank)
+
+    def send(self, obj, dest, tag):
+        payload = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        q = self.pendingWrites[dest]
+        q.append(memoryview(self._hdrStruct.pack(tag, len(payload))))
+        q.append(memoryview(payload))
+        self._pushWrites()
+
+    def hasPendingSends(self):
+        return any(self.pendingWrites.values())
+
+    def _pushWrites(self):
+        progress = False
+        for dest, q in self.pendingWrites.items():
+            ring = self.sendRings[dest]
+            while q:
+                n = ring.write(q[0])
+                if n:
+                    progress = True
+                if n < len(q[0]):
+                    q[0] = q[0][n:]
+                    break
+                q.popleft()
+        return progress
+
+    def _drain(self, source):
+        """Queue every complete message which has arrived from source; True if any bytes moved"""
+        ring = self.recvRings.get(source)
+        if ring is None:
+            try:
+                ring = self.recvRings[source] = ShmRing(self._ringName(source, self.rank))
+            except (OSError, ValueError):
+                return False  # the partner has not created it yet
+        progress = False
+        while True:
+            state = self.partialReads.get(source)
+            if state is None:
+                state = self.partialReads[source] = [bytearray(self._hdrStruct.size), 0, None, 0]
+            hdrBuf, nHdrRead, buf, nRead = state
+            if buf is None:
+                n = ring.read(memoryview(hdrBuf)[nHdrRead:])
+                progress = progress or n > 0
+                state[1] = nHdrRead = nHdrRead + n
+                if nHdrRead < len(hdrBuf):
+                    return progress
+                tag, nBytes = self._hdrStruct.unpack(hdrBuf)
+                state[2] = buf = bytearray(nBytes)
+            n = ring.read(memoryview(buf)[nRead:])
+            progress = progress or n > 0
+            state[3] = nRead = nRead + n
+            if nRead < len(buf):
+                return progress
+            tag = self._hdrStruct.unpack(hdrBuf)[0]
+            del self.partialReads[source]
+            self.queues.setdefault((source, tag), deque()).append(pickle.loads(buf))
+
+    def poll(self, source, tag):
+        self._drain(source)
+        q = self.queues.get((source, tag))
+        if q:
+            return (True, q.popleft())
+        else:
+            return (False, None)
+
+    def progress(self):
+        progress = self._pushWrites()
+        for source in range(self.size):
+            if source != self.rank and self._drain(source):
+                progress = True
+        return progress
+
+    def idle(self, nIdle):
+        if nIdle < self.spinsBeforeSleep:
+            time.sleep(0)  # yield the core, since ranks may share cores
+        else:
+            time.sleep(self.idleSleepSeconds)
+
+    def close(self):
+        """
+        All ranks must call this together.  The barrier makes sure every rank has finished
+        reading before the rings are unlinked.
+        """
+        self.Barrier()
+        self.flush()
+        for ring in list(self.sendRings.values()) + list(self.recvRings.values()):
+            ring.close()
+        self.sendRings = {}
+        self.recvRings = {}
+
+
+def _processMain(rank, size, prefix, target, args):
+    comm = ProcessCommunicator(rank, size, prefix)
+    try:
+        target(comm, *args)
+    except Exception:
+        logger.exception('rank %d failed' % rank)
+        comm.Abort(1)
+    comm.close()
+
+
+def getForkContext():
+    """Returns a multiprocessing context which forks, or None if there is none"""
+    if hasattr(multiprocessing, 'get_context'):
+        try:
+            return multiprocessing.get_context('fork')
+        except ValueError:
+            return None
+    elif sys.platform.startswith('win'):
+        return None
+    else:
+        return multiprocessing  # Python 2 always forks on posix
+
+
+def runProcesses(nRanks, target, args=()):
+    """
+    Run target(comm, *args) in nRanks processes, where comm is each process's
+    ProcessCommunicator, and wait for them all to finish.  Returns the list of process exit
+    codes.  The processes are forked where possible, so that they inherit the state of
+    this one.  Otherwise the platform's default start method is used, and target and args
+    must be picklable.
+    """
+    context = getForkContext()
+    if context is None:
+        context = multiprocessing
+    prefix = 'quilt_%d_%d' % (os.getpid(), int(time.time()))
+    procs = [context.Process(target=_processMain, args=(rank, nRanks, prefix, target, args))
+             for rank in range(nRanks)]
+    for p in procs:
+        p.start()
+    while any([p.is_alive() for p in procs]):
+        if any([p.exitcode for p in procs]):
+            # As with MPI_Abort, one failed rank brings down the rest
+            for p in procs:
+                if p.is_alive():
+                    p.terminate()
+        time.sleep(0.1)
+    for p in procs:
+        p.join()
+    return [p.exitcode for p in procs]
+
+
+def describeSelf():
+    print("Usage: communicator.py [nRanks]")
+
+
+def _selfTest(comm):
+    gathered = comm.allgather(comm.rank)
+    assert gathered == list(range(comm.size)), gathered
+    for dest in range(comm.size):
+        if dest != comm.rank:
+            comm.send(('hello', comm.rank, bytearray(3 * comm.ringBytes // 2)), dest, 7)
+    for src in range(comm.size):
+        if src != comm.rank:
+            msg = comm.recv(src, 7)
+            assert msg[0] == 'hello' and msg[1] == src, msg
+    comm.flush()
+    print('rank %d of %d: ok' % (comm.rank, comm.size))
+
+
+def main():
+    nRanks = 3
+    if len(sys.argv) > 1:
+        try:
+            nRanks = int(sys.argv[1])
+        except ValueError:
+            describeSelf()
+            sys.exit('argument must be an integer')
+    codes = runProcesses(nRanks, _selfTest)
+    if any(codes):
+        sys.exit('exit codes %s' % codes)
+
+############
+# Main hook
+############
+
+if __name__ == "__main__":
+    main()
@@ -17,33 +17,106 @@
 
 _rhea_svn_id_ = "$Id$"
 
-from mpi4py import MPI
+import os
+# Importing mpi4py.MPI initializes MPI, which QUILT_NOMPI avoids even if it is installed
+if os.environ.get('QUILT_NOMPI'):
+    MPI = None
+else:
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        MPI = None  # only the communicators in quilt.communicator are available
 import numpy as np
-from collections import namedtuple
+import io
+import time
+import struct
+import pickle
 import logging
 
+from quilt.communicator import Communicator, LocalCommunicator, ShmRing, shared_memory
+
 logger = logging.getLogger(__name__)
 
 
 def getCommWorld():
-    """Provide easy access to the world to packages that don't want to know about MPI"""
-    return MPI.COMM_WORLD
+    """
+    Provide easy access to the world to packages that don't want to know about MPI.  If
+    mpi4py is not installed or QUILT_NOMPI is set, the world is a single rank in this
+    process.
+    """
+    if MPI is None:
+        return LocalCommunicator()
+    else:
+        return MPI.COMM_WORLD
 
 
 class VectorClock(object):
+    """
+    The clock vector is updated in place, so a reference to self.vec sees later ticks and
+    merges.  Use copy() or setFrom() to hold on to the current time.
+    """
     def __init__(self, commSize, rank, vec=None):
         self.rank = rank
         if vec is None:
             self.vec = np.zeros(commSize, dtype=np.int32)
         else:
             self.vec = np.copy(vec)
+        self._scratch = None  # boolean work array for comparisons
 
     def incr(self):
         self.vec[self.rank] += 1
 
     def merge(self, foreignVec):
         """ This operation does not include incrementing the local time """
-        self.vec = np.maximum(self.vec, foreignVec)
+        np.maximum(self.vec, foreignVec, out=self.vec)
+
+    def encodeDelta(self, lastSent):
+        """
+        Returns the clock encoded relative to lastSent, the vector most recently encoded
+        for the same receiver, and updates lastSent in place.  The encoding is the smallest
+        of:
+
+            an int             every entry has advanced by that amount
+            (indices, steps)   a few entries have advanced; both are int32 bytes
+            bytes              every entry has advanced by less than 256; one uint8 each
+            the vector         anything else
+
+        The vector is returned as a copy, since the communicator may keep a reference to it.
+        In the steady state every rank ticks once per cycle, so the int form is typical.
+        The receiver must decode with mergeDelta(), and messages must be decoded in the
+        order they were encoded.
+        """
+        diff = self.vec - lastSent
+        np.copyto(lastSent, self.vec)
+        lo = diff.min()
+        hi = diff.max()
+        if lo == hi:
+            return int(lo)
+        elif lo >= 0 and hi < 256:
+            changed = np.flatnonzero(diff)
+            if 8 * changed.shape[0] < diff.shape[0]:
+                return (changed.astype(np.int32).tobytes(), diff[changed].tobytes())
+            else:
+                return diff.astype(np.uint8).tobytes()
+        else:
+            return self.vec.copy()
+
+    def mergeDelta(self, enc, lastRecv):
+        """
+        Decode a clock produced by encodeDelta() into lastRecv, the vector most recently
+        decoded from the same sender, and merge the result.  This operation does not
+        include incrementing the local time.
+        """
+        if isinstance(enc, tuple):
+            idx = np.frombuffer(enc[0], dtype=np.int32)
+            lastRecv[idx] += np.frombuffer(enc[1], dtype=np.int32)
+        elif isinstance(enc, bytes):
+            lastRecv += np.frombuffer(enc, dtype=np.uint8)
+        elif isinstance(enc, np.ndarray):
+            np.copyto(lastRecv, enc)
+        else:
+            lastRecv += enc
+        self.merge(lastRecv)
 
     def max(self):
         return np.amax(self.vec)
@@ -51,43 +124,138 @@ class VectorClock(object):
     def min(self):
         return np.amin(self.vec)
 
+    def _anyLess(self, a, b):
+        """returns True if any element of a is less than the corresponding element of b"""
+        scratch = self._scratch
+        if scratch is None or scratch.shape != a.shape:
+            scratch = self._scratch = np.empty(a.shape, dtype=np.bool_)
+        return np.less(a, b, out=scratch).any()
+
     def before(self, other):
         """returns True if 'self' is less than the vector clock 'other' """
-        return (np.all(np.less_equal(self.vec, other.vec))
-                and np.any(np.less(self.vec, other.vec)))
+        return (not self._anyLess(other.vec, self.vec)
+                and self._anyLess(self.vec, other.vec))
 
     def after(self, other):
         """returns True if the vector clock 'other' is less than 'self' """
-        return (np.all(np.less_equal(other.vec, self.vec))
-                and np.any(np.less(other.vec, self.vec)))
+        return (not self._anyLess(self.vec, other.vec)
+                and self._anyLess(other.vec, self.vec))
 
     def simultaneous(self, other):
         """returns True if neither vector clock is before the other"""
-        return (not self.before(other) and not self.after(other))
+        return self._anyLess(self.vec, other.vec) == self._anyLess(other.vec, self.vec)
 
     def __str__(self):
         return 'VClock(%s)' % str(self.vec)
 
     def copy(self):
-        return VectorClock(self.vec.shape[0], self.rank, vec=np.copy(self.vec))
+        result = VectorClock.__new__(VectorClock)
+        result.rank = self.rank
+        result.vec = self.vec.copy()
+        result._scratch = None
+        return result
+
+    def setFrom(self, other):
+        """Set this clock to the time of 'other' without allocating a new vector"""
+        if other.vec.shape == self.vec.shape:
+            np.copyto(self.vec, other.vec)
+        else:
+            self.vec = other.vec.copy()
+
+
+_LCL_MASK = 0xffffffff  # the interactant id field of an encoded address; all ones for a patch
+
+
+def _unpickleGblAddr(code):
+    return GblAddr.decode(code)
+
+
+class GblAddr(object):
+    """
+    The global address of a patch or of an interactant in a patch.  rank is the home rank
+    of the patch and lclId is either the patch id or a (patchId, interactantId) tuple.
+    Addresses can be indexed and unpacked like the (rank, lclId) tuples they once were.
+
+    Addresses are interned: constructing one returns the existing instance with the same
+    rank and lclId if there is one, and unpickling does the same.  Equal addresses are
+    thus identical, so comparison usually succeeds on identity and the hash is computed
+    only once.  Each address also has an integer encoding, (rank << 64) | lclCode, where
+    lclCode packs the patch id into the high 32 bits and the interactant id (all ones for
+    a patch) into the low 32.  Addresses are pickled in that form; see encode() and
+    decode().
+    """
+    __slots__ = ('rank', 'lclId', 'lclCode', '_hash', '_patchAddr')
+    _internDict = {}  # addresses by (rank, lclId)
+    _codeDict = {}  # addresses by encoding
+
+    def __new__(cls, rank, lclId):
+        try:
+            return cls._internDict[(rank, lclId)]
+        except KeyError:
+            pass
+        self = object.__new__(cls)
+        self.rank = rank
+        self.lclId = lclId
+        self._hash = hash((rank, lclId))
+        if isinstance(lclId, tuple):
+            patchId, iactId = lclId
+            assert 0 <= patchId < 2**32, 'patch id %s is out of range' % patchId
+            assert 0 <= iactId < _LCL_MASK, 'interactant id %s is out of range' % iactId
+            self.lclCode = (patchId << 32) | iactId
+            self._patchAddr = GblAddr(rank, patchId)
+        else:
+            assert 0 <= lclId < 2**32, 'patch id %s is out of range' % lclId
+            self.lclCode = (lclId << 32) | _LCL_MASK
+            self._patchAddr = self
+        cls._internDict[(rank, lclId)] = self
+        cls._codeDict[self.encode()] = self
+        return self
+
+    def encode(self):
+        """Returns the integer encoding of this address"""
+        return (self.rank << 64) | self.lclCode
+
+    @staticmethod
+    def decode(code):
+        """The inverse of encode()"""
+        try:
+            return GblAddr._codeDict[code]
+        except KeyError:
+            rank, lclCode = code >> 64, code & 0xffffffffffffffff
+            patchId, iactId = lclCode >> 32, lclCode & _LCL_MASK
+            if iactId == _LCL_MASK:
+                return GblAddr(rank, patchId)
+            else:
+                return GblAddr(rank, (patchId, iactId))
 
-_InnerGblAddr = namedtuple('_innerGblAddr', ['rank', 'lclId'])
+    def __reduce__(self):
+        return (_unpickleGblAddr, (self.encode(),))
 
+    def __getitem__(self, idx):
+        if idx == 0:
+            return self.rank
+        elif idx == 1:
+            return self.lclId
+        else:
+            return (self.rank, self.lclId)[idx]
+
+    def __iter__(self):
+        return iter((self.rank, self.lclId))
 
-class GblAddr(_InnerGblAddr):
+    def __len__(self):
+        return 2
 
     def getLclAddr(self):
         return self.lclId
 
     def getPatchAddr(self):
-        if isinstance(self.lclId, tuple):
-            return GblAddr(self.rank, self.lclId[0])
-        else:
-            return GblAddr(self.rank, self.lclId)
+        return self._patchAddr
 
     @staticmethod
     def tupleGetPatchAddr(tpl):
-        """For those awkward times when the argument is really an _InnerGblAddr"""
+        """For those awkward times when the argument may be a plain (rank, lclId) tuple"""
+        if isinstance(tpl, GblAddr):
+            return tpl._patchAddr
         rank = tpl[0]
         lclId = tpl[1]
         if isinstance(lclId, tuple):
@@ -101,6 +269,9 @@ class GblAddr(_InnerGblAddr):
         else:
             return '%d_%d' % (self.rank, self.lclId)
 
+    def __repr__(self):
+        return 'GblAddr(rank=%r, lclId=%r)' % (self.rank, self.lclId)
+
     def __lt__(self, other):
         return (self.rank < other.rank
                 or (self.rank == other.rank and self.lclId < other.lclId))
@@ -109,11 +280,12 @@ class GblAddr(_InnerGblAddr):
         return self < other or self == other
 
     def __eq__(self, other):
-        return (type(self) == type(other)
-                and self.rank == other.rank and self.lclId == other.lclId)
+        return (self is other
+                or (isinstance(other, GblAddr)
+                    and self.rank == other.rank and self.lclId == other.lclId))
 
     def __ne__(self, other):
-        return (type(self) != type(other) or self.rank != other.rank or self.lclId != other.lclId)
+        return not self.__eq__(other)
 
     def __gt__(self, other):
         return (self.rank > other.rank
@@ -123,49 +295,208 @@ class GblAddr(_InnerGblAddr):
         return self > other or self == other
 
     def __hash__(self):
+        return self._hash
+
+
+class RecvBufferPool(object):
+    """
+    A pool of receive buffers, one per source rank, which are reused from cycle to cycle.
+    The size of each message received is recorded.  A buffer is grown as soon as a
+    message needs more room than it has, and every shrinkWindow receives from a source its
+    buffer is shrunk if it is more than twice as large as the largest recent message
+    requires.  Buffers are never smaller than minSize.
+
+    Buffer sizes are rounded up to a power of two multiple of minSize, with 'headroom' as
+    the factor of slack beyond the observed message size.
+    """
+    shrinkWindow = 64
+    headroom = 1.25
+
+    def __init__(self, minSize):
+        self.minSize = minSize
+        self._free = {}  # free buffers by source rank
+        self._winMax = {}  # largest message in the current window, by source rank
+        self._winCount = {}  # number of messages in the current window, by source rank
+        self.stats = {}  # statistics dicts by source rank
+
+    def _targetSize(self, nBytes):
+        sz = self.minSize
+        nBytes = int(nBytes * self.headroom)
+        while sz < nBytes:
+            sz *= 2
+        return sz
+
+    def _getStats(self, srcRank):
+        if srcRank not in self.stats:
+            self.stats[srcRank] = {'nRecvs': 0, 'totBytes': 0, 'maxBytes': 0, 'nAllocs': 0,
+                                   'nGrows': 0, 'nShrinks': 0, 'bufSize': 0}
+            self._winMax[srcRank] = 0
+            self._winCount[srcRank] = 0
+        return self.stats[srcRank]
+
+    def get(self, srcRank, nBytes=0):
         """
-        MD: I'm not yet sure if it's a python 3 specific thing,
-        but objects that override equivalence functions won't hash with standard object hashing
-        Without this, I get a `TypeError: unhashable type: 'GblAddr'`
-        More research is required to see if this solution treats the disease or the symptom, however
+        Returns a bytearray at least nBytes long for a message from srcRank.  The caller
+        must hand it back with release() when the message has been consumed.
         """
-        return hash((self.rank, self.lclId))
+        stats = self._getStats(srcRank)
+        buf = self._free.pop(srcRank, None)
+        if buf is None or len(buf) < nBytes:
+            if buf is not None:
+                stats['nGrows'] += 1
+            buf = bytearray(max(self._targetSize(nBytes), stats['bufSize']))
+            stats['nAllocs'] += 1
+            stats['bufSize'] = len(buf)
+        return buf
+
+    def release(self, srcRank, buf, nBytes):
+        """Return a buffer to the pool, recording that it held a message of nBytes"""
+        stats = self._getStats(srcRank)
+        stats['nRecvs'] += 1
+        stats['totBytes'] += nBytes
+        stats['maxBytes'] = max(stats['maxBytes'], nBytes)
+        self._winMax[srcRank] = max(self._winMax[srcRank], nBytes)
+        self._winCount[srcRank] += 1
+        if self._winCount[srcRank] >= self.shrinkWindow:
+            target = self._targetSize(self._winMax[srcRank])
+            if 2 * target <= len(buf):
+                buf = bytearray(target)
+                stats['nShrinks'] += 1
+                stats['nAllocs'] += 1
+                stats['bufSize'] = target
+            self._winMax[srcRank] = 0
+            self._winCount[srcRank] = 0
+        if len(buf) >= stats['bufSize']:
+            self._free[srcRank] = buf
+
+    def getStats(self):
+        """Returns a dict of statistics dicts, keyed by source rank"""
+        return dict([(k, v.copy()) for k, v in self.stats.items()])
 
 
 class NetworkInterface(object):
     MPI_TAG_MORE = 1
     MPI_TAG_END = 2
+    MPI_TAG_TRANSFER = 4
 
     #maxChunksPerMsg = 32
     maxChunksPerMsg = 24
     irecvBufferSize = 1024 * 1024
 
-    def __init__(self, comm, deterministic=False):
+    def __init__(self, comm, deterministic=False, deltaClocks=False):
         self.comm = comm
         self.vclock = VectorClock(self.comm.size, self.comm.rank)
         self.outgoingDict = {}
         self.outstandingSendReqs = []
         self.outstandingRecvReqs = []
+        self.outstandingRecvBufs = []  # parallel to outstandingRecvReqs
+        self.recvPool = RecvBufferPool(NetworkInterface.irecvBufferSize)
         self.expectFrom = set()  # Other ranks sending to us directly
+        self.sendTo = set()  # Other ranks we send to directly
+        self.patchRanks = {}  # current rank of each patch which has migrated from its home
+        self.clockSentDict = {}  # last clock vector encoded for each destination rank
+        self.clockRecvDict = {}  # last clock vector decoded from each source rank
         self.clientIncomingCallbacks = {}
         self.deterministic = deterministic
+        self.deltaClocks = deltaClocks  # send only the changed entries of the clock; see _wireClock
         self.doneMsg = [(False, 0)]
         self.incomingLclMessages = []
+        self.cycleOpened = False  # see openCycle
         self.doneSignalSent = False
         self.doneSignalsSeen = 0
         self.doneMaxCycle = 0
+        self.doneVec = None  # done cycle by rank, if done signals are relayed; see setDoneTopology
+        self.doneRanks = None
+        self.doneDiameter = 0
+        self.reductionReq = None
+        self.reductionResult = None
+        self.reductionPending = False
 
     def getGblAddr(self, lclId):
         return GblAddr(self.comm.rank, lclId)
 
+    def rankOf(self, gblAddr):
+        """
+        Returns the rank currently holding the patch of gblAddr.  This is the rank in the
+        address unless the patch has migrated; see setPatchRank.
+        """
+        if self.patchRanks:
+            return self.patchRanks.get(GblAddr.tupleGetPatchAddr(gblAddr), gblAddr[0])
+        else:
+            return gblAddr[0]
+
+    def setPatchRank(self, patchAddr, rank):
+        """
+        Record that the patch with address patchAddr now lives on the given rank.  A patch
+        keeps its address when it migrates, so messages for it and its interactants are
+        forwarded to its current rank.  Every rank must make the same calls at the same
+        point in the cycle.
+        """
+        if rank == patchAddr.rank:
+            self.patchRanks.pop(patchAddr, None)
+        else:
+            self.patchRanks[patchAddr] = rank
+
+    def dropCallbacks(self, patchAddr):
+        """Forget the incoming message callbacks of a patch which is leaving this rank"""
+        for key in [k for k in self.clientIncomingCallbacks if k[1] == patchAddr]:
+            del self.clientIncomingCallbacks[key]
+
     def isLocal(self, gblAddr):
-        return gblAddr.rank == self.comm.rank
+        return self.rankOf(gblAddr) == self.comm.rank
 
     def barrier(self):
         self.comm.Barrier()
 
+    def close(self):
+        """
+        Release any resources held by the transport.  This is called once communication is
+        over, after every rank has agreed that it is done.
+        """
+        pass
+
+    def startReduction(self, vals):
+        """
+        Begin a non-blocking global sum of the integer sequence vals, elementwise across
+        all ranks.  Every rank must call this the same number of times, and the result is
+        collected with finishReduction().  A single-rank run simply keeps a local copy.
+        """
+        assert self.reductionReq is None, 'previous reduction was never finished'
+        sendBuf = np.array(vals, dtype=np.int64)
+        if self.comm.size == 1:
+            self.reductionResult = sendBuf
+        else:
+            self.reductionResult = np.empty_like(sendBuf)
+            self.reductionReq = self.comm.Iallreduce(sendBuf, self.reductionResult, op=MPI.SUM)
+        self.reductionPending = True
+
+    def finishReduction(self):
+        """Wait for the reduction begun by startReduction() and return the sums"""
+        if self.reductionReq is not None:
+            self.reductionReq.Wait()
+            self.reductionReq = None
+        self.reductionPending = False
+        return self.reductionResult
+
+    def transfer(self, outgoing, incomingRanks):
+        """
+        Exchange objects outside the message cycle.  outgoing is a list of (destRank, obj)
+        tuples, and incomingRanks has one entry, the source rank, for each object this rank
+        is to receive.  Objects from a given source arrive in the order they were sent.
+        The received objects are returned in the order of incomingRanks.
+
+        This must be called between finishSend() and startRecv(), when no cycle messages
+        are outstanding, and the senders and receivers must agree on what is sent.
+        """
+        reqs = [self.comm.isend(obj, destRank, tag=NetworkInterface.MPI_TAG_TRANSFER)
+                for destRank, obj in outgoing]
+        result = [self.comm.recv(source=srcRank, tag=NetworkInterface.MPI_TAG_TRANSFER)
+                  for srcRank in incomingRanks]
+        MPI.Request.Waitall(reqs)
+        return result
+
     def enqueue(self, msgType, thing, srcAddr, gblAddr):
-        toRank = gblAddr.rank
+        toRank = self.rankOf(gblAddr)
         if toRank not in self.outgoingDict:
             self.outgoingDict[toRank] = []
         self.outgoingDict[toRank].append((srcAddr, gblAddr, msgType, thing))
@@ -179,35 +510,127 @@ class NetworkInterface(object):
         There is no way to drop a rank from the expected source set because one can
         never be sure there is no straggler message from that rank
         """
-        if srcAddr.rank != self.comm.rank:
-            self.expectFrom.add(srcAddr.rank)
-        assert destAddr.rank == self.comm.rank, "Cannot deliver to foreign object %s" % destAddr
-        self.clientIncomingCallbacks[(srcAddr.rank, srcAddr.lclId,
-                                      destAddr.lclId)] = handleIncoming
+        srcRank = self.rankOf(srcAddr)
+        if srcRank != self.comm.rank:
+            self.expectFrom.add(srcRank)
+        assert self.rankOf(destAddr) == self.comm.rank, \
+            "Cannot deliver to foreign object %s" % destAddr
+        self.clientIncomingCallbacks[(srcAddr, destAddr)] = handleIncoming
+
+    def getRecvBufferStats(self):
+        """
+        Returns a dict, keyed by source rank, of receive buffer statistics: the number of
+        messages and bytes received, the largest message, the number of buffer
+        allocations, grows and shrinks, and the current buffer size.
+        """
+        return self.recvPool.getStats()
+
+    def _postRecv(self, srcRank):
+        buf = self.recvPool.get(srcRank)
+        self.outstandingRecvReqs.append(self.comm.irecv(buf, srcRank, MPI.ANY_TAG))
+        self.outstandingRecvBufs.append(buf)
+
+    def willSendTo(self, destAddr):
+        """
+        Every rank in expectFrom must send exactly one message per cycle.  Clients call this
+        for each destination to which they may send, starting in the same cycle as the
+        receiving client's first call to expect(), and a rank with nothing to deliver to
+        one of those destinations in a given cycle sends just a header holding its vector
+        clock and done signal.  Thus clients need not enqueue empty messages to keep the
+        cycle going, and receivers must treat the absence of a message as 'nothing arrived'.
+        """
+        destRank = self.rankOf(destAddr)
+        if destRank != self.comm.rank:
+            self.sendTo.add(destRank)
+
+    def _addHeaderOnlyDests(self):
+        for destRank in self.sendTo:
+            if destRank not in self.outgoingDict:
+                self.outgoingDict[destRank] = []
 
     def startRecv(self):
+        """
+        Pickled messages are received into pooled buffers no smaller than irecvBufferSize,
+        since a message larger than its buffer would be truncated.  The pool saves
+        allocating fresh buffers every cycle.
+        """
+        self.cycleOpened = False
         if self.deterministic:
             l = [a for a in self.expectFrom]
             l.sort()
             for srcRank in l:
-                buf = bytearray(NetworkInterface.irecvBufferSize)
-                self.outstandingRecvReqs.append(self.comm.irecv(buf, srcRank, MPI.ANY_TAG))
+                self._postRecv(srcRank)
         else:
             for srcRank in self.expectFrom:
-                buf = bytearray(NetworkInterface.irecvBufferSize)
-                self.outstandingRecvReqs.append(self.comm.irecv(buf, srcRank, MPI.ANY_TAG))
+                self._postRecv(srcRank)
 
     def _innerRecv(self, tpl):
         msgType, srcTag, destTag, partTpl = tpl
         logger.debug('msg type %s arrived from %s for %s' % (msgType, srcTag, destTag))
-        self.clientIncomingCallbacks[(srcTag.rank, srcTag.lclId, destTag.lclId)](msgType, partTpl)
+        self.clientIncomingCallbacks[(srcTag, destTag)](msgType, partTpl)
 
-    def finishRecv(self):
+    def openCycle(self):
+        """
+        Called before the first message of a cycle is delivered, by finishRecv or by
+        whichever pollRecv comes first.  Local messages from the last cycle are delivered
+        here.
+        """
+        if self.cycleOpened:
+            return
+        self.cycleOpened = True
         self.vclock.incr()  # must happen before incoming messages arrive
         logger.debug('%d local messages' % len(self.incomingLclMessages))
         for tpl in self.incomingLclMessages:
             self._innerRecv(tpl)
         self.incomingLclMessages = []
+
+    def _deliver(self, idx, msg, s):
+        """Deliver msg, just received by outstandingRecvReqs[idx] with status s"""
+        self.outstandingRecvReqs.pop(idx)
+        self.recvPool.release(s.Get_source(), self.outstandingRecvBufs.pop(idx),
+                              s.Get_count(MPI.BYTE))
+        tag = s.Get_tag()
+        if tag == NetworkInterface.MPI_TAG_MORE:
+            logger.debug('netInterface rank %d: MORE from %s' %
+                         (self.comm.rank, s.Get_source()))
+            self._postRecv(s.Get_source())
+        else:
+            self._noteDone(msg.pop())
+        vtm = msg[0]
+        #
+        # Handle vtime order issues here
+        #
+        self._mergeWireClock(s.Get_source(), vtm)
+        for tpl in msg[1:]:
+            self._innerRecv(tpl)
+
+    def pollRecv(self):
+        """
+        Deliver any messages of the current cycle which have already arrived, without
+        waiting for the rest, and return True if nothing more is due this cycle.  This
+        lets the caller keep working while messages are in flight; finishRecv must still
+        be called to complete the cycle.  In deterministic mode messages are only delivered
+        by finishRecv, in a fixed order, so this just reports whether any are outstanding.
+        """
+        if self.deterministic:
+            return not self.outstandingRecvReqs
+        self.openCycle()
+        while self.outstandingRecvReqs:
+            statuses = [MPI.Status() for r in self.outstandingRecvReqs]  # @UnusedVariable
+            indices, msgs = MPI.Request.testsome(self.outstandingRecvReqs, statuses)
+            if not indices:
+                return False
+            # statuses are in completion order.  Deliver from the highest index down, so
+            # that popping a request does not shift those yet to be delivered.
+            done = sorted(zip(indices, msgs, statuses), key=lambda tpl: tpl[0], reverse=True)
+            for idx, msg, st in done:
+                logger.debug('netInterface rank %d: testsome returned idx %s: tag %s source %s'
+                             % (self.comm.rank, idx, st.Get_tag(), st.Get_source()))
+                self._deliver(idx, msg, st)
+        return True
+
+    def finishRecv(self):
+        self.openCycle()
         while True:
             if not self.outstandingRecvReqs:
                 break
@@ -216,67 +639,34 @@ class NetworkInterface(object):
                 msg = MPI.Request.wait(self.outstandingRecvReqs[-1], s)
                 logger.debug('netInterface rank %d: wait returned for last idx: tag %s source %s'
                              % (self.comm.rank, s.Get_tag(), s.Get_source()))
-                self.outstandingRecvReqs.pop()
-                tag = s.Get_tag()
-                if tag == NetworkInterface.MPI_TAG_MORE:
-                    logger.debug('netInterface rank %d: MORE from %s' %
-                                 (self.comm.rank, s.Get_source()))
-                    buf = bytearray(NetworkInterface.irecvBufferSize)
-                    self.outstandingRecvReqs.append(self.comm.irecv(buf, s.Get_source(),
-                                                                    MPI.ANY_TAG))
-                else:
-                    doneMsg = msg.pop()
-                    if doneMsg[0]:
-                        self.doneSignalsSeen += 1
-                vtm = msg[0]
-                #
-                # Handle vtime order issues here
-                #
-                self.vclock.merge(vtm)
-                for tpl in msg[1:]:
-                    self._innerRecv(tpl)
+                self._deliver(len(self.outstandingRecvReqs) - 1, msg, s)
             else:
                 s = MPI.Status()
                 idx, msg = MPI.Request.waitany(self.outstandingRecvReqs, s)
                 logger.debug('netInterface rank %d: waitany returned for idx %s: tag %s source %s'
                              % (self.comm.rank, idx, s.Get_tag(), s.Get_source()))
-                self.outstandingRecvReqs.pop(idx)
-                tag = s.Get_tag()
-                if tag == NetworkInterface.MPI_TAG_MORE:
-                    logger.debug('netInterface rank %d: MORE from %s' %
-                                 (self.comm.rank, s.Get_source()))
-                    buf = bytearray(NetworkInterface.irecvBufferSize)
-                    self.outstandingRecvReqs.append(self.comm.irecv(buf, s.Get_source(),
-                                                                    MPI.ANY_TAG))
-                else:
-                    doneMsg = msg.pop()
-                    if doneMsg[0]:
-                        self.doneSignalsSeen += 1
-                        self.doneMaxCycle = max(self.doneMaxCycle, doneMsg[1])
-                vtm = msg[0]
-                #
-                # Handle vtime order issues here
-                #
-                self.vclock.merge(vtm)
-                for tpl in msg[1:]:
-                    self._innerRecv(tpl)
+                self._deliver(idx, msg, s)
         self.outstandingRecvReqs = []
+        self.outstandingRecvBufs = []
 
     def startSend(self):
-        vTimeNow = self.vclock.vec
+        self._addHeaderOnlyDests()
         if self.deterministic:
-            l = self.outgoingDict.keys()
-            l.sort()
-            for destRank in l:
+            for destRank in sorted(self.outgoingDict.keys()):
                 msgList = self.outgoingDict[destRank][:]
                 msgList.sort()
                 if destRank == self.comm.rank:
                     # local message
                     for srcTag, destTag, msgType, cargo in msgList:
                         self.incomingLclMessages.append((msgType, srcTag, destTag, cargo))
+                elif not msgList:
+                    # header only
+                    req = self.comm.isend([self._wireClock(destRank)] + self.doneMsg, destRank,
+                                          tag=NetworkInterface.MPI_TAG_END)
+                    self.outstandingSendReqs.append(req)
                 else:
                     while msgList:
-                        bigCargo = [vTimeNow]
+                        bigCargo = [self._wireClock(destRank)]
                         for srcTag, destTag, msgType, cargo \
                                 in msgList[0:NetworkInterface.maxChunksPerMsg]:
                             bigCargo.append((msgType, srcTag, destTag, cargo))
@@ -290,7 +680,7 @@ class NetworkInterface(object):
                                                   tag=NetworkInterface.MPI_TAG_END)
                         self.outstandingSendReqs.append(req)
             self.outgoingDict.clear()
-            self.doneMsg = [(False, 0)]  # to avoid accidental re-sends
+            self.doneMsg = self._quietDoneMsg()  # to avoid accidental re-sends
 
         else:
             for destRank, msgList in self.outgoingDict.items():
@@ -298,9 +688,14 @@ class NetworkInterface(object):
                     # local message
                     for srcTag, destTag, msgType, cargo in msgList:
                         self.incomingLclMessages.append((msgType, srcTag, destTag, cargo))
+                elif not msgList:
+                    # header only
+                    req = self.comm.isend([self._wireClock(destRank)] + self.doneMsg, destRank,
+                                          tag=NetworkInterface.MPI_TAG_END)
+                    self.outstandingSendReqs.append(req)
                 else:
                     while msgList:
-                        bigCargo = [vTimeNow]
+                        bigCargo = [self._wireClock(destRank)]
                         for srcTag, destTag, msgType, cargo \
                                 in msgList[0:NetworkInterface.maxChunksPerMsg]:
                             bigCargo.append((msgType, srcTag, destTag, cargo))
@@ -316,7 +711,7 @@ class NetworkInterface(object):
                         logger.debug('netInterface rank %d sent %s to %s req %s' %
                                      (self.comm.rank, len(bigCargo), destRank, req))
             self.outgoingDict.clear()
-            self.doneMsg = [(False, 0)]  # to avoid accidental re-sends
+            self.doneMsg = self._quietDoneMsg()  # to avoid accidental re-sends
 
     def finishSend(self):
         sList = []
@@ -326,6 +721,57 @@ class NetworkInterface(object):
         MPI.Request.Waitall(self.outstandingSendReqs, statuses=sList)  # @UnusedVariable
         self.outstandingSendReqs = []
 
+    def setDoneTopology(self, ranks, diameter):
+        """
+        By default every rank must hear the 'done' signal directly from every rank it
+        receives from.  If ranks only talk to their neighbors, this is called instead with
+        the list of ranks connected to this one (directly or indirectly, including this rank)
+        and the diameter of that connected graph.  Each message then carries the done cycles
+        of every rank known to the sender, so news of each rank's 'done' signal reaches every
+        connected rank within 'diameter' cycles, and all of them can stop on the same cycle.
+        """
+        self.doneVec = np.full(self.comm.size, -1, dtype=np.int64)
+        self.doneRanks = np.array(sorted(ranks), dtype=np.int64)
+        self.doneDiameter = diameter
+        self.doneMsg = self._quietDoneMsg()
+
+    def _wireClock(self, destRank):
+        """
+        Returns the vector clock as it should be sent in a message to destRank.  With
+        deltaClocks set it is encoded relative to the last clock sent to that rank, which
+        shrinks the header from one int32 per rank to a few bytes.  deltaClocks must have
+        the same value on every rank.
+        """
+        if not self.deltaClocks:
+            return self.vclock.vec
+        lastSent = self.clockSentDict.get(destRank)
+        if lastSent is None:
+            lastSent = self.clockSentDict[destRank] = np.zeros_like(self.vclock.vec)
+        return self.vclock.encodeDelta(lastSent)
+
+    def _mergeWireClock(self, srcRank, enc):
+        """Merge a vector clock produced by _wireClock on srcRank"""
+        if not self.deltaClocks:
+            self.vclock.merge(enc)
+            return
+        lastRecv = self.clockRecvDict.get(srcRank)
+        if lastRecv is None:
+            lastRecv = self.clockRecvDict[srcRank] = np.zeros_like(self.vclock.vec)
+        self.vclock.mergeDelta(enc, lastRecv)
+
+    def _quietDoneMsg(self):
+        if self.doneVec is None:
+            return [(False, 0)]
+        else:
+            return [(False, 0, self.doneVec)]
+
+    def _noteDone(self, doneMsg):
+        if doneMsg[0]:
+            self.doneSignalsSeen += 1
+            self.doneMaxCycle = max(self.doneMaxCycle, doneMsg[1])
+        if self.doneVec is not None:
+            np.maximum(self.doneVec, doneMsg[2], out=self.doneVec)
+
     def sendDoneSignal(self):
         """
         This routine signals all partners of this NetworkInterface that it is 'done' and ready to
@@ -339,6 +785,12 @@ class NetworkInterface(object):
         not-done state.
         """
         cycleNow = self.vclock.vec[self.comm.rank]
+        if self.doneVec is not None:
+            if self.doneVec[self.comm.rank] < 0:
+                self.doneVec[self.comm.rank] = cycleNow
+                self.doneSignalSent = True
+            known = self.doneVec[self.doneRanks]
+            return bool(np.all(known >= 0)) and cycleNow >= known.max() + self.doneDiameter + 1
         if self.doneSignalSent:
             self.doneMsg = [(False, 0)]
         else:
@@ -346,3 +798,438 @@ class NetworkInterface(object):
             self.doneSignalSent = True
             self.doneMaxCycle = max(self.doneMaxCycle, cycleNow)
         return (self.doneSignalsSeen == len(self.expectFrom) and cycleNow >= self.doneMaxCycle + 1)
+
+
+class BufferedNetworkInterface(NetworkInterface):
+    """
+    A NetworkInterface which serializes everything bound for a given rank in a cycle into
+    one contiguous buffer and ships it with a single buffer-based Isend.  The receiver
+    probes for the size of each incoming message and receives it into a buffer which is
+    kept and reused from cycle to cycle.  Thus there is no limit on chunks per message,
+    no MPI_TAG_MORE round trips, and no per-cycle allocation of receive buffers.  Because
+    the size of each message is known before it is received, the receive buffers can be
+    sized to the observed traffic from each source, starting from minRecvBufferSize.
+
+    As with NetworkInterface, every rank in expectFrom must send exactly one message
+    per cycle.
+    """
+    MPI_TAG_BUFFER = 3
+    minRecvBufferSize = 4096
+
+    def __init__(self, comm, deterministic=False, deltaClocks=False):
+        super(BufferedNetworkInterface, self).__init__(comm, deterministic=deterministic,
+                                                       deltaClocks=deltaClocks)
+        self.recvPool = RecvBufferPool(BufferedNetworkInterface.minRecvBufferSize)
+        self.sendStreams = {}  # reusable serialization buffers by destination rank
+        self.sendViews = []  # exported views of sendStreams, pinned until sends complete
+        self.pendingSrcRanks = []  # ranks whose message for this cycle has not been received
+
+    def startRecv(self):
+        """
+        Receives are matched by probing in finishRecv, so this just records the ranks from
+        which a message is due this cycle.
+        """
+        self.cycleOpened = False
+        if self.deterministic:
+            self.pendingSrcRanks = sorted(self.expectFrom)
+        else:
+            self.pendingSrcRanks = list(self.expectFrom)
+
+    def _recvFrom(self, srcRank, status):
+        nBytes = status.Get_count(MPI.BYTE)
+        buf = self.recvPool.get(srcRank, nBytes)
+        self.comm.Recv([buf, nBytes, MPI.BYTE], srcRank,
+                       BufferedNetworkInterface.MPI_TAG_BUFFER)
+        self._deliverBuffer(srcRank, buf, nBytes)
+
+    def _deliverBuffer(self, srcRank, buf, nBytes):
+        """Unpickle and deliver the message of nBytes from srcRank held in pooled buffer buf"""
+        msg = pickle.loads(memoryview(buf)[:nBytes])
+        self.recvPool.release(srcRank, buf, nBytes)
+        self._noteDone(msg.pop())
+        self._mergeWireClock(srcRank, msg[0])
+        for tpl in msg[1:]:
+            self._innerRecv(tpl)
+
+    def pollRecv(self):
+        if self.deterministic:
+            return not self.pendingSrcRanks
+        self.openCycle()
+        tag = BufferedNetworkInterface.MPI_TAG_BUFFER
+        s = MPI.Status()
+        stillPending = []
+        for srcRank in self.pendingSrcRanks:
+            if self.comm.Iprobe(srcRank, tag, s):
+                self._recvFrom(srcRank, s)
+            else:
+                stillPending.append(srcRank)
+        self.pendingSrcRanks = stillPending
+        return not stillPending
+
+    def finishRecv(self):
+        self.openCycle()
+        tag = BufferedNetworkInterface.MPI_TAG_BUFFER
+        s = MPI.Status()
+        pending = self.pendingSrcRanks
+        if self.deterministic:
+            for srcRank in pending:
+                self.comm.Probe(srcRank, tag, s)
+                self._recvFrom(srcRank, s)
+        else:
+            while pending:
+                for idx, srcRank in enumerate(pending):
+                    if self.comm.Iprobe(srcRank, tag, s):
+                        break
+                else:
+                    idx, srcRank = 0, pending[0]
+                    self.comm.Probe(srcRank, tag, s)
+                pending.pop(idx)
+                self._recvFrom(srcRank, s)
+        self.pendingSrcRanks = []
+
+    def startSend(self):
+        self._addHeaderOnlyDests()
+        if self.deterministic:
+            destList = sorted(self.outgoingDict.keys())
+        else:
+            destList = list(self.outgoingDict.keys())
+        for destRank in destList:
+            msgList = self.outgoingDict[destRank]
+            if self.deterministic:
+                msgList.sort()
+            if destRank == self.comm.rank:
+                # local message
+                for srcTag, destTag, msgType, cargo in msgList:
+                    self.incomingLclMessages.append((msgType, srcTag, destTag, cargo))
+            else:
+                bigCargo = [self._wireClock(destRank)]
+                bigCargo.extend([(msgType, srcTag, destTag, cargo)
+                                 for srcTag, destTag, msgType, cargo in msgList])
+                bigCargo.extend(self.doneMsg)
+                stream = self.sendStreams.get(destRank)
+                if stream is None:
+                    stream = self.sendStreams[destRank] = io.BytesIO()
+                stream.seek(0)
+                stream.truncate()
+                pickle.dump(bigCargo, stream, pickle.HIGHEST_PROTOCOL)
+                view = stream.getbuffer()
+                self.sendViews.append(view)
+                self._shipBuffer(destRank, view)
+        self.outgoingDict.clear()
+        self.doneMsg = self._quietDoneMsg()  # to avoid accidental re-sends
+
+    def _shipBuffer(self, destRank, view):
+        """Start sending the serialized message in view, which stays valid until finishSend"""
+        req = self.comm.Isend([view, len(view), MPI.BYTE], destRank,
+                              tag=BufferedNetworkInterface.MPI_TAG_BUFFER)
+        self.outstandingSendReqs.append(req)
+        logger.debug('netInterface rank %d sent %s bytes to %s req %s' %
+                     (self.comm.rank, len(view), destRank, req))
+
+    def finishSend(self):
+        NetworkInterface.finishSend(self)
+        for view in self.sendViews:
+            view.release()  # so the streams can be reused
+        self.sendViews = []
+
+
+class SharedMemoryNetworkInterface(BufferedNetworkInterface):
+    """
+    A BufferedNetworkInterface which passes messages between ranks on the same host
+    through shared memory rather than MPI.  Each sending rank creates a ShmRing of
+    ringBytes for each destination on its host, the first time it sends there, and the
+    destination attaches to it when it first looks for a message from that rank.  A
+    message is the same pickled buffer BufferedNetworkInterface would send, preceded by
+    its length.  Messages to ranks on other hosts go by MPI as before.
+
+    A message larger than the free space in its ring is written in pieces as the receiver
+    drains the ring, so both the receive loops and finishSend keep pushing pending writes
+    along while they wait.  Since every rank sends each of its destinations exactly one
+    message per cycle, a receiver reads exactly one message per source per cycle and
+    leaves anything beyond it for the next cycle.
+    """
+    ringBytes = 4 * 1024 * 1024
+    spinsBeforeSleep = 100  # idle polls before a waiting loop starts sleeping between polls
+    idleSleepSeconds = 0.0001
+    _lenStruct = struct.Struct('<Q')
+
+    def __init__(self, comm, deterministic=False, deltaClocks=False):
+        if shared_memory is None:
+            raise RuntimeError('SharedMemoryNetworkInterface requires'
+                               ' multiprocessing.shared_memory')
+        super(SharedMemoryNetworkInterface, self).__init__(comm, deterministic=deterministic,
+                                                           deltaClocks=deltaClocks)
+        nodeComm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+        self.hostRanks = set(nodeComm.allgather(comm.rank)) - set([comm.rank])
+        if nodeComm.rank == 0:
+            prefix = 'quilt_%d_%d' % (os.getpid(), int(time.time()))
+        else:
+            prefix = None
+        self.shmPrefix = nodeComm.bcast(prefix, root=0)
+        nodeComm.Free()
+        self.sendRings = {}  # rings we write, by destination rank
+        self.recvRings = {}  # rings we read, by source rank
+        self.pendingWrites = {}  # by destination rank, a list of views still to be written
+        self.partialReads = {}  # by source rank, [lenBuf, nLenRead, buf, nBytes, nRead]
+        self.pendingShmRanks = []  # host ranks whose message for this cycle is incomplete
+
+    def _ringName(self, srcRank, destRank):
+        return '%s_%d_%d' % (self.shmPrefix, srcRank, destRank)
+
+    def startRecv(self):
+        super(SharedMemoryNetworkInterface, self).startRecv()
+        self.pendingShmRanks = [r for r in self.pendingSrcRanks if r in self.hostRanks]
+        self.pendingSrcRanks = [r for r in self.pendingSrcRanks if r not in self.hostRanks]
+
+    def _shipBuffer(self, destRank, view):
+        if destRank not in self.hostRanks:
+            super(SharedMemoryNetworkInterface, self)._shipBuffer(destRank, view)
+            return
+        if destRank not in self.sendRings:
+            self.sendRings[destRank] = ShmRing(self._ringName(self.comm.rank, destRank),
+                                               size=self.ringBytes)
+        self.pendingWrites[destRank] = [memoryview(self._lenStruct.pack(len(view))), view]
+        self._pushWrites()
+
+    def _pushWrites(self):
+        """Write as much pending data as the rings will take; returns True if any was written"""
+        progress = False
+        for destRank in list(self.pendingWrites.keys()):
+            views = self.pendingWrites[destRank]
+            ring = self.sendRings[destRank]
+            while views:
+                n = ring.write(views[0])
+                if n:
+                    progress = True
+                if n < len(views[0]):
+                    views[0] = views[0][n:]
+                    break
+                views.pop(0)
+            if not views:
+                del self.pendingWrites[destRank]
+        return progress
+
+    def _pullRead(self, srcRank):
+        """
+        Read what is available of this cycle's message from srcRank, delivering it if it is
+        complete.  Returns True if the message has been delivered.
+        """
+        ring = self.recvRings.get(srcRank)
+        if ring is None:
+            try:
+                ring = self.recvRings[srcRank] = ShmRing(self._ringName(srcRank, self.comm.rank))
+            except (OSError, ValueError):
+                return False  # the sender has not created it yet
+        state = self.partialReads.get(srcRank)
+        if state is None:
+            state = self.partialReads[srcRank] = [bytearray(self._lenStruct.size), 0,
+                                                  None, 0, 0]
+        lenBuf, nLenRead, buf, nBytes, nRead = state
+        if buf is None:
+            nLenRead += ring.read(memoryview(lenBuf)[nLenRead:])
+            state[1] = nLenRead
+            if nLenRead < len(lenBuf):
+                return False
+            nBytes, = self._lenStruct.unpack(lenBuf)
+            buf = self.recvPool.get(srcRank, nBytes)
+            state[2], state[3] = buf, nBytes
+        nRead += ring.read(memoryview(buf)[nRead:nBytes])
+        state[4] = nRead
+        if nRead < nBytes:
+            return False
+        del self.partialReads[srcRank]
+        self._deliverBuffer(srcRank, buf, nBytes)
+        return True
+
+    def _progress(self):
+        """
+        Push pending writes and pull from the rings of any host ranks whose messages are
+        due; returns True if all of this cycle's host messages have been delivered.
+        """
+        self._pushWrites()
+        if self.deterministic:
+            while self.pendingShmRanks and self._pullRead(self.pendingShmRanks[0]):
+                self.pendingShmRanks.pop(0)
+        else:
+            self.pendingShmRanks = [r for r in self.pendingShmRanks if not self._pullRead(r)]
+        return not self.pendingShmRanks
+
+    def _idle(self, nIdle):
+        """Called by waiting loops after nIdle consecutive polls without progress"""
+        if nIdle < self.spinsBeforeSleep:
+            time.sleep(0)  # yield the core, since ranks may share cores
+        else:
+            time.sleep(self.idleSleepSeconds)
+
+    def pollRecv(self):
+        if self.deterministic:
+            return not self.pendingSrcRanks and not self.pendingShmRanks
+        self.openCycle()
+        shmDone = self._progress()
+        return super(SharedMemoryNetworkInterface, self).pollRecv() and shmDone
+
+    def finishRecv(self):
+        """
+        Messages from other hosts are received as by BufferedNetworkInterface, except that
+        probes never block, so the rings keep moving while we wait.  In deterministic mode
+        all host messages are delivered, in rank order, before the others.
+        """
+        self.openCycle()
+        tag = BufferedNetworkInterface.MPI_TAG_BUFFER
+        s = MPI.Status()
+        pending = self.pendingSrcRanks
+        nIdle = 0
+        while True:
+            nWaiting = len(self.pendingShmRanks)
+            shmDone = self._progress()
+            progress = len(self.pendingShmRanks) < nWaiting
+            if self.deterministic and not shmDone:
+                nIdle = 0 if progress else nIdle + 1
+                self._idle(nIdle)
+                continue
+            while pending:
+                if self.comm.Iprobe(pending[0], tag, s):
+                    self._recvFrom(pending.pop(0), s)
+                    progress = True
+                elif self.deterministic:
+                    break
+                else:
+                    pending.append(pending.pop(0))
+                    break
+            if shmDone and not pending:
+                break
+            nIdle = 0 if progress else nIdle + 1
+            self._idle(nIdle)
+        self.pendingSrcRanks = []
+
+    def finishSend(self):
+        nIdle = 0
+        while self.pendingWrites:
+            nIdle = 0 if self._pushWrites() else nIdle + 1
+            self._idle(nIdle)
+        super(SharedMemoryNetworkInterface, self).finishSend()
+
+    def close(self):
+        for ring in list(self.sendRings.values()) + list(self.recvRings.values()):
+            ring.close()
+        self.sendRings = {}
+        self.recvRings = {}
+
+
+class CommNetworkInterface(NetworkInterface):
+    """
+    A NetworkInterface for the communicators of quilt.communicator, which let quilt run
+    without MPI.  Each cycle every rank sends one message to each rank in sendTo, as with
+    the MPI transports, and the global reduction and transfers are built from the same
+    point to point messages.  With a LocalCommunicator there is only one rank, so every
+    message is local and is delivered by reference.
+    """
+    TAG_REDUCTION = 5
+
+    def __init__(self, comm, deterministic=False, deltaClocks=False):
+        assert isinstance(comm, Communicator), 'CommNetworkInterface needs a quilt Communicator'
+        super(CommNetworkInterface, self).__init__(comm, deterministic=deterministic,
+                                                   deltaClocks=deltaClocks)
+        self.pendingSrcRanks = []  # ranks whose message for this cycle has not been received
+        self.reductionVals = None
+
+    def startReduction(self, vals):
+        assert not self.reductionPending, 'previous reduction was never finished'
+        self.reductionVals = np.array(vals, dtype=np.int64)
+        for destRank in range(self.comm.size):
+            if destRank != self.comm.rank:
+                self.comm.send(self.reductionVals, destRank, CommNetworkInterface.TAG_REDUCTION)
+        self.reductionPending = True
+
+    def finishReduction(self):
+        result = self.reductionVals.copy()
+        for srcRank in range(self.comm.size):
+            if srcRank != self.comm.rank:
+                result += self.comm.recv(srcRank, CommNetworkInterface.TAG_REDUCTION)
+        self.reductionPending = False
+        return result
+
+    def transfer(self, outgoing, incomingRanks):
+        for destRank, obj in outgoing:
+            self.comm.send(obj, destRank, NetworkInterface.MPI_TAG_TRANSFER)
+        result = [self.comm.recv(srcRank, NetworkInterface.MPI_TAG_TRANSFER)
+                  for srcRank in incomingRanks]
+        self.comm.flush()
+        return result
+
+    def startRecv(self):
+        self.cycleOpened = False
+        if self.deterministic:
+            self.pendingSrcRanks = sorted(self.expectFrom)
+        else:
+            self.pendingSrcRanks = list(self.expectFrom)
+
+    def _deliverMsg(self, srcRank, msg):
+        self._noteDone(msg.pop())
+        self._mergeWireClock(srcRank, msg[0])
+        for tpl in msg[1:]:
+            self._innerRecv(tpl)
+
+    def _recvSome(self):
+        """Deliver whichever pending messages have arrived; returns True if any did"""
+        progress = False
+        if self.deterministic:
+            candidates = self.pendingSrcRanks[:1]
+        else:
+            candidates = self.pendingSrcRanks[:]
+        for srcRank in candidates:
+            ok, msg = self.comm.poll(srcRank, NetworkInterface.MPI_TAG_END)
+            if ok:
+                self.pendingSrcRanks.remove(srcRank)
+                self._deliverMsg(srcRank, msg)
+                progress = True
+            elif self.deterministic:
+                break
+        return progress
+
+    def pollRecv(self):
+        if self.deterministic:
+            return not self.pendingSrcRanks
+        self.openCycle()
+        self.comm.progress()
+        self._recvSome()
+        return not self.pendingSrcRanks
+
+    def finishRecv(self):
+        self.openCycle()
+        nIdle = 0
+        while self.pendingSrcRanks:
+            while self._recvSome():
+                nIdle = 0
+            if self.pendingSrcRanks:
+                nIdle = 0 if self.comm.progress() else nIdle + 1
+                self.comm.idle(nIdle)
+
+    def startSend(self):
+        self._addHeaderOnlyDests()
+        if self.deterministic:
+            destList = sorted(self.outgoingDict.keys())
+        else:
+            destList = list(self.outgoingDict.keys())
+        for destRank in destList:
+            msgList = self.outgoingDict[destRank]
+            if self.deterministic:
+                msgList.sort()
+            if destRank == self.comm.rank:
+                # local message
+                for srcTag, destTag, msgType, cargo in msgList:
+                    self.incomingLclMessages.append((msgType, srcTag, destTag, cargo))
+            else:
+                clk = self._wireClock(destRank)
+                if not self.deltaClocks:
+                    clk = np.copy(clk)  # the communicator may keep a reference to the message
+                bigCargo = [clk]
+                bigCargo.extend([(msgType, srcTag, destTag, cargo)
+                                 for srcTag, destTag, msgType, cargo in msgList])
+                bigCargo.extend(self.doneMsg)
+                self.comm.send(bigCargo, destRank, NetworkInterface.MPI_TAG_END)
+        self.outgoingDict.clear()
+        self.doneMsg = self._quietDoneMsg()  # to avoid accidental re-sends
+
+    def finishSend(self):
+        self.comm.flush()
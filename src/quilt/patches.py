@@ -17,13 +17,21 @@
 
 _rhea_svn_id_ = "$Id$"
 
-from collections import defaultdict
+from collections import defaultdict, deque
+import bisect
+import io
+import pickle
+import random
+import time
 import logging
 from greenlet import greenlet
+import numpy as np
 
 import quilt.netinterface as netinterface
+import quilt.communicator as communicator
 # from pympler import tracker
 import quilt.agent as agent
+import quilt.agentpack as agentpack
 
 logger = logging.getLogger(__name__)
 
@@ -41,6 +49,8 @@ agent._clockAgentBreakHook = _substituteClockAgentBreakHook
 
 class MsgTypes():
     GATE = 0
+    POST = 1
+    PACKED_GATE = 2
 
 
 def getCommWorld():
@@ -68,7 +78,7 @@ class Interactant(agent.Interactant):
         self.patch = patch
 
     def getGblAddr(self):
-        return self.patch.group.getGblAddr((self.patch.patchId, self.id))
+        return netinterface.GblAddr(self.patch.gblAddr.rank, (self.patch.patchId, self.id))
 
 
 class MultiInteractant(agent.MultiInteractant):
@@ -83,7 +93,7 @@ class MultiInteractant(agent.MultiInteractant):
         self.patch = patch
 
     def getGblAddr(self):
-        return self.patch.group.getGblAddr((self.patch.patchId, self.id))
+        return netinterface.GblAddr(self.patch.gblAddr.rank, (self.patch.patchId, self.id))
 
 
 class Agent(agent.Agent):
@@ -114,6 +124,23 @@ class Agent(agent.Agent):
         # print('%s home is now %s' % (self, newPatch))
 
 
+class FSMAgent(agent.FSMAgent):
+    """
+    An FSMAgent is a mobile agent which is not a greenlet (see agent.FSMAgent).  Instead of
+    a run method it has a step method which the patch's MainLoop calls directly, and which
+    returns the agent's next action.  This avoids the allocation and switching costs of a
+    greenlet, and suits agents like messages whose run method would be a simple finite
+    state machine anyway.
+    """
+    def __init__(self, name, patch, debug=False):
+        agent.FSMAgent.__init__(self, name, patch.loop, debug=debug)
+        self.patch = patch
+
+    def reHome(self, newPatch):
+        self.ownerLoop = newPatch.loop
+        self.patch = newPatch
+
+
 # class OmniClock(Agent):
 #     def __init__(self, ownerPatch):
 #         Agent.__init__(self, 'OmniClock', ownerPatch)
@@ -174,12 +201,20 @@ class GateAgent(Agent):
         self.gateList.append(gate)
 
     def run(self, startTime):
+        """
+        The gates are cycled once per network cycle.  A patch may be given several ticks in
+        one cycle (see PatchGroup.run), so the GateAgent sleeps through any extra ticks;
+        anything reaching a gate in the meantime waits for the next cycle.
+        """
         timeNow = startTime
         assert timeNow is not None, "Timenow is None"
         while True:
             for gate in self.gateList:
                 gate.cycleStart(timeNow)
+            cycle = self.patch.group.cycleCount
             timeNow = self.sleep(0)
+            while self.patch.group.cycleCount == cycle:
+                timeNow = self.sleep(0)
             assert timeNow is not None, "Timenow is None"
             for gate in self.gateList:
                 gate.cycleFinish(timeNow)
@@ -188,35 +223,74 @@ class GateAgent(Agent):
 
 class GateEntrance(Interactant):
     queueBlockSize = 40  # limits network packet size
+    usePackedTransfer = True  # ship agents with registered schemas via agentpack
+    directLocalDelivery = True  # hand agents straight to patches on this rank; see cycleStart
 
     def __init__(self, name, ownerPatch, destTag, debug=False):
         Interactant.__init__(self, name, ownerPatch, debug=debug)
         self.destTag = destTag
         self.nInTransit = 0
         self._oldLockQueue = []
+        self._postQueue = []
         self.logger = logging.getLogger(__name__ + '.GateEntrance')
 
     def cycleStart(self, timeNow):
+        """
+        Everything waiting at the gate is shipped.  If the destination patch is on this rank
+        and dates change collectively, the contents go straight to the matching GateExit
+        instead, arriving in the same cycle without passing through the network interface.
+        That is safe because every patch is then on the same day until the end of the
+        cycle, so the arrivals cannot be in the destination's past.  The circulating date
+        change protocol relies on the vector clock advancing while an agent is in transit,
+        so it always takes the slower path.
+        """
         self.logger.debug('%s begins cycleStart; destTag is %s' % (self._name, self.destTag))
-        self.nInTransit = len([a for a in self._lockQueue if not a.timeless])
+        self.patch.group.willSendTo(self.destTag)  # mirrors GateExit.cycleStart
+        self.nInTransit = self._nEnqueued + len(self._postQueue)
+        self.patch.group.nGateSent += self.nInTransit
+        if self.directLocalDelivery and self.patch.group.collectiveDateChange:
+            gateExit = self.patch.group.getLocalGateExit(self.patch.gblAddr, self.destTag)
+        else:
+            gateExit = None
+        if gateExit is not None:
+            self.nInTransit = 0
+            if self._postQueue:
+                postQueue = self._postQueue
+                self._postQueue = []
+                gateExit.handleIncoming(MsgTypes.POST, (timeNow, postQueue))
+            if self._lockQueue:
+                lockQueue = self._lockQueue
+                self._lockQueue = agent.LockQueue()
+                self._nEnqueued = 0
+                gateExit.handleIncoming(MsgTypes.GATE, (timeNow, lockQueue))
+        if self._postQueue:
+            self.patch.group.enqueue(MsgTypes.POST, (timeNow, self._postQueue),
+                                     self.patch.gblAddr, self.destTag)
+            self._postQueue = []
         if self._lockQueue:
-            q = self._lockQueue[:]
+            q = list(self._lockQueue)
+            packIt = self.usePackedTransfer and not self.patch.group.isLocal(self.destTag)
             while q:
-                self.patch.group.enqueue(MsgTypes.GATE, (timeNow, q[:GateEntrance.queueBlockSize]),
-                                         self.patch.gblAddr, self.destTag)
+                block = q[:GateEntrance.queueBlockSize]
+                if packIt and agentpack.canPack(block):
+                    self.patch.group.enqueue(MsgTypes.PACKED_GATE,
+                                             (timeNow, agentpack.packAgents(block)),
+                                             self.patch.gblAddr, self.destTag)
+                else:
+                    self.patch.group.enqueue(MsgTypes.GATE, (timeNow, block),
+                                             self.patch.gblAddr, self.destTag)
                 q = q[GateEntrance.queueBlockSize:]
-        else:
-            self.patch.group.enqueue(MsgTypes.GATE, (timeNow, []),
-                                     self.patch.gblAddr, self.destTag)
         self._oldLockQueue = self._lockQueue
-        self._lockQueue = []
+        self._lockQueue = agent.LockQueue()
         self._nEnqueued = 0
+        self._updateBlocking()
         self.logger.debug('%s ends cycleStart' % self._name)
 
     def cycleFinish(self, timeNow):
         if self._debug:
             self.logger.debug('%s begins cycleFinish' % self._name)
         self.nInTransit = 0
+        self._updateBlocking()
         if not self.patch.group.isLocal(self.destTag):
             for a in self._oldLockQueue:
                 a.kill()
@@ -225,14 +299,23 @@ class GateEntrance(Interactant):
             self.logger.debug('%s ends cycleFinish' % self._name)
 
     def getNWaiting(self):
-        return self._nEnqueued + self.nInTransit
+        return self._nEnqueued + len(self._postQueue) + self.nInTransit
 
     def getWaitingDetails(self):
         """Returns a dict of typeName:nOfThisType entries"""
         result = Interactant.getWaitingDetails(self)
+        result['_posted'] = len(self._postQueue)
         result['_in_transit'] = self.nInTransit
         return result
 
+    def forwardMsg(self, msgType, payload, destAddr, timeNow):
+        """
+        Queue a message posted with Patch.postMsg for delivery through this gate.  Messages
+        are shipped in one batch per cycle.
+        """
+        self._postQueue.append((destAddr, msgType, payload, timeNow))
+        self._updateBlocking()
+
     def lock(self, lockingAgent):
         if self._lockingAgent is not None:
             #  This will get enqueued for sending
@@ -254,10 +337,21 @@ class GateExit(Interactant):
         pass
 
     def handleIncoming(self, msgType, incomingTuple):
-        """ This is called by the messaging system to deliver incoming agents """
-        if msgType == MsgTypes.GATE:
-            senderTime, agentList = incomingTuple
+        """
+        This is called by the messaging system to deliver incoming agents.  A GateEntrance
+        with nothing to send stays silent, so a cycle with no call simply means that
+        nothing arrived.  A GateEntrance on the same rank may call this directly, in which
+        case the agents arrive in its LockQueue rather than in a list.
+        """
+        self.patch.runPending = True
+        if msgType == MsgTypes.GATE or msgType == MsgTypes.PACKED_GATE:
+            if msgType == MsgTypes.PACKED_GATE:
+                senderTime, buf = incomingTuple
+                agentList = agentpack.unpackAgents(buf)
+            else:
+                senderTime, agentList = incomingTuple
             logger.debug('%s got %s arriving agents' % (self._name, len(agentList)))
+            self.patch.group.nGateRecvd += len(agentList)
             if self._debug:
                 d = {}
                 for k in [a.__class__.__name__ for a in agentList]:
@@ -287,23 +381,68 @@ class GateExit(Interactant):
                     self._ownerLoop.sequencer.enqueue(a, senderTime)
                 if a.debug:
                     self.logger.debug('%s materializes at %s' % (a.name, self._name))
+        elif msgType == MsgTypes.POST:
+            senderTime, msgList = incomingTuple  # @UnusedVariable
+            self.patch.group.nGateRecvd += len(msgList)
+            timeNow = self._ownerLoop.sequencer.getTimeNow()
+            for destAddr, postType, payload, msgTime in msgList:
+                if timeNow > msgTime:
+                    self.logger.critical('%s: MESSAGE FROM THE PAST: %s for %s' %
+                                         (self._name, postType, destAddr))
+                    self.patch.group.nI.comm.Abort()
+                elif timeNow < msgTime:
+                    self._ownerLoop.sequencer.enqueue(DelayedPost(self.patch, postType, payload,
+                                                                  destAddr),
+                                                      msgTime)
+                else:
+                    self.patch.postMsg(postType, payload, destAddr, msgTime)
         else:
             raise RuntimeError('Unknown message type %s arrived at Gate %s' %
                                (msgType, self._name))
 
 
+class DelayedPost(FSMAgent):
+    """
+    A message posted by a patch which is ahead of this one in time must not be delivered
+    until this patch catches up.  A DelayedPost waits in the sequencer until that day and
+    then posts the message.
+    """
+    def __init__(self, patch, msgType, payload, destAddr):
+        FSMAgent.__init__(self, 'DelayedPost', patch)
+        self.msgType = msgType
+        self.payload = payload
+        self.destAddr = destAddr
+
+    def step(self, timeNow):
+        self.patch.postMsg(self.msgType, self.payload, self.destAddr, timeNow)
+        return (self.FINISH, None)
+
+    def __getstate__(self):
+        d = FSMAgent.__getstate__(self)
+        d['msgType'] = self.msgType
+        d['payload'] = self.payload
+        d['destAddr'] = self.destAddr
+        return d
+
+    def __setstate__(self, stateDict):
+        FSMAgent.__setstate__(self, stateDict)
+        self.msgType = stateDict['msgType']
+        self.payload = stateDict['payload']
+        self.destAddr = stateDict['destAddr']
+
+
 class DateChangeQueue(Interactant):
     pass
 
 
-class DateChangeMsg(Agent):
+class DateChangeMsg(FSMAgent):
     STATE_OUTGOING = 0
     STATE_HOMEWARD = 1
     STATE_TERMINATE = 2
 
     def __init__(self, name, patch, homeQueueAddr, destQueueAddr, creationVTime,
                  creationDate, debug=True):
-        Agent.__init__(self, name, patch, debug=debug)
+        FSMAgent.__init__(self, name, patch, debug=debug)
         self.homeQueueAddr = homeQueueAddr
         self.destQueueAddr = destQueueAddr
         self.creationVTime = creationVTime
@@ -311,24 +450,24 @@ class DateChangeMsg(Agent):
         self.fsmstate = DateChangeMsg.STATE_OUTGOING
         self.timeless = True
 
-    def run(self, startTime):
-        timeNow = startTime  # @UnusedVariable
-        while True:
-            if self.fsmstate == DateChangeMsg.STATE_OUTGOING:
-                addr, final = self.patch.getPathTo(self.destQueueAddr)
-                if final:
-                    self.fsmstate = DateChangeMsg.STATE_HOMEWARD
-                timeNow = addr.lock(self)  # @UnusedVariable
-            elif self.fsmstate == DateChangeMsg.STATE_HOMEWARD:
-                addr, final = self.patch.getPathTo(self.homeQueueAddr)
-                if final:
-                    self.fsmstate = DateChangeMsg.STATE_TERMINATE
-                timeNow = addr.lock(self)  # @UnusedVariable
-            elif self.fsmstate == DateChangeMsg.STATE_TERMINATE:
-                break
+    def step(self, timeNow):
+        if self.fsmstate == DateChangeMsg.STATE_OUTGOING:
+            addr, final = self.patch.getPathTo(self.destQueueAddr)
+            if final:
+                self.fsmstate = DateChangeMsg.STATE_HOMEWARD
+            return (self.LOCK, addr)
+        elif self.fsmstate == DateChangeMsg.STATE_HOMEWARD:
+            addr, final = self.patch.getPathTo(self.homeQueueAddr)
+            if final:
+                self.fsmstate = DateChangeMsg.STATE_TERMINATE
+            return (self.LOCK, addr)
+        elif self.fsmstate == DateChangeMsg.STATE_TERMINATE:
+            return (self.FINISH, None)
+        else:
+            raise RuntimeError('unknown state %s' % self.fsmstate)
 
     def __getstate__(self):
-        d = Agent.__getstate__(self)
+        d = FSMAgent.__getstate__(self)
         d['homeQueueAddr'] = self.homeQueueAddr
         d['destQueueAddr'] = self.destQueueAddr
         d['creationVTime'] = self.creationVTime.vec
@@ -338,7 +477,7 @@ class DateChangeMsg(Agent):
         return d
 
     def __setstate__(self, stateDict):
-        Agent.__setstate__(self, stateDict)
+        FSMAgent.__setstate__(self, stateDict)
         self.homeQueueAddr = stateDict['homeQueueAddr']
         self.destQueueAddr = stateDict['destQueueAddr']
         vec = stateDict['creationVTime']
@@ -348,6 +487,14 @@ class DateChangeMsg(Agent):
         self.fsmstate = stateDict['fsmstate']
 
 
+agentpack.registerSchema(DelayedPost, agentpack.AGENT_FIELDS
+                         + [('msgType', 'obj'), ('payload', 'obj'), ('destAddr', 'addr')])
+agentpack.registerSchema(DateChangeMsg, agentpack.AGENT_FIELDS
+                         + [('homeQueueAddr', 'addr'), ('destQueueAddr', 'addr'),
+                            ('creationVTime', 'obj'), ('creationVTimeRank', 'int'),
+                            ('creationDate', 'int'), ('fsmstate', 'int')])
+
+
 class DateChangeAgent(Agent):
     def __init__(self, name, patch):
         Agent.__init__(self, name, patch)
@@ -360,6 +507,8 @@ class DateChangeAgent(Agent):
         self.logger = logging.getLogger(__name__ + '.DateChangeAgent')
 
     def run(self, startTime):
+        if self.patch.group.collectiveDateChange:
+            return '%s: the PatchGroup handles date changes' % self.name
         timeNow = startTime
         logDebug = self.logger.isEnabledFor(logging.DEBUG)
         while True:
@@ -386,8 +535,10 @@ class DateChangeAgent(Agent):
                         self.logger.debug('%s spawned and launched %d' % (self.name, nInGroup))
                 else:
                     bumpTime = True  # we are alone, so just change date
-            else:
+            elif self.mostRecentBusyVTime is None:
                 self.mostRecentBusyVTime = self.patch.group.nI.vclock.copy()
+            else:
+                self.mostRecentBusyVTime.setFrom(self.patch.group.nI.vclock)
             while self.inputQueue._lockQueue:
                 msg = self.inputQueue._lockQueue[0]
                 if logDebug:
@@ -464,6 +615,12 @@ class DateChangeAgent(Agent):
 
 class Patch(object):
     counter = 0
+    migratable = False  # see packForMigration
+    # attributes which are rebuilt rather than shipped when a patch migrates
+    _migrationExcludes = frozenset(['patchId', 'group', 'gblAddr', 'name', 'logger', 'loop',
+                                    'gateAgent', 'dateChangeAgent', 'outgoingGateDict',
+                                    'incomingGateDict', 'nextHopDict', 'interactantDict',
+                                    'stepTime', 'runPending', 'idlePasses', 'routeDict'])
 
     def _createPerTickCB(self):
         def tickFun(thisAgent, timeLastTick, timeNow):
@@ -473,25 +630,44 @@ class Patch(object):
             self.group.switch(timeNow)
         return tickFun
 
-    def __init__(self, group, name=None, patchId=None, checkpointer=None):
-        if patchId is None:
+    def __init__(self, group, name=None, patchId=None, checkpointer=None, sequencerClass=None,
+                 gblAddr=None):
+        """
+        gblAddr is given only when a migrated patch is rebuilt on its new rank, since a patch
+        keeps the address it was given on its home rank.  If checkpointer is None, the
+        group's checkpointer is used.
+        """
+        if gblAddr is not None:
+            self.patchId = gblAddr.lclId
+        elif patchId is None:
             self.patchId = Patch.counter
             Patch.counter += 1
         else:
             self.patchId = patchId
         self.group = group
-        self.gblAddr = group.getGblAddr(self.patchId)
+        if gblAddr is None:
+            self.gblAddr = group.getGblAddr(self.patchId)
+        else:
+            self.gblAddr = gblAddr
         if name is None:
             self.name = "Patch_%s" % str(self.gblAddr)
         else:
             self.name = name
         self.logger = logging.getLogger(__name__ + '.Patch')
-        self.loop = agent.MainLoop(self.name + '.loop', checkpointer=checkpointer)
+        if checkpointer is None:
+            checkpointer = group.checkpointer
+        self.loop = agent.MainLoop(self.name + '.loop', checkpointer=checkpointer,
+                                   sequencerClass=sequencerClass)
         self.gateAgent = GateAgent(self)
         self.dateChangeAgent = DateChangeAgent(self.name + '_DateChangeAgent', self)
         self.outgoingGateDict = {}
         self.incomingGateDict = {}
+        self.nextHopDict = {}  # first hop toward patches with no gate of their own
         self.interactantDict = {}  # Does not include gates
+        self.routeDict = {}  # getPathTo results by address; see getPathTo
+        self.stepTime = 0.0  # seconds spent running this patch since the last load balance
+        self.runPending = True  # something may have happened since this patch last ran
+        self.idlePasses = 0  # consecutive passes in which this patch was skipped
         self.loop.addPerTickCallback(self._createPerTickCB())
         self.addAgents([self.gateAgent, self.dateChangeAgent])
         self.addInteractants([self.dateChangeAgent.inputQueue])
@@ -502,17 +678,14 @@ class Patch(object):
         will return True; otherwise False.  Note that this condition can be reversed if
         a new agent is inserted into today's loop.
         """
-        for myDict in [self.outgoingGateDict, self.incomingGateDict, self.interactantDict]:
-            for iact in myDict.values():
-                if (iact._lockingAgent is not None and iact._lockingAgent.timeless
-                        and iact.getNWaiting()):
+        registry = self.loop.interactants
+        if registry.nBlocking():
+            if self.logger.isEnabledFor(logging.DEBUG):
+                for iact in registry.getBlocking():
                     self.logger.debug('doneWithToday is false because %s has %d waiting: %s' %
                                       (iact, iact.getNWaiting(), iact.getWaitingDetails()))
-                    return False
-        # Gates are not in interactantDict so we have not checked them, but they are timeless
-        # by definition.
-        return all([a.timeless for a in
-                    self.loop.sequencer._timeQueues[self.loop.sequencer._timeNow]])
+            return False
+        return self.loop.sequencer.onlyTimelessToday()
 
     def addGateFrom(self, otherPatchTag):
         gateExit = GateExit(("%s.GateExit_%s" % (self.name, otherPatchTag)),
@@ -526,8 +699,18 @@ class Patch(object):
                                     self, otherPatchTag, debug=False)
         self.gateAgent.addGate(gateEntrance)
         self.outgoingGateDict[otherPatchTag] = gateEntrance
+        if len(self.routeDict) > len(self.interactantDict):
+            self._resetRoutes()  # some remote addresses may now have a shorter path
         return gateEntrance
 
+    def setNextHops(self, nextHopDict):
+        """
+        nextHopDict maps the address of each patch with no gate from this one to the address
+        of the neighboring patch through which agents bound for it should travel.
+        """
+        self.nextHopDict = nextHopDict
+        self._resetRoutes()
+
     def addAgents(self, agentList):
         self.loop.addAgents(agentList)
 
@@ -540,7 +723,115 @@ class Patch(object):
                 if iact.srcTag not in self.incomingGateDict:
                     self.incomingGateDict[iact.srcTag] = iact
             else:
-                self.interactantDict[iact.getGblAddr()] = iact
+                gblAddr = iact.getGblAddr()
+                self.interactantDict[gblAddr] = iact
+                self.routeDict[gblAddr] = (iact, True)
+
+    def canMigrate(self):
+        """
+        Returns True if the patch may be moved to another rank now.  The patch class must
+        be marked migratable, and nothing may be waiting in its outgoing gates.
+        """
+        return (self.migratable
+                and all([not g.getNWaiting() for g in self.outgoingGateDict.values()]))
+
+    def packForMigration(self):
+        """
+        Returns a picklable package from which PatchGroup.unpackMigrant() can rebuild this
+        patch on another rank.  The package holds the patch class and address, the agents
+        in the patch's sequencer with their wake times, the interactants, and any attributes
+        added by derived classes.  Gates, the patch's MainLoop and its GateAgent and
+        DateChangeAgent are rebuilt rather than shipped.
+
+        Agents are shipped as they would be through a gate, so every agent in the patch must
+        be mobile in the sense described for patches.Agent; a greenlet agent resumes at the
+        start of its run method.  References to the patch, its loop or its group are
+        restored on arrival, but nothing may refer to other patches.  Loop callbacks are
+        not shipped, so derived classes must re-install theirs in onArrival().
+        """
+        frameworkAgents = [self.gateAgent, self.dateChangeAgent]
+        agentList = [(a, t) for a, t in self.loop.sequencer.getScheduled()
+                     if a not in frameworkAgents
+                     and not isinstance(a, agent.MainLoop.ClockAgent)]
+        iactList = [iact for iact in self.interactantDict.values()
+                    if iact is not self.dateChangeAgent.inputQueue]
+        patchDict = dict([(k, v) for k, v in self.__dict__.items()
+                          if k not in Patch._migrationExcludes])
+        stream = io.BytesIO()
+        pickler = _MigrationPickler(stream, self)
+        pickler.dump((agentList, iactList, patchDict))
+        pickler.dump(pickler.agentsSeen)
+        return (self._packHeader(), stream.getvalue())
+
+    def _packHeader(self):
+        """The part of a packed patch which PatchGroup._newPatchFromHeader() uses"""
+        return {'cls': type(self), 'name': self.name, 'gblAddr': self.gblAddr,
+                'timeNow': self.loop.sequencer.getTimeNow(),
+                'sequencerClass': type(self.loop.sequencer),
+                'gatesTo': list(self.outgoingGateDict.keys()),
+                'gatesFrom': list(self.incomingGateDict.keys()),
+                'nextHopDict': self.nextHopDict,
+                'dateChangeQueueId': self.dateChangeAgent.inputQueue.id}
+
+    def packForCheckpoint(self, isClean):
+        """
+        Like packForMigration(), but every agent and interactant of the patch is pickled as
+        a separate record, so that a checkpoint need only save again those which may have
+        changed.  So is every other object which they share (see _CheckpointPickler); such
+        an object is saved again whenever a record which refers to it is.  isClean(thing)
+        is called for each record found; it returns None if thing must be pickled, or else
+        the list of the other records to which its earlier record refers.
+
+        Returns (header, buf, stateLength, index).  buf holds the patch's own state in its
+        first stateLength bytes, followed by the records pickled.  index has an entry
+        (thing, offset, length, refs) for every record of the patch, with offset and length
+        None for those which were not pickled.  PatchGroup.unpackCheckpoint() is the
+        inverse.
+        """
+        frameworkAgents = [self.gateAgent, self.dateChangeAgent]
+        agentList = [(a, t) for a, t in self.loop.sequencer.getScheduled()
+                     if a not in frameworkAgents
+                     and not isinstance(a, agent.MainLoop.ClockAgent)]
+        iactList = [iact for iact in self.interactantDict.values()
+                    if iact is not self.dateChangeAgent.inputQueue]
+        patchDict = dict([(k, v) for k, v in self.__dict__.items()
+                          if k not in Patch._migrationExcludes])
+        stream = io.BytesIO()
+        pickler = _CheckpointPickler(stream, self)
+        pickler.dump(([(id(a), t) for a, t in agentList], [id(iact) for iact in iactList],
+                      patchDict))
+        stateLength = stream.tell()
+        forced = set([id(r) for r in pickler.refs])  # the patch's own state is always saved
+        todo = [a for a, t in agentList] + iactList + pickler.refs
+        indexDict = {}
+        while todo:
+            thing = todo.pop()
+            entry = indexDict.get(id(thing))
+            if entry is not None and (entry[1] is not None or id(thing) not in forced):
+                continue
+            refs = None if id(thing) in forced else isClean(thing)
+            if refs is None:
+                pickler.clear_memo()
+                pickler.refs = []
+                offset = stream.tell()
+                pickler.dump(_getObjState(thing))
+                refs = pickler.refs
+                indexDict[id(thing)] = (thing, offset, stream.tell() - offset, refs)
+                # Anything other than an agent or interactant may have changed along with
+                # the record which refers to it
+                forced.update([id(r) for r in refs
+                               if not isinstance(r, _CheckpointPickler.trackedTypes)])
+            else:
+                indexDict[id(thing)] = (thing, None, None, refs)
+            todo.extend(refs)
+        return (self._packHeader(), stream.getvalue(), stateLength, list(indexDict.values()))
+
+    def onArrival(self):
+        """
+        Called after a migrated patch has been rebuilt on its new rank.  Derived classes
+        re-install any loop callbacks here.
+        """
+        pass
 
     def getAllLocalInteractants(self):
         """
@@ -553,22 +844,64 @@ class Patch(object):
         return '<%s>' % self.name
 
     def launch(self, agent, startTime):
-        agent.parent = self.loop
+        if not agent.isFSM:
+            agent.parent = self.loop
         self.loop.sequencer.enqueue(agent, startTime)
 
+    def postMsg(self, msgType, payload, destAddr, timeNow):
+        """
+        Deliver a message without launching an agent to carry it.  If destAddr is local,
+        (msgType, payload, timeNow) goes straight into the inbox of the destination
+        interactant, which must implement postMsg(msgType, payload, timeNow).  Otherwise
+        the message is passed to the appropriate gate, which batches messages for transfer
+        at the next network cycle.
+        """
+        iact, final = self.getPathTo(destAddr)
+        if final:
+            iact.postMsg(msgType, payload, timeNow)
+        else:
+            iact.forwardMsg(msgType, payload, destAddr, timeNow)
+
     def serviceLookup(self, typeNameStr, patchAddr=None):
-        if patchAddr is None:
-            return self.group.worldInteractants[typeNameStr][:]
+        """
+        Returns a tuple of (info, gblAddr) pairs for every interactant of the named class,
+        or only those in the patch at patchAddr.  The tuple is shared, so a caller which
+        wants to reorder it must make a copy; see ServiceDirectory.
+        """
+        return self.group.serviceDirectory.lookup(typeNameStr, patchAddr)
+
+    def serviceChoice(self, typeNameStr, excludeAddr=None):
+        """
+        Returns the address of a randomly chosen interactant of the named class other than
+        the one at excludeAddr, or None if there is no such interactant.
+        """
+        tpl = self.group.serviceDirectory.choice(typeNameStr, excludeAddr=excludeAddr)
+        if tpl is None:
+            return None
         else:
-            return [(nm, addr)
-                    for nm, addr in self.group.worldInteractants[typeNameStr]
-                    if addr.getPatchAddr() == patchAddr]
+            return tpl[1]
 
     def isLocal(self, gblAddr):
         """Is the address local to this patch?"""
         return (netinterface.GblAddr.tupleGetPatchAddr(gblAddr) == self.gblAddr)
 
     def getPathTo(self, gblAddr):
+        """
+        Returns (interactant, True) if gblAddr is the address of an interactant in this
+        patch, or otherwise (gate, False) where gate is the GateEntrance on the path toward
+        gblAddr.  Every mobile agent asks this on every hop, so the answers are kept in
+        routeDict.  The entries for local interactants are made as they are added, and those
+        for remote addresses on first use; the remote ones are dropped whenever gates or
+        next hops change.  Routes do not depend on where patches live, so migration of
+        other patches leaves them valid.
+        """
+        route = self.routeDict.get(gblAddr)
+        if route is None:
+            route = self._findPathTo(gblAddr)
+            self.routeDict[gblAddr] = route
+        return route
+
+    def _findPathTo(self, gblAddr):
         if gblAddr in self.interactantDict:
             return (self.interactantDict[gblAddr], True)
         else:
@@ -577,10 +910,403 @@ class Patch(object):
             patchAddr = netinterface.GblAddr.tupleGetPatchAddr(gblAddr)
             if patchAddr in self.outgoingGateDict:
                 return (self.outgoingGateDict[patchAddr], False)
+            elif patchAddr in self.nextHopDict:
+                return (self.outgoingGateDict[self.nextHopDict[patchAddr]], False)
             else:
                 raise RuntimeError("%s: No path to correct patch for address %s" % (self.name,
                                                                                     gblAddr))
 
+    def _resetRoutes(self):
+        self.routeDict = dict([(addr, (iact, True))
+                               for addr, iact in self.interactantDict.items()])
+
+
+class _MigrationPickler(pickle.Pickler):
+    """
+    Pickles the contents of a migrating patch.  References to the things which are rebuilt
+    on the new rank are replaced by tokens, and every agent pickled is recorded so that it
+    can be re-homed on arrival.
+    """
+    def __init__(self, stream, patch):
+        pickle.Pickler.__init__(self, stream, pickle.HIGHEST_PROTOCOL)
+        self.tokenDict = {id(patch): 'patch', id(patch.loop): 'loop',
+                          id(patch.loop.sequencer): 'sequencer',
+                          id(patch.loop.interactants): 'registry',
+                          id(patch.group): 'group', id(patch.group.nI): 'nI',
+                          id(patch.gateAgent): 'gateAgent',
+                          id(patch.dateChangeAgent): 'dateChangeAgent',
+                          id(patch.dateChangeAgent.inputQueue): 'dateChangeQueue'}
+        for tag, gate in patch.outgoingGateDict.items():
+            self.tokenDict[id(gate)] = ('gateTo', tag)
+        for tag, gate in patch.incomingGateDict.items():
+            self.tokenDict[id(gate)] = ('gateFrom', tag)
+        self.agentsSeen = []
+        self._agentIds = set()
+
+    def persistent_id(self, obj):
+        token = self.tokenDict.get(id(obj))
+        if token is None:
+            if isinstance(obj, agent.MainLoop.ClockAgent):
+                token = 'clockAgent'
+            elif (isinstance(obj, (agent.Agent, agent.FSMAgent))
+                  and id(obj) not in self._agentIds):
+                self._agentIds.add(id(obj))
+                self.agentsSeen.append(obj)
+        return token
+
+
+class _MigrationUnpickler(pickle.Unpickler):
+    """The inverse of _MigrationPickler, given the freshly built patch"""
+    def __init__(self, stream, patch):
+        pickle.Unpickler.__init__(self, stream)
+        self.patch = patch
+        self.tokenDict = {'patch': patch, 'loop': patch.loop,
+                          'sequencer': patch.loop.sequencer,
+                          'registry': patch.loop.interactants,
+                          'group': patch.group, 'nI': patch.group.nI,
+                          'gateAgent': patch.gateAgent,
+                          'dateChangeAgent': patch.dateChangeAgent,
+                          'dateChangeQueue': patch.dateChangeAgent.inputQueue,
+                          'clockAgent': patch.loop.newAgents[0]}
+
+    def persistent_load(self, token):
+        if isinstance(token, tuple):
+            kind, tag = token
+            if kind == 'gateTo':
+                return self.patch.outgoingGateDict[tag]
+            else:
+                return self.patch.incomingGateDict[tag]
+        else:
+            return self.tokenDict[token]
+
+
+def _getObjState(obj):
+    """The state which pickle would save for obj"""
+    getState = getattr(obj, '__getstate__', None)
+    if getState is None:
+        return obj.__dict__
+    return getState()
+
+
+def _setObjState(obj, state):
+    """Restore state as pickle would"""
+    setState = getattr(obj, '__setstate__', None)
+    if setState is not None:
+        setState(state)
+    elif state is not None:
+        obj.__dict__.update(state)
+
+
+class _CheckpointPickler(_MigrationPickler):
+    """
+    Pickles the state of a single record of a patch being checkpointed.  The records are
+    the agents and interactants of the patch, and any other instances of classes which
+    pickle as plain objects, since these may be shared.  References to other records are
+    replaced by ('record', id) tokens, and the things referred to are collected in
+    self.refs.
+    """
+    trackedTypes = (agent.Agent, agent.FSMAgent, agent.Interactant)
+    _kindDict = {}  # class -> 'clockAgent', 'record' or None; see _classKind()
+
+    def __init__(self, stream, patch):
+        _MigrationPickler.__init__(self, stream, patch)
+        self.refs = []
+
+    @classmethod
+    def _classKind(cls, objCls):
+        if issubclass(objCls, agent.MainLoop.ClockAgent):
+            kind = 'clockAgent'
+        elif issubclass(objCls, cls.trackedTypes):
+            kind = 'record'
+        elif (objCls.__module__ not in ('builtins', '__builtin__')
+              and not issubclass(objCls, type)
+              and objCls.__reduce_ex__ is object.__reduce_ex__
+              and objCls.__reduce__ is object.__reduce__
+              and not hasattr(objCls, '__getnewargs__')
+              and not hasattr(objCls, '__getnewargs_ex__')):
+            kind = 'record'  # plain objects without a __dict__ are weeded out by the caller
+        else:
+            kind = None
+        cls._kindDict[objCls] = kind
+        return kind
+
+    def persistent_id(self, obj):
+        # This is called for everything pickled, so it is written for speed
+        token = self.tokenDict.get(id(obj))
+        if token is not None:
+            return token
+        objCls = type(obj)
+        try:
+            kind = self._kindDict[objCls]
+        except KeyError:
+            kind = self._classKind(objCls)
+        if kind is None:
+            return None
+        elif kind == 'record':
+            if hasattr(obj, '__dict__'):
+                self.refs.append(obj)
+                return ('record', id(obj))
+            return None
+        return kind
+
+
+class _CheckpointUnpickler(_MigrationUnpickler):
+    """The inverse of _CheckpointPickler, given the patch and the things being restored"""
+    def __init__(self, stream, patch, thingDict):
+        _MigrationUnpickler.__init__(self, stream, patch)
+        self.thingDict = thingDict
+
+    def persistent_load(self, token):
+        if isinstance(token, tuple) and token[0] == 'record':
+            return self.thingDict[token[1]]
+        return _MigrationUnpickler.persistent_load(self, token)
+
+
+class DirectoryBlock(object):
+    """
+    The directory entries for one class of interactant from one rank, in the compact form
+    in which ranks exchange them.  The interactant addresses are held as an array of their
+    lclCodes (see netinterface.GblAddr), all of them sharing the rank of the block.  In the
+    common case where every getInfo() is a string, typically the interactant's name, the
+    strings are concatenated into one with an array of offsets; otherwise the infos are
+    kept in a list.  Entries are decoded one at a time, as needed.
+    """
+    def __init__(self, rank, entries):
+        """entries is a list of (info, gblAddr) pairs, all with the given rank"""
+        self.rank = rank
+        self.codes = np.array([addr.lclCode for info, addr in entries], dtype=np.uint64)
+        infos = [info for info, addr in entries]
+        if all([isinstance(info, str) for info in infos]):
+            self.names = ''.join(infos)
+            self.offsets = np.zeros(len(infos) + 1, dtype=np.int64)
+            np.cumsum([len(info) for info in infos], out=self.offsets[1:])
+            self.infos = None
+        else:
+            self.names = self.offsets = None
+            self.infos = infos
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def getInfo(self, idx):
+        if self.infos is None:
+            return self.names[int(self.offsets[idx]):int(self.offsets[idx + 1])]
+        else:
+            return self.infos[idx]
+
+    def getAddr(self, idx):
+        return netinterface.GblAddr.decode((self.rank << 64) | int(self.codes[idx]))
+
+    def getEntry(self, idx):
+        return (self.getInfo(idx), self.getAddr(idx))
+
+    def getPatchIds(self):
+        return self.codes >> np.uint64(32)
+
+
+class ServiceDirectory(object):
+    """
+    The world-wide directory of interactants which PatchGroup.start builds from the
+    DirectoryBlocks shared by all ranks.  Entries are (info, gblAddr) pairs, where info is
+    the interactant's getInfo().  They can be looked up by class name, by class name and
+    patch, and by class name and the rank currently holding the patch.  Every lookup
+    returns a tuple which is shared between callers, so lookups are cheap but the results
+    must not be modified.
+
+    The entries of a class are decoded from the blocks the first time they are looked up,
+    since a directory may have millions of entries of which a rank uses few.  choice() and
+    sample() pick entries straight from the blocks, so a class which is only ever sampled
+    is never decoded as a whole.
+    """
+    _empty = ()
+
+    def __init__(self, blockDict, rankOf):
+        """
+        blockDict is a dict of lists of DirectoryBlocks by class name.  rankOf(gblAddr)
+        returns the rank currently holding the patch of gblAddr.
+        """
+        self.rankOf = rankOf
+        self._blocks = blockDict
+        self._starts = {}  # the index of the first entry of each block, by class name
+        self._counts = {}
+        for classNm, blockList in blockDict.items():
+            starts = []
+            n = 0
+            for block in blockList:
+                starts.append(n)
+                n += len(block)
+            self._starts[classNm] = starts
+            self._counts[classNm] = n
+        self._byClass = {}  # built on first use
+        self._byPatch = {}  # built on first use, for a whole class at a time
+        self._byRank = {}  # built on first use, for a whole class at a time; see patchesMoved
+        self._patchIndexed = set()  # classes in _byPatch
+        self._rankIndexed = set()  # classes in _byRank
+
+    def classNames(self):
+        return list(self._blocks.keys())
+
+    def count(self, classNm):
+        return self._counts.get(classNm, 0)
+
+    def lookup(self, classNm, patchAddr=None):
+        if patchAddr is None:
+            if classNm not in self._byClass:
+                entries = []
+                for block in self._blocks.get(classNm, []):
+                    entries.extend([block.getEntry(i) for i in range(len(block))])
+                self._byClass[classNm] = tuple(entries)
+            return self._byClass[classNm]
+        else:
+            if classNm not in self._patchIndexed:
+                self._patchIndexed.add(classNm)
+                for block in self._blocks.get(classNm, []):
+                    patchIds = block.getPatchIds()
+                    for patchId in np.unique(patchIds):
+                        idxs = np.nonzero(patchIds == patchId)[0]
+                        patchAddr2 = netinterface.GblAddr(block.rank, int(patchId))
+                        self._byPatch[(classNm, patchAddr2)] = tuple([block.getEntry(i)
+                                                                      for i in idxs])
+            return self._byPatch.get((classNm, patchAddr), self._empty)
+
+    def lookupByRank(self, classNm, rank):
+        """Returns the entries for the named class in patches currently on the given rank"""
+        if classNm not in self._rankIndexed:
+            self._rankIndexed.add(classNm)
+            byRank = defaultdict(list)
+            for tpl in self.lookup(classNm):
+                byRank[self.rankOf(tpl[1])].append(tpl)
+            for rank2, l in byRank.items():
+                self._byRank[(classNm, rank2)] = tuple(l)
+        return self._byRank.get((classNm, rank), self._empty)
+
+    def patchesMoved(self):
+        """Called when patches migrate, since that changes the rank index"""
+        self._byRank = {}
+        self._rankIndexed = set()
+
+    def _getEntry(self, classNm, idx, entries=None):
+        if entries is not None:
+            return entries[idx]
+        elif classNm in self._byClass:
+            return self._byClass[classNm][idx]
+        starts = self._starts[classNm]
+        blockIdx = bisect.bisect_right(starts, idx) - 1
+        return self._blocks[classNm][blockIdx].getEntry(idx - starts[blockIdx])
+
+    def choice(self, classNm, patchAddr=None, excludeAddr=None, rng=random):
+        """
+        Returns an entry chosen uniformly from lookup(classNm, patchAddr), skipping any entry
+        with the address excludeAddr, or None if there is nothing to choose.  No list is
+        built.
+        """
+        if patchAddr is None:
+            entries = None
+            n = self.count(classNm)
+        else:
+            entries = self.lookup(classNm, patchAddr)
+            n = len(entries)
+        if n == 0:
+            return None
+        idx = rng.randrange(n)
+        entry = self._getEntry(classNm, idx, entries)
+        if excludeAddr is not None and entry[1] == excludeAddr:
+            # Addresses are unique, so only this entry need be skipped
+            if n == 1:
+                return None
+            otherIdx = rng.randrange(n - 1)
+            if otherIdx >= idx:
+                otherIdx += 1
+            entry = self._getEntry(classNm, otherIdx, entries)
+        return entry
+
+    def sample(self, classNm, k, patchAddr=None, rng=random):
+        """
+        Returns a list of k distinct entries chosen at random, or all of them in random order
+        if there are fewer than k.
+        """
+        if patchAddr is None:
+            n = self.count(classNm)
+            return [self._getEntry(classNm, i) for i in rng.sample(range(n), min(k, n))]
+        else:
+            entries = self.lookup(classNm, patchAddr)
+            return rng.sample(entries, min(k, len(entries)))
+
+
+def _planMigrations(rankLoads, tolerance, maxMoves):
+    """
+    rankLoads[rank] is a list of (patchAddr, load, migratable) tuples describing the
+    patches on that rank.  Returns a list of (patchAddr, fromRank, toRank) tuples.  Patches
+    are moved one at a time from the most heavily loaded rank to the most lightly loaded
+    one, choosing the patch which most nearly halves the difference between them, until the
+    heaviest rank is within the tolerance factor of the mean load.  A rank always keeps at
+    least one patch, and a patch moves at most once.  The answer depends only on rankLoads,
+    so every rank computes the same plan.
+    """
+    nRanks = len(rankLoads)
+    totals = [sum([load for addr, load, mig in l]) for l in rankLoads]  # @UnusedVariable
+    patchLists = [list(l) for l in rankLoads]
+    mean = sum(totals) / nRanks
+    moves = []
+    while len(moves) < maxMoves and mean > 0.0:
+        srcRank = max(range(nRanks), key=lambda r: (totals[r], -r))
+        destRank = min(range(nRanks), key=lambda r: (totals[r], r))
+        if (srcRank == destRank or totals[srcRank] <= tolerance * mean
+                or len(patchLists[srcRank]) < 2):
+            break
+        gap = totals[srcRank] - totals[destRank]
+        candidates = [(abs(0.5 * gap - load), addr, load)
+                      for addr, load, mig in patchLists[srcRank] if mig and load < gap]
+        if not candidates:
+            break
+        candidates.sort()
+        dist, addr, load = candidates[0]  # @UnusedVariable
+        moves.append((addr, srcRank, destRank))
+        totals[srcRank] -= load
+        totals[destRank] += load
+        patchLists[srcRank] = [tpl for tpl in patchLists[srcRank] if tpl[0] != addr]
+        patchLists[destRank].append((addr, load, False))
+    return moves
+
+
+def _firstHops(adjacency, srcAddr):
+    """
+    Given a dict mapping each patch address to the set of its neighbors, return a dict
+    giving the first hop along a shortest path from srcAddr to every other reachable patch.
+    """
+    firstHop = {}
+    frontier = deque()
+    for nbrAddr in adjacency[srcAddr]:
+        firstHop[nbrAddr] = nbrAddr
+        frontier.append(nbrAddr)
+    while frontier:
+        addr = frontier.popleft()
+        for nbrAddr in adjacency[addr]:
+            if nbrAddr != srcAddr and nbrAddr not in firstHop:
+                firstHop[nbrAddr] = firstHop[addr]
+                frontier.append(nbrAddr)
+    return firstHop
+
+
+def _componentAndDiameter(adjacency, start):
+    """
+    Given a dict mapping nodes to sets of neighbors, return the list of nodes connected to
+    start (including start itself) and the diameter of that connected component.
+    """
+    def distances(src):
+        dist = {src: 0}
+        frontier = deque([src])
+        while frontier:
+            node = frontier.popleft()
+            for nbr in adjacency[node]:
+                if nbr not in dist:
+                    dist[nbr] = dist[node] + 1
+                    frontier.append(nbr)
+        return dist
+    component = list(distances(start))
+    diameter = max([max(distances(node).values()) for node in component])
+    return component, diameter
+
 
 def greenletTrace(event, args):
     if event == 'switch':
@@ -612,6 +1338,9 @@ def output_func(o):
 
 
 class PatchGroup(greenlet):
+    balanceTolerance = 1.2  # ranks loaded more heavily than this times the mean shed patches
+    maxMigrationsPerBalance = 4
+    maxOverlapTicks = 8  # most ticks per patch while waiting on messages; see overlapComm()
 
     def createPerEventCallback(self):
         def evtFun(mainLoop, scalarTimeNow):
@@ -620,12 +1349,69 @@ class PatchGroup(greenlet):
         return evtFun
 
     def __init__(self, comm, name=None, trace=False, deterministic=False,
-                 printCensus=False):
+                 printCensus=False, netInterfaceClass=None, collectiveDateChange=False,
+                 balanceInterval=None, pipelined=False, checkpointer=None, deltaClocks=False,
+                 maxTicksPerPass=1, maxSliceSeconds=None, maxIdlePasses=0):
+        """
+        netInterfaceClass selects the transport; it defaults to netinterface.NetworkInterface.
+        netinterface.BufferedNetworkInterface sends one contiguous buffer per destination
+        rank per cycle, and netinterface.SharedMemoryNetworkInterface does the same but
+        passes buffers for ranks on the same host through shared memory.  If comm is one
+        of the communicators of quilt.communicator rather than an MPI communicator, the
+        transport is always netinterface.CommNetworkInterface.  If deltaClocks is True, the
+        transport sends each vector clock as the change since the last one sent to the same
+        rank; all ranks must make the same choice.
+
+        If collectiveDateChange is True, date changes are decided by a global reduction
+        once per network cycle rather than by circulating DateChangeMsg agents between the
+        patches.  All ranks must make the same choice.
+
+        If balanceInterval is not None, every balanceInterval days the time spent running
+        each patch is compared across ranks, and migratable patches are moved from heavily
+        loaded ranks to lightly loaded ones; see balanceLoad().  This requires
+        collectiveDateChange, since patches can only move when all of them change date
+        together.
+
+        If pipelined is True, messages are delivered to the patches as they arrive rather
+        than all at once at the end of each pass, and busy patches keep running while the
+        rest are in flight; see overlapComm().  This requires collectiveDateChange, because
+        the circulating date change protocol depends on when in the pass messages arrive,
+        and it cannot be combined with deterministic.
+
+        If checkpointer is not None, it is typically a checkpoint.Checkpointer, which
+        writes snapshots of the patches from which a run can be restarted.  It is given to
+        the Sequencer of every patch, its writeIfDue(patchGroup) is called after every
+        date change, and its flush() is called when the run ends.  This requires
+        collectiveDateChange, for the same reason as load balancing.
+
+        maxTicksPerPass, maxSliceSeconds and maxIdlePasses control how the patches are
+        scheduled within a pass; see run() and _runSlice().  A busy patch may run up to
+        maxTicksPerPass ticks per network cycle, but gets no extra ticks once its slice has
+        run for maxSliceSeconds, if that is not None.  With collectiveDateChange, an idle
+        patch may be skipped for up to maxIdlePasses consecutive passes.
+        """
+        if balanceInterval is not None and not collectiveDateChange:
+            raise RuntimeError('load balancing requires collectiveDateChange')
+        if checkpointer is not None and not collectiveDateChange:
+            raise RuntimeError('checkpointing requires collectiveDateChange')
+        if pipelined and (deterministic or not collectiveDateChange):
+            raise RuntimeError('pipelined mode requires collectiveDateChange and is not'
+                               ' deterministic')
         if trace:
             greenlet.settrace(greenletTrace)
 
         self.patches = []
-        self.nI = netinterface.NetworkInterface(comm, deterministic=deterministic)
+        self.patchDict = {}  # local patches by address
+        self.serviceDirectory = None  # built by start()
+        if isinstance(comm, communicator.Communicator):
+            if netInterfaceClass is None:
+                netInterfaceClass = netinterface.CommNetworkInterface
+            elif not issubclass(netInterfaceClass, netinterface.CommNetworkInterface):
+                raise RuntimeError('%s cannot use a %s' % (netInterfaceClass.__name__,
+                                                          type(comm).__name__))
+        elif netInterfaceClass is None:
+            netInterfaceClass = netinterface.NetworkInterface
+        self.nI = netInterfaceClass(comm, deterministic=deterministic, deltaClocks=deltaClocks)
         if name is None:
             self.name = 'PatchGroup_%d' % comm.rank
         else:
@@ -637,6 +1423,20 @@ class PatchGroup(greenlet):
         self.clientGateExits = {}
         self.deterministic = deterministic
         self.printCensus = printCensus
+        self.collectiveDateChange = collectiveDateChange
+        self.nGateSent = 0  # agents and posted messages sent through gates
+        self.nGateRecvd = 0  # agents and posted messages received through gates
+        self.balanceInterval = balanceInterval
+        self.daysSinceBalance = 0
+        self.cycleCount = 0  # network cycles completed
+        self.nSkipped = 0  # patch slices skipped because the patch was idle
+        self.nExtraTicks = 0  # ticks beyond the first given to busy patches
+        self.maxTicksPerPass = maxTicksPerPass  # most ticks a busy patch may run in one cycle
+        self.maxSliceSeconds = maxSliceSeconds  # if not None, no extra ticks past this long
+        self.maxIdlePasses = maxIdlePasses  # most consecutive passes an idle patch is skipped
+        self.pipelined = pipelined
+        self.nOverlapTicks = 0  # ticks run while waiting on messages in pipelined mode
+        self.checkpointer = checkpointer
         self.prevTraceCB = None
         self.stopNow = False
         self.logger = logging.getLogger(__name__ + '.PatchGroup')
@@ -670,24 +1470,78 @@ class PatchGroup(greenlet):
     def addPatch(self, patch):
         patch.loop.parent = self
         self.patches.append(patch)
+        self.patchDict[patch.gblAddr] = patch
         patch.loop.freezeDate()  # No new days until I say so
         patch.loop.addPerEventCallback(self.createPerEventCallback())
         return patch
 
+    def getLocalGateExit(self, srcAddr, destAddr):
+        """
+        Returns the GateExit through which the patch at destAddr receives from the patch at
+        srcAddr, or None if the destination patch is not on this rank.
+        """
+        patch = self.patchDict.get(destAddr)
+        if patch is None:
+            return None
+        else:
+            return patch.incomingGateDict.get(srcAddr)
+
+    def _runSlice(self, p):
+        """
+        Give patch p its slice of the pass.  Each tick ends with the patch switching back
+        here.  While the patch still has agents which are not timeless waiting to run today,
+        it gets further ticks, up to maxTicksPerPass in all and as long as the slice has
+        not run for maxSliceSeconds.
+        """
+        t0 = time.time()
+        nTicks = 0
+        while True:
+            reply = p.loop.switch()  # @UnusedVariable
+            nTicks += 1
+            if (nTicks >= self.maxTicksPerPass or self.stopNow or p.loop.dead
+                    or p.loop.sequencer.onlyTimelessToday()
+                    or (self.maxSliceSeconds is not None
+                        and time.time() - t0 >= self.maxSliceSeconds)):
+                break
+        self.nExtraTicks += nTicks - 1
+        p.stepTime += time.time() - t0
+
     def run(self):
+        """
+        Each pass gives every patch a slice and then completes a network cycle.
+
+        With collective date changes, a patch which is done with today and has had nothing
+        arrive and no date change since its last slice has nothing to do, and is skipped
+        for up to maxIdlePasses consecutive passes.  The bound is there for timeless agents
+        which poll on every tick.  The circulating date change protocol needs every patch's
+        DateChangeAgent to run each cycle, so idle patches are never skipped without
+        collectiveDateChange.
+        """
         # tr = tracker.SummaryTracker()
         logDebug = self.logger.isEnabledFor(logging.DEBUG)
+        skipIdle = self.collectiveDateChange and self.maxIdlePasses > 0
         while True:
             if logDebug:
                 self.logger.debug('%s: new pass of run' % (self.name))
             for p in self.patches[:]:
+                if (skipIdle and not p.runPending and p.idlePasses < self.maxIdlePasses
+                        and p.doneWithToday()):
+                    p.idlePasses += 1
+                    self.nSkipped += 1
+                    continue
                 if logDebug:
                     self.logger.debug('%s: running patch %s: %s agents at time %s' %
                                       (self.name, p.name, p.loop.sequencer.getNWaitingNow(),
                                        p.loop.sequencer.getTimeNow()))
-                reply = p.loop.switch()  # @UnusedVariable
+                p.runPending = False
+                p.idlePasses = 0
+                self._runSlice(p)
                 if self.printCensus:
                     p.loop.printCensus(tickNum=self.nI.vclock.vec[self.nI.comm.rank])
+                if self.pipelined:
+                    self.nI.pollRecv()
+            if self.pipelined:
+                self.overlapComm()
 
             if logDebug:
                 self.logger.debug('%s: finish last recv' % self.name)
@@ -695,10 +1549,22 @@ class PatchGroup(greenlet):
             if logDebug:
                 self.logger.debug('%s: finish last send' % self.name)
             self.nI.finishSend()
+            if self.collectiveDateChange:
+                self.collectiveDateCheck()
             if self.stopNow:
                 self.logger.debug('%s Sending done signal' % self.name)
                 if self.nI.sendDoneSignal():
                     self.logger.debug('%s: everyone is done' % self.name)
+                    if self.nI.reductionPending:
+                        self.nI.finishReduction()
+                    if self.checkpointer is not None:
+                        self.checkpointer.flush()
+                    self.nI.close()
+                    self.logger.debug('%s: receive buffer stats %s'
+                                      % (self.name, self.nI.getRecvBufferStats()))
+                    self.logger.debug('%s: %d idle slices skipped, %d extra ticks, %d overlap'
+                                      ' ticks' % (self.name, self.nSkipped, self.nExtraTicks,
+                                                  self.nOverlapTicks))
                     return '%s claims all done' % self.name
             if logDebug:
                 self.logger.debug('%s: start recv' % self.name)
@@ -706,15 +1572,213 @@ class PatchGroup(greenlet):
             if logDebug:
                 self.logger.debug('%s: start send' % self.name)
             self.nI.startSend()
+            self.cycleCount += 1
             if logDebug:
                 self.logger.debug('%s: finished networking' % self.name)
 
+    def overlapComm(self):
+        """
+        In pipelined mode this is called after every patch has had its slice.  Until all of
+        the messages due this cycle have arrived, each patch which still has agents that
+        are not timeless waiting to run today gets another tick, up to maxOverlapTicks.
+        Messages are delivered as they complete, between ticks, so a patch can act on its
+        arrivals within the same cycle.  Anything the extra ticks send through gates waits
+        for the next cycle, since the gates cycle only once per network cycle.
+        """
+        for rnd in range(self.maxOverlapTicks):  # @UnusedVariable
+            if self.stopNow or self.nI.pollRecv():
+                break
+            busy = [p for p in self.patches
+                    if not p.loop.dead and not p.loop.sequencer.onlyTimelessToday()]
+            if not busy:
+                break
+            for p in busy:
+                t0 = time.time()
+                reply = p.loop.switch()  # @UnusedVariable
+                p.stepTime += time.time() - t0
+                self.nOverlapTicks += 1
+                self.nI.pollRecv()
+
+    def collectiveDateCheck(self):
+        """
+        Every rank gets here once per network cycle, just after everything sent in the
+        previous cycle has been delivered.  At that point a patch which is done with today
+        and has nothing in its gates cannot be holding or awaiting any work, so the count of
+        busy patches and the gate traffic counts form a consistent snapshot of the whole
+        simulation.  The snapshot is summed across ranks by a non-blocking reduction which
+        is collected a cycle later.  If no patch anywhere was busy and everything sent has
+        been received, all patches move to the next day together.  The cycle of delay is
+        safe because an idle simulation stays idle; timeless agents only respond to
+        arrivals.
+        """
+        if self.nI.reductionPending:
+            nBusy, nSent, nRecvd = self.nI.finishReduction()
+            if nBusy == 0 and nSent == nRecvd:
+                for p in self.patches:
+                    p.loop.sequencer.bumpTime()
+                    p.runPending = True
+                if self.balanceInterval is not None:
+                    self.daysSinceBalance += 1
+                    if self.daysSinceBalance >= self.balanceInterval:
+                        self.balanceLoad()
+                        self.daysSinceBalance = 0
+                if self.checkpointer is not None:
+                    self.checkpointer.writeIfDue(self)
+        nBusy = len([p for p in self.patches if not p.doneWithToday()])
+        self.nI.startReduction([nBusy, self.nGateSent, self.nGateRecvd])
+
+    def getCheckpointState(self):
+        """
+        Returns a picklable dict of the state of the group which a checkpoint must preserve
+        besides its patches.  This is only meaningful just after a collective date change.
+        """
+        return {'nGateSent': self.nGateSent, 'nGateRecvd': self.nGateRecvd,
+                'daysSinceBalance': self.daysSinceBalance, 'cycleCount': self.cycleCount,
+                'patchRanks': dict(self.nI.patchRanks),
+                'patchCounter': Patch.counter, 'interactantCounter': agent.Interactant.counter}
+
+    def setCheckpointState(self, stateDict):
+        """The inverse of getCheckpointState(), called before the patches are restored"""
+        self.nGateSent = stateDict['nGateSent']
+        self.nGateRecvd = stateDict['nGateRecvd']
+        self.daysSinceBalance = stateDict['daysSinceBalance']
+        self.cycleCount = stateDict['cycleCount']
+        for patchAddr, rank in stateDict['patchRanks'].items():
+            self.nI.setPatchRank(patchAddr, rank)
+        # New ids must not collide with those of the restored patches and interactants
+        Patch.counter = max(Patch.counter, stateDict['patchCounter'])
+        agent.Interactant.counter = max(agent.Interactant.counter,
+                                        stateDict['interactantCounter'])
+
+    def balanceLoad(self):
+        """
+        This is called on every rank at the same date change, when nothing is in flight
+        between patches.  The step times of all patches since the last call are gathered,
+        a migration plan is computed (identically on every rank), and the chosen patches
+        are shipped to their new ranks.  Every rank then forwards messages for a moved patch
+        to its new rank.
+        """
+        myLoads = [(p.gblAddr, p.stepTime, p.canMigrate()) for p in self.patches]
+        for p in self.patches:
+            p.stepTime = 0.0
+        moves = _planMigrations(self.nI.comm.allgather(myLoads), self.balanceTolerance,
+                                self.maxMigrationsPerBalance)
+        if moves:
+            self.migratePatches(moves)
+
+    def migratePatches(self, moves):
+        """
+        moves is a list of (patchAddr, fromRank, toRank) tuples, which must be the same on
+        every rank.  This must be called between network cycles.
+        """
+        moves = [(patchAddr, srcRank, destRank) for patchAddr, srcRank, destRank in moves
+                 if srcRank != destRank]
+        myRank = self.nI.comm.rank
+        outgoing = []
+        incomingRanks = []
+        for patchAddr, srcRank, destRank in moves:
+            if srcRank == myRank:
+                patch = [p for p in self.patches if p.gblAddr == patchAddr][0]
+                outgoing.append((destRank, patch.packForMigration()))
+                self.patches.remove(patch)
+                del self.patchDict[patchAddr]
+                self.nI.dropCallbacks(patchAddr)
+                self.logger.info('%s: patch %s migrates to rank %d'
+                                 % (self.name, patch.name, destRank))
+            elif destRank == myRank:
+                incomingRanks.append(srcRank)
+        arrivals = self.nI.transfer(outgoing, incomingRanks)
+        for patchAddr, srcRank, destRank in moves:  # @UnusedVariable
+            self.nI.setPatchRank(patchAddr, destRank)
+        self.serviceDirectory.patchesMoved()
+        for pkg in arrivals:
+            self.unpackMigrant(pkg)
+        # Gates normally register their routes as the GateAgent cycles, but a patch which
+        # has just arrived would register a cycle late.  Registering every route now means
+        # that both ends of every new pair of ranks start exchanging messages this cycle.
+        for p in self.patches:
+            for tag in p.outgoingGateDict:
+                self.willSendTo(tag)
+            for tag, gateExit in p.incomingGateDict.items():
+                self.expect(tag, p.gblAddr, gateExit.handleIncoming)
+
+    def unpackMigrant(self, pkg):
+        """Rebuild a patch from the output of Patch.packForMigration()"""
+        header, buf = pkg
+        patch = self._newPatchFromHeader(header)
+        unpickler = _MigrationUnpickler(io.BytesIO(buf), patch)
+        agentList, iactList, patchDict = unpickler.load()
+        agentsSeen = unpickler.load()
+        self._installPatchContents(patch, agentList, iactList, patchDict, agentsSeen)
+        self.logger.info('%s: patch %s arrived' % (self.name, patch.name))
+        return patch
+
+    def unpackCheckpoint(self, header, stateBuf, records):
+        """
+        Rebuild a patch from the output of Patch.packForCheckpoint().  stateBuf holds the
+        patch's own state, and records is a list of (key, cls, buf) giving the id, class and
+        pickled state of each of its records when they were saved.
+        """
+        patch = self._newPatchFromHeader(header)
+        thingDict = dict([(key, cls.__new__(cls)) for key, cls, buf in records])
+        for key, cls, buf in records:  # @UnusedVariable
+            _setObjState(thingDict[key],
+                         _CheckpointUnpickler(io.BytesIO(buf), patch, thingDict).load())
+        agentKeys, iactKeys, patchDict = _CheckpointUnpickler(io.BytesIO(stateBuf), patch,
+                                                              thingDict).load()
+        agentList = [(thingDict[key], t) for key, t in agentKeys]
+        iactList = [thingDict[key] for key in iactKeys]
+        agentsSeen = [thing for thing in thingDict.values()
+                      if isinstance(thing, (agent.Agent, agent.FSMAgent))]
+        self._installPatchContents(patch, agentList, iactList, patchDict, agentsSeen)
+        return patch
+
+    def _newPatchFromHeader(self, header):
+        patchCls = header['cls']
+        patch = patchCls.__new__(patchCls)
+        Patch.__init__(patch, self, name=header['name'], gblAddr=header['gblAddr'],
+                       sequencerClass=header['sequencerClass'])
+        patch.loop.sequencer.setTimeNow(header['timeNow'])
+        dcQueue = patch.dateChangeAgent.inputQueue
+        del patch.interactantDict[dcQueue.getGblAddr()]
+        dcQueue.id = header['dateChangeQueueId']
+        patch.interactantDict[dcQueue.getGblAddr()] = dcQueue
+        for tag in header['gatesTo']:
+            patch.addGateTo(tag)
+        for tag in header['gatesFrom']:
+            patch.addGateFrom(tag)
+        patch.setNextHops(header['nextHopDict'])  # also re-keys the date change queue route
+        return patch
+
+    def _installPatchContents(self, patch, agentList, iactList, patchDict, agentsSeen):
+        patch.__dict__.update(patchDict)
+        liveList = agent.Interactant.getLiveList()
+        for iact in iactList:
+            patch.loop.interactants.add(iact)
+            liveList.append(iact)
+        patch.addInteractants(iactList)
+        for a in agentsSeen:
+            a.reHome(patch)
+        for iact in iactList:
+            iact._updateBlocking()
+        for a, t in agentList:
+            patch.loop.sequencer.enqueue(a, t)
+        self.addPatch(patch)
+        patch.onArrival()
+
     def __str__(self):
         return '<%s>' % self.name
 
     def enqueue(self, msgType, thing, srcTag, destTag):
         self.nI.enqueue(msgType, thing, srcTag, destTag)
 
+    def willSendTo(self, destAddr):
+        """
+        Declare that messages may be enqueued for destAddr.  A message need only be
+        enqueued when there is something to deliver.
+        """
+        self.nI.willSendTo(destAddr)
+
     def expect(self, srcAddr, destAddr, handleIncoming):
         """
         The handleIncoming is a callback with the signature
@@ -727,50 +1791,65 @@ class PatchGroup(greenlet):
         self.nI.expect(srcAddr, destAddr, handleIncoming)
 
     def shareInteractantDirectories(self, patchList):
-        myInteractants = defaultdict(list)
+        """
+        Every rank contributes the addresses of its patches and a DirectoryBlock for each
+        class of interactant they hold (one per home rank, if patches have migrated), and
+        gets back a ServiceDirectory of the whole world and the list of all patch addresses.
+        The blocks are gathered in rank order, so the directory is the same on every rank.
+        This includes an implicit barrier.
+        """
+        myEntries = defaultdict(list)
+        myPatches = []
         for p in patchList:
-            pId = p.patchId
-            myInteractants['_'].append(self.getGblAddr(pId))
+            myPatches.append(p.gblAddr)
             for iact in p.interactantDict.values():
-                info = iact.getInfo()
-                classNm = iact.__class__.__name__
-                myInteractants[classNm].append((info, self.getGblAddr((pId, iact.id))))
-        gblAllInteractants = defaultdict(list)
+                gblAddr = iact.getGblAddr()
+                myEntries[(iact.__class__.__name__, gblAddr.rank)].append((iact.getInfo(),
+                                                                            gblAddr))
+        myBlocks = [(classNm, DirectoryBlock(rank, entries))
+                    for (classNm, rank), entries in sorted(myEntries.items())]
+        blockDict = defaultdict(list)
         gblAllPatches = []
-        if self.deterministic:
-            # Be meticulous, so that things get inserted in consistent order
-            dList = self.nI.comm.allgather(myInteractants)
-            l = [(d['_'], d) for d in dList]
-            l.sort()
-            l = [b for a, b in l]  # @UnusedVariable
-            for d in l:
-                gblAllPatches.extend(d['_'])
-                subL = [(k, v) for k, v in d.items() if k != '_']
-                subL.sort()
-                for k, v in subL:
-                    gblAllInteractants[k].extend(v)
-        else:
-            for d in self.nI.comm.allgather(myInteractants):
-                for k, v in d.items():
-                    if k == '_':
-                        gblAllPatches.extend(v)
-                    else:
-                        gblAllInteractants[k].extend(v)
-        return gblAllInteractants, gblAllPatches
+        for patchAddrList, blockList in self.nI.comm.allgather((myPatches, myBlocks)):
+            gblAllPatches.extend(patchAddrList)
+            for classNm, block in blockList:
+                blockDict[classNm].append(block)
+        return ServiceDirectory(dict(blockDict), self.nI.rankOf), gblAllPatches
+
+    @property
+    def worldInteractants(self):
+        """
+        A dict of lists of (info, gblAddr) pairs by class name, for the whole world.  This
+        decodes the entire directory, so serviceDirectory should be used instead.
+        """
+        return dict([(classNm, list(self.serviceDirectory.lookup(classNm)))
+                     for classNm in self.serviceDirectory.classNames()])
 
     def isLocal(self, gblAddr):
         return self.nI.isLocal(gblAddr)
 
-    def start(self):
+    def start(self, neighbors=None):
+        """
+        If neighbors is None, every patch gets gates to and from every other patch.
+        Otherwise neighbors(patchAddr) must return the GblAddrs of the patches with which the
+        patch at patchAddr exchanges agents directly.  It is called for every patch on every
+        rank and must give the same answers everywhere.  Gates are built in both directions
+        between neighbors, agents bound for more distant patches hop from neighbor to neighbor
+        along a shortest path, and each rank communicates only with the ranks holding
+        neighbors of its patches.
+        """
         # Collect remote geometry information.  This includes an implicit barrier
-        self.worldInteractants, self.allPatches = self.shareInteractantDirectories(self.patches)
-
-        # Build the global gate network
-        for localP in self.patches:
-            for friend in self.allPatches:
-                if (localP.gblAddr != friend):
-                    localP.addGateTo(friend)
-                    localP.addGateFrom(friend)
+        self.serviceDirectory, self.allPatches = self.shareInteractantDirectories(self.patches)
+
+        if neighbors is None:
+            # Build the global gate network
+            for localP in self.patches:
+                for friend in self.allPatches:
+                    if (localP.gblAddr != friend):
+                        localP.addGateTo(friend)
+                        localP.addGateFrom(friend)
+        else:
+            self.buildSparseGates(neighbors)
 
         self.stopNow = False
         return self.switch()
@@ -778,5 +1857,35 @@ class PatchGroup(greenlet):
     def stop(self):
         self.stopNow = True
 
+    def buildSparseGates(self, neighbors):
+        """
+        Build gates only between neighboring patches, along with the tables needed to route
+        agents to more distant patches and to agree on when all ranks are done.
+        """
+        adjacency = dict([(pAddr, set()) for pAddr in self.allPatches])
+        for pAddr in self.allPatches:
+            for nbrAddr in neighbors(pAddr):
+                if nbrAddr != pAddr:
+                    adjacency[pAddr].add(nbrAddr)
+                    adjacency[nbrAddr].add(pAddr)
+        for localP in self.patches:
+            for friend in self.allPatches:
+                if friend in adjacency[localP.gblAddr]:
+                    localP.addGateTo(friend)
+                    localP.addGateFrom(friend)
+            localP.setNextHops(_firstHops(adjacency, localP.gblAddr))
+        rankOf = self.nI.rankOf  # patches restored from a checkpoint may have migrated
+        rankAdjacency = dict([(rankOf(pAddr), set()) for pAddr in self.allPatches])
+        rankAdjacency.setdefault(self.nI.comm.rank, set())
+        for pAddr, nbrs in adjacency.items():
+            for nbrAddr in nbrs:
+                if rankOf(nbrAddr) != rankOf(pAddr):
+                    rankAdjacency[rankOf(pAddr)].add(rankOf(nbrAddr))
+        ranks, diameter = _componentAndDiameter(rankAdjacency, self.nI.comm.rank)
+        if self.collectiveDateChange and len(ranks) != self.nI.comm.size:
+            raise RuntimeError('%s: collective date change requires that all ranks be connected'
+                               % self.name)
+        self.nI.setDoneTopology(ranks, diameter)
+
     def doneWithToday(self):
         return all([p.doneWithToday() for p in self.patches])
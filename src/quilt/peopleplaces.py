@@ -16,7 +16,9 @@
 ###################################################################################
 
 import logging
+from collections import deque
 import quilt.patches as patches
+import quilt.agentpack as agentpack
 
 logger = logging.getLogger(__name__)
 
@@ -53,7 +55,7 @@ class HoldQueue(patches.Interactant):
         return patches.Interactant.lock(self, lockingAgent)
 
     def awaken(self, agentOrKey):
-        if isinstance(agentOrKey, patches.Agent):
+        if isinstance(agentOrKey, (patches.Agent, patches.FSMAgent)):
             agent = agentOrKey
         elif agentOrKey in self.heldDict:
             agent = self.heldDict[agentOrKey]
@@ -64,11 +66,43 @@ class HoldQueue(patches.Interactant):
 
 
 class Manager(patches.Agent):
+    """
+    A Manager handles the requests arriving at the RequestQueues of its ManagementBase.
+
+    If wakeOnRequest is True, an idle Manager leaves the run queue entirely and is
+    re-enqueued by its RequestQueues when a request arrives.  Otherwise it runs every tick.
+    The default of None selects the first behavior unless the derived class overrides
+    perTickActions, which would otherwise no longer be called on every tick.
+
+    If maxRequestsPerSlice is not None, the Manager yields after handling that many
+    requests, letting other agents run before it drains the rest.
+
+    Requests arrive in two ways.  Message agents waiting in a RequestQueue are passed to
+    handleRequest(), while messages posted with Patch.postMsg() are passed to
+    handlePostedMsg().  Person posts its Arrival and Departure messages, so a derived
+    class which wants to see them must override handlePostedMsg() rather than
+    handleRequest().
+    """
+    wakeOnRequest = None
+    maxRequestsPerSlice = None
+
     def __init__(self, name, patch, managementBase):
         super(Manager, self).__init__(name, patch)
         self.timeless = True
         self.toManage = managementBase
         self.logger = logger.getChild('Manager')
+        if self.wakeOnRequest is None:
+            self.wakeOnRequest = (type(self).perTickActions == Manager.perTickActions)
+        self._waitingForRequests = False
+
+    def notify(self):
+        """
+        Called by a RequestQueue when a request arrives.  If the Manager is idle and waiting
+        for requests, it is enqueued to run now.
+        """
+        if self._waitingForRequests:
+            self._waitingForRequests = False
+            self.ownerLoop.sequencer.enqueue(self, self.ownerLoop.sequencer.getTimeNow())
 
     def handleRequest(self, req, logDebug, timeNow):
         if isinstance(req, SimpleMsg):
@@ -76,6 +110,12 @@ class Manager(patches.Agent):
         else:
             raise RuntimeError("%s unexpectedly got the message %s" % (self.name, req.name))
 
+    def handlePostedMsg(self, msgType, payload, timeNow):
+        """
+        Messages posted with Patch.postMsg arrive here rather than via handleRequest.
+        """
+        return self.toManage.handleIncomingMsg(msgType, payload, timeNow)
+
     def perTickActions(self, timeNow):
         """
         This hook allows derived classes to add per-tick behavior without messing with
@@ -86,21 +126,59 @@ class Manager(patches.Agent):
     def run(self, startTime):
         timeNow = startTime  # @UnusedVariable
         logDebug = self.logger.isEnabledFor(logging.DEBUG)
+        maxPerSlice = self.maxRequestsPerSlice
+        nHandled = 0
         while True:
             foundAny = True
             while foundAny:
                 foundAny = False
                 for rQ in self.toManage.reqQueues:
+                    while rQ.inbox:
+                        foundAny = True
+                        msgType, payload, msgTime = rQ.popMsg()  # @UnusedVariable
+                        timeNow = self.handlePostedMsg(msgType, payload, timeNow)
+                        nHandled += 1
+                        if maxPerSlice is not None and nHandled >= maxPerSlice:
+                            timeNow = self.sleep(0)
+                            nHandled = 0
                     if rQ._lockQueue:
                         foundAny = True
                         req = rQ._lockQueue[0]
                         timeNow = self.handleRequest(req, logDebug, timeNow)
                         rQ.awaken(req)
+                        nHandled += 1
+                        if maxPerSlice is not None and nHandled >= maxPerSlice:
+                            timeNow = self.sleep(0)
+                            nHandled = 0
             self.perTickActions(timeNow)
-            timeNow = self.sleep(0)  # @UnusedVariable
+            nHandled = 0
+            if self.wakeOnRequest:
+                self._waitingForRequests = True
+                timeNow = self.ownerLoop.switch('%s waits for requests' % self.name)
+            else:
+                timeNow = self.sleep(0)  # @UnusedVariable
+
+    def __getstate__(self):
+        """
+        A Manager moves only when its whole patch migrates.  Its run method then starts over,
+        which is harmless since it keeps no state between requests.
+        """
+        d = patches.Agent.__getstate__(self)
+        d['toManage'] = self.toManage
+        d['wakeOnRequest'] = self.wakeOnRequest
+        d['_waitingForRequests'] = self._waitingForRequests
+        return d
 
+    def __setstate__(self, d):
+        patches.Agent.__setstate__(self, d)
+        self.logger = logger.getChild('Manager')
 
-class SimpleMsg(patches.Agent):
+
+class SimpleMsg(patches.FSMAgent):
+    """
+    Messages are FSMAgents rather than greenlets, since a message is launched for every
+    move of every Person.
+    """
     STATE_MOVING = 0
     STATE_ARRIVED = 1
 
@@ -110,31 +188,35 @@ class SimpleMsg(patches.Agent):
         self.destAddr = destAddr
         self.fsmstate = self.STATE_MOVING
 
-    def run(self, startTime):
-        timeNow = startTime  # @UnusedVariable
-        while True:
-            if self.fsmstate == self.STATE_MOVING:
-                addr, final = self.patch.getPathTo(self.destAddr)
-                if final:
-                    self.fsmstate = self.STATE_ARRIVED
-                timeNow = addr.lock(self)  # @UnusedVariable
-            elif self.fsmstate == self.STATE_ARRIVED:
-                break  # we are done
+    def step(self, timeNow):
+        if self.fsmstate == self.STATE_MOVING:
+            addr, final = self.patch.getPathTo(self.destAddr)
+            if final:
+                self.fsmstate = self.STATE_ARRIVED
+            return (self.LOCK, addr)
+        elif self.fsmstate == self.STATE_ARRIVED:
+            return (self.FINISH, None)  # we are done
+        else:
+            raise RuntimeError('unknown state %s' % self.fsmstate)
 
     def __getstate__(self):
-        d = patches.Agent.__getstate__(self)
+        d = patches.FSMAgent.__getstate__(self)
         d['payload'] = self.payload
         d['fsmstate'] = self.fsmstate
         d['destAddr'] = self.destAddr
         return d
 
     def __setstate__(self, stateDict):
-        patches.Agent.__setstate__(self, stateDict)
+        patches.FSMAgent.__setstate__(self, stateDict)
         self.payload = stateDict['payload']
         self.fsmstate = stateDict['fsmstate']
         self.destAddr = stateDict['destAddr']
 
 
+agentpack.registerSchema(SimpleMsg, agentpack.AGENT_FIELDS
+                         + [('payload', 'obj'), ('fsmstate', 'int'), ('destAddr', 'addr')])
+
+
 class ArrivalMsg(SimpleMsg):
     pass
 
@@ -145,30 +227,40 @@ class DepartureMsg(SimpleMsg):
 
 class FutureMsg(SimpleMsg):
     """A message guaranteed to arrive in the future, rather than "now"."""
+    STATE_HOPPED = 2
+    STATE_DELIVERED = 3
 
     def __init__(self, name, patch, payload, destAddr, arrivalTime, debug=False):
         super(FutureMsg, self).__init__(name, patch, payload, destAddr, debug=debug)
+        assert arrivalTime > patch.loop.sequencer.getTimeNow(), \
+            "This FutureMsg is not going to the future"
         self.arrivalTime = arrivalTime
 
-    def run(self, startTime):
-        assert self.arrivalTime > startTime, "This FutureMsg is not going to the future"
-        timeNow = startTime  # @UnusedVariable
-        while True:
-            if self.fsmstate == self.STATE_MOVING:
-                addr, final = self.patch.getPathTo(self.destAddr)
-                if final:
-                    self.fsmstate = self.STATE_ARRIVED
-                else:
-                    timeNow = addr.lock(self)  # @UnusedVariable
-                    if timeNow < self.arrivalTime:
-                        timeNow = self.sleep(1)
-            elif self.fsmstate == self.STATE_ARRIVED:
-                if timeNow < self.arrivalTime:
-                    timeNow = self.sleep(self.arrivalTime - timeNow)
-                timeNow = addr.lock(self)
-                break  # we are done
+    def step(self, timeNow):
+        if self.fsmstate == self.STATE_MOVING:
+            addr, final = self.patch.getPathTo(self.destAddr)
+            if final:
+                self.fsmstate = self.STATE_ARRIVED
+                return self.step(timeNow)
+            else:
+                self.fsmstate = self.STATE_HOPPED
+                return (self.LOCK, addr)
+        elif self.fsmstate == self.STATE_HOPPED:
+            self.fsmstate = self.STATE_MOVING
+            if timeNow < self.arrivalTime:
+                return (self.SLEEP, 1)
             else:
-                raise RuntimeError('unknown state %s' % self.fsmstate)
+                return self.step(timeNow)
+        elif self.fsmstate == self.STATE_ARRIVED:
+            if timeNow < self.arrivalTime:
+                return (self.SLEEP, self.arrivalTime - timeNow)
+            addr, final = self.patch.getPathTo(self.destAddr)  # @UnusedVariable
+            self.fsmstate = self.STATE_DELIVERED
+            return (self.LOCK, addr)
+        elif self.fsmstate == self.STATE_DELIVERED:
+            return (self.FINISH, None)  # we are done
+        else:
+            raise RuntimeError('unknown state %s' % self.fsmstate)
 
     def __getstate__(self):
         d = SimpleMsg.__getstate__(self)
@@ -180,8 +272,59 @@ class FutureMsg(SimpleMsg):
         self.arrivalTime = stateDict['arrivalTime']
 
 
+agentpack.registerSchema(FutureMsg, agentpack.AGENT_FIELDS
+                         + [('payload', 'obj'), ('fsmstate', 'int'), ('destAddr', 'addr'),
+                            ('arrivalTime', 'int')])
+
+
 class RequestQueue(patches.Interactant):
-    pass
+    """
+    The manager of a ManagementBase locks its RequestQueues.  Message agents which lock
+    the queue wait there until the manager handles and awakens them.  Messages can also be
+    delivered without any agent at all via Patch.postMsg, which places them in the queue's
+    inbox.  Either way the manager passes them to ManagementBase.handleIncomingMsg.
+    """
+    def __init__(self, name, patch, debug=False):
+        super(RequestQueue, self).__init__(name, patch, debug=debug)
+        self.inbox = deque()
+        self.manager = None
+
+    def setManager(self, manager):
+        """The manager locks the queue, and is notified whenever a request arrives"""
+        self.lock(manager)
+        self.manager = manager
+
+    def lock(self, lockingAgent, debug=False):
+        if self.manager is not None and lockingAgent is not self.manager:
+            self.manager.notify()
+        return patches.Interactant.lock(self, lockingAgent, debug=debug)
+
+    def suspend(self, agent):
+        if self.manager is not None:
+            self.manager.notify()
+        return patches.Interactant.suspend(self, agent)
+
+    def postMsg(self, msgType, payload, timeNow):
+        self.inbox.append((msgType, payload, timeNow))
+        self._updateBlocking()
+        if self.manager is not None:
+            self.manager.notify()
+
+    def popMsg(self):
+        """Returns the oldest (msgType, payload, timeNow) tuple in the inbox"""
+        tpl = self.inbox.popleft()
+        if not self.inbox:
+            self._updateBlocking()
+        return tpl
+
+    def getNWaiting(self):
+        return self._nEnqueued + len(self.inbox)
+
+    def getWaitingDetails(self):
+        """Returns a dict of typeName:nOfThisType entries"""
+        result = patches.Interactant.getWaitingDetails(self)
+        result['_inbox'] = len(self.inbox)
+        return result
 
 
 class ManagementBase(object):
@@ -194,7 +337,7 @@ class ManagementBase(object):
         self.manager = managerClass(name + '_Mgr', patch, self)
         self.reqQueues = [rQC(name+'_rQ', patch) for rQC in reqQueueClasses]
         for rQ in self.reqQueues:
-            rQ.lock(self.manager)
+            rQ.setManager(self.manager)
         self.holdQueue = HoldQueue(name+'_hQ', patch)
         self.holdQueue.lock(self.manager)
 
@@ -307,11 +450,8 @@ class Person(patches.Agent):
                                               self.name)
                         self.handleDeparture(timeNow)
                         self.handleDeath(timeNow)
-                        self.patch.launch(DepartureMsg(self.name + '_depMsg',
-                                                       self.patch,
-                                                       self.loc.getDepartureMsgPayload(self),
-                                                       self.loc.getReqQueueAddr()),
-                                          timeNow)
+                        self.patch.postMsg(DepartureMsg, self.loc.getDepartureMsgPayload(self),
+                                           self.loc.getReqQueueAddr(), timeNow)
                         timeNow = self.loc.unlock(self)
                         break
                     elif newLocAddr == self.locAddr:
@@ -320,11 +460,8 @@ class Person(patches.Agent):
                                               (self.name, self.loc.checkInterval))
                         timeNow = self.sleep(self.loc.checkInterval)
                     else:
-                        self.patch.launch(DepartureMsg(self.name + '_depMsg',
-                                                       self.patch,
-                                                       self.loc.getDepartureMsgPayload(self),
-                                                       self.loc.getReqQueueAddr()),
-                                          timeNow)
+                        self.patch.postMsg(DepartureMsg, self.loc.getDepartureMsgPayload(self),
+                                           self.loc.getReqQueueAddr(), timeNow)
                         self.newLocAddr = newLocAddr
                         self.handleDeparture(timeNow)
                         timeNow = self.loc.unlock(self)
@@ -344,11 +481,8 @@ class Person(patches.Agent):
 
                 elif self.fsmstate == Person.STATE_JUSTARRIVED:
                     self.handleArrival(timeNow)
-                    self.patch.launch(ArrivalMsg(self.name + '_arvMsg',
-                                                 self.patch,
-                                                 self.loc.getArrivalMsgPayload(self),
-                                                 self.loc.getReqQueueAddr()),
-                                      timeNow)
+                    self.patch.postMsg(ArrivalMsg, self.loc.getArrivalMsgPayload(self),
+                                       self.loc.getReqQueueAddr(), timeNow)
                     self.fsmstate = Person.STATE_ATLOC
                     if self.debug:
                         self.logger.debug('%s point 7: day %s'
@@ -376,3 +510,8 @@ class Person(patches.Agent):
         self.newLocAddr = d['newLocAddr']
         self.fsmstate = d['fsmstate']
         self.logger = logging.getLogger(d['loggerName'])
+
+
+agentpack.registerSchema(Person, agentpack.AGENT_FIELDS
+                         + [('locAddr', 'addr'), ('newLocAddr', 'addr'), ('fsmstate', 'int'),
+                            ('loggerName', 'str')])
@@ -0,0 +1,158 @@
+#! /usr/bin/env python
+
+###################################################################################
+# Copyright   2015, Pittsburgh Supercomputing Center (PSC).  All Rights Reserved. #
+# =============================================================================== #
+#                                                                                 #
+# Permission to use, copy, and modify this software and its documentation without #
+# fee for personal use within your organization is hereby granted, provided that  #
+# the above copyright notice is preserved in all copies and that the copyright    #
+# and this permission notice appear in supporting documentation.  All other       #
+# restrictions and obligations are defined in the GNU Affero General Public       #
+# License v3 (AGPL-3.0) located at http://www.gnu.org/licenses/agpl-3.0.html  A   #
+# copy of the license is also provided in the top level of the source directory,  #
+# in the file LICENSE.txt.                                                        #
+#                                                                                 #
+###################################################################################
+
+_rhea_svn_id_ = "$Id$"
+
+"""
+This benchmark compares greenlet message agents with FSMAgent message agents.  Senders
+launch messages to a request queue each day, and a timeless receiver drains the queue,
+much as Person agents and Managers do in peopleplaces.  The number of greenlet switches
+and the run time per simulated day are reported for each kind of message.
+"""
+
+import sys
+import time
+from greenlet import greenlet
+
+import quilt.agent as agent
+
+
+class GreenletMsg(agent.Agent):
+    def __init__(self, name, ownerLoop, destQueue):
+        agent.Agent.__init__(self, name, ownerLoop)
+        self.destQueue = destQueue
+
+    def run(self, startTime):
+        timeNow = self.destQueue.lock(self)  # @UnusedVariable
+
+
+class StepMsg(agent.FSMAgent):
+    STATE_MOVING = 0
+    STATE_ARRIVED = 1
+
+    def __init__(self, name, ownerLoop, destQueue):
+        agent.FSMAgent.__init__(self, name, ownerLoop)
+        self.destQueue = destQueue
+        self.fsmstate = StepMsg.STATE_MOVING
+
+    def step(self, timeNow):
+        if self.fsmstate == StepMsg.STATE_MOVING:
+            self.fsmstate = StepMsg.STATE_ARRIVED
+            return (self.LOCK, self.destQueue)
+        else:
+            return (self.FINISH, None)
+
+
+class Sender(agent.Agent):
+    def __init__(self, name, ownerLoop, destQueue, msgClass, msgsPerDay):
+        agent.Agent.__init__(self, name, ownerLoop)
+        self.destQueue = destQueue
+        self.msgClass = msgClass
+        self.msgsPerDay = msgsPerDay
+        self.counter = 0
+
+    def run(self, startTime):
+        timeNow = startTime
+        while True:
+            for i in range(self.msgsPerDay):  # @UnusedVariable
+                msg = self.msgClass('%s_msg_%d' % (self.name, self.counter), self.ownerLoop,
+                                    self.destQueue)
+                self.counter += 1
+                if not msg.isFSM:
+                    msg.parent = self.ownerLoop
+                self.ownerLoop.sequencer.enqueue(msg, timeNow)
+            timeNow = self.sleep(1)
+
+
+class Receiver(agent.Agent):
+    def __init__(self, name, ownerLoop, reqQueue):
+        agent.Agent.__init__(self, name, ownerLoop)
+        self.timeless = True
+        self.reqQueue = reqQueue
+        self.nReceived = 0
+
+    def run(self, startTime):
+        timeNow = self.reqQueue.lock(self)
+        while True:
+            while self.reqQueue._lockQueue:
+                self.reqQueue.awaken(self.reqQueue._lockQueue[0])
+                self.nReceived += 1
+            timeNow = self.sleep(0)  # @UnusedVariable
+
+
+def runOne(msgClass, nSenders, msgsPerDay, nDays):
+    loop = agent.MainLoop(name='%sLoop' % msgClass.__name__)
+    reqQueue = agent.Interactant('reqQueue', loop)
+    receiver = Receiver('receiver', loop, reqQueue)
+    senders = [Sender('sender_%d' % i, loop, reqQueue, msgClass, msgsPerDay)
+               for i in range(nSenders)]
+
+    def perDayCB(thisLoop, timeNow):
+        if timeNow >= nDays:
+            thisLoop.stopRunning()
+    loop.addPerDayCallback(perDayCB)
+    loop.addAgents([receiver] + senders)
+
+    counts = {'switch': 0}
+
+    def countSwitches(event, args):
+        if event == 'switch':
+            counts['switch'] += 1
+
+    oldTrace = greenlet.settrace(countSwitches)
+    t0 = time.time()
+    loop.switch()
+    elapsed = time.time() - t0
+    greenlet.settrace(oldTrace)
+    return counts['switch'], elapsed, receiver.nReceived
+
+
+def describeSelf():
+    print("Usage: fsmbench.py [nSenders [msgsPerDay [nDays]]]")
+
+
+def main():
+    nSenders = 100
+    msgsPerDay = 20
+    nDays = 20
+    try:
+        args = [int(a) for a in sys.argv[1:]]
+    except ValueError:
+        describeSelf()
+        sys.exit('arguments must be integers')
+    if args:
+        nSenders = args[0]
+    if len(args) > 1:
+        msgsPerDay = args[1]
+    if len(args) > 2:
+        nDays = args[2]
+
+    results = {}
+    for msgClass in [GreenletMsg, StepMsg]:
+        nSwitches, elapsed, nReceived = runOne(msgClass, nSenders, msgsPerDay, nDays)
+        results[msgClass] = nSwitches
+        print('%12s: %d msgs, %10.1f switches/day, %8.4f sec/day'
+              % (msgClass.__name__, nReceived, float(nSwitches) / nDays, elapsed / nDays))
+    print('switches saved per simulated day: %.1f'
+          % (float(results[GreenletMsg] - results[StepMsg]) / nDays))
+
+############
+# Main hook
+############
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#! /usr/bin/env python
+
+###################################################################################
+# Copyright   2015, Pittsburgh Supercomputing Center (PSC).  All Rights Reserved. #
+# =============================================================================== #
+#                                                                                 #
+# Permission to use, copy, and modify this software and its documentation without #
+# fee for personal use within your organization is hereby granted, provided that  #
+# the above copyright notice is preserved in all copies and that the copyright    #
+# and this permission notice appear in supporting documentation.  All other       #
+# restrictions and obligations are defined in the GNU Affero General Public       #
+# License v3 (AGPL-3.0) located at http://www.gnu.org/licenses/agpl-3.0.html  A   #
+# copy of the license is also provided in the top level of the source directory,  #
+# in the file LICENSE.txt.                                                        #
+#                                                                                 #
+###################################################################################
+
+_rhea_svn_id_ = "$Id$"
+
+"""
+This benchmark times the VectorClock operations used in each network cycle- merge, copy
+and the before/after comparisons- for a range of communicator sizes, and compares them
+with a straightforward implementation which allocates a new vector for each result.  It
+also reports the pickled size of the clock in a message header, sent whole and sent as a
+delta against the previous cycle.  No MPI is needed.
+"""
+
+import sys
+import timeit
+import pickle
+import numpy as np
+
+from quilt.netinterface import VectorClock
+
+
+class SimpleVectorClock(object):
+    """The allocating implementation, for comparison"""
+    def __init__(self, commSize, rank, vec=None):
+        self.rank = rank
+        if vec is None:
+            self.vec = np.zeros(commSize, dtype=np.int32)
+        else:
+            self.vec = np.copy(vec)
+
+    def merge(self, foreignVec):
+        self.vec = np.maximum(self.vec, foreignVec)
+
+    def before(self, other):
+        return (np.all(np.less_equal(self.vec, other.vec))
+                and np.any(np.less(self.vec, other.vec)))
+
+    def after(self, other):
+        return (np.all(np.less_equal(other.vec, self.vec))
+                and np.any(np.less(other.vec, self.vec)))
+
+    def simultaneous(self, other):
+        return (not self.before(other) and not self.after(other))
+
+    def copy(self):
+        return SimpleVectorClock(self.vec.shape[0], self.rank, vec=np.copy(self.vec))
+
+
+def timeOps(clockClass, nRanks, nReps):
+    """Returns a dict of microseconds per call by operation name"""
+    a = clockClass(nRanks, 0, vec=np.arange(nRanks, dtype=np.int32))
+    b = clockClass(nRanks, 1, vec=np.arange(nRanks, dtype=np.int32) + 1)
+    foreignVec = np.arange(nRanks, dtype=np.int32)[::-1].copy()
+    ops = [('merge', lambda: a.merge(foreignVec)),
+           ('copy', a.copy),
+           ('before', lambda: a.before(b)),
+           ('after', lambda: a.after(b)),
+           ('simultaneous', lambda: a.simultaneous(b))]
+    result = {}
+    for nm, fun in ops:
+        result[nm] = 1.0e6 * min(timeit.repeat(fun, number=nReps, repeat=3)) / nReps
+    return result
+
+
+def headerSizes(nRanks, nCycles):
+    """
+    Returns the mean pickled size of the clock in a message header, sent whole and as a
+    delta, over nCycles cycles in which every rank ticks once and a few entries lag.
+    """
+    clock = VectorClock(nRanks, 0)
+    lastSent = np.zeros(nRanks, dtype=np.int32)
+    lastRecv = np.zeros(nRanks, dtype=np.int32)
+    receiver = VectorClock(nRanks, 1)
+    fullBytes = 0
+    deltaBytes = 0
+    for cycle in range(nCycles):
+        clock.vec += 1
+        if cycle % 7 == 0:
+            clock.vec[cycle % nRanks] += 1  # an occasional straggler catching up
+        fullBytes += len(pickle.dumps(clock.vec, pickle.HIGHEST_PROTOCOL))
+        enc = clock.encodeDelta(lastSent)
+        deltaBytes += len(pickle.dumps(enc, pickle.HIGHEST_PROTOCOL))
+        receiver.mergeDelta(enc, lastRecv)
+    assert np.array_equal(receiver.vec, clock.vec), 'delta decoding went wrong'
+    return float(fullBytes) / nCycles, float(deltaBytes) / nCycles
+
+
+def describeSelf():
+    print("Usage: vclockbench.py [nReps]")
+
+
+def main():
+    nReps = 20000
+    try:
+        args = [int(a) for a in sys.argv[1:]]
+    except ValueError:
+        describeSelf()
+        sys.exit('arguments must be integers')
+    if args:
+        nReps = args[0]
+
+    opNames = ['merge', 'copy', 'before', 'after', 'simultaneous']
+    print('%6s %14s' % ('ranks', 'usec per call:') + ''.join(['%14s' % nm for nm in opNames]))
+    for nRanks in [2, 4, 16, 64, 256, 1024]:
+        for clockClass in [SimpleVectorClock, VectorClock]:
+            times = timeOps(clockClass, nRanks, nReps)
+            print('%6d %14s' % (nRanks, clockClass.__name__[:14])
+                  + ''.join(['%14.3f' % times[nm] for nm in opNames]))
+    print('')
+    print('%6s %16s %16s' % ('ranks', 'full hdr bytes', 'delta hdr bytes'))
+    for nRanks in [2, 4, 16, 64, 256, 1024]:
+        fullBytes, deltaBytes = headerSizes(nRanks, 100)
+        print('%6d %16.1f %16.1f' % (nRanks, fullBytes, deltaBytes))
+
+############
+# Main hook
+############
+
+if __name__ == "__main__":
+    main()
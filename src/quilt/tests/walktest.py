@@ -22,9 +22,13 @@ This provides a simple test routine for patches.
 """
 
 import sys
+import functools
 from random import choice, seed, random
 
 import quilt.patches as patches
+import quilt.netinterface as netinterface
+import quilt.communicator as communicator
+import quilt.checkpoint as checkpoint
 import quilt.peopleplaces as peopleplaces
 import logging
 
@@ -100,10 +104,7 @@ class Walker(peopleplaces.Person):
         if isinstance(self.loc, wantLocType):
             return self.locAddr
         else:
-            facAddrList = [tpl[1] for tpl in self.patch.serviceLookup(wantLocType.__name__)
-                           if tpl[1] != self.locAddr]
-            newAddr = choice(facAddrList)
-            return newAddr
+            return self.patch.serviceChoice(wantLocType.__name__, excludeAddr=self.locAddr)
 
     def handleArrival(self, timeNow):
         """
@@ -168,8 +169,7 @@ class LocGroup(peopleplaces.ManagementBase):
             # Maybe let this trigger a FutureMsg
             if random() <= 0.1:
                 ptch = self.manager.patch
-                facAddrList = [tpl[1] for tpl in ptch.serviceLookup(LocManagerReqQueue.__name__)]
-                newAddr = choice(facAddrList)
+                newAddr = ptch.serviceChoice(LocManagerReqQueue.__name__)
                 delay = choice([1, 2, 3])
                 tstMsg = FutureTestMsg(self.name + ('_futureMsg_%d' % FutureTestMsg.nextId()),
                                        ptch,
@@ -188,10 +188,16 @@ class MyPatch(patches.Patch):
     """
     Specialized so that we can collect some display data
     """
+    migratable = True
+
     def __init__(self, group, name=None, patchId=None):
         super(MyPatch, self).__init__(group, name, patchId)
         self.locGroups = []
         self.termsList = []  # used in printing output
+        self.runDuration = None
+
+    def onArrival(self):
+        self.loop.addPerTickCallback(createPerTickCB(self, self.runDuration))
 
     def addAgents(self, agentList):
         super(MyPatch, self).addAgents(agentList)
@@ -225,19 +231,61 @@ def createPerTickCB(patch, runDurationDays):
     return perTickCB
 
 
+def ringNeighbors(nRanks, patchesPerRank):
+    """
+    Returns a neighbors function for PatchGroup.start which links the patches into a ring,
+    assuming the patches on each rank have patchIds 0 through patchesPerRank - 1
+    """
+    nPatches = nRanks * patchesPerRank
+
+    def neighbors(patchAddr):
+        idx = patchAddr.rank * patchesPerRank + patchAddr.lclId
+        return [netinterface.GblAddr(nbrIdx // patchesPerRank, nbrIdx % patchesPerRank)
+                for nbrIdx in [(idx + 1) % nPatches, (idx - 1) % nPatches]]
+    return neighbors
+
+
 def describeSelf():
     print("This main provides diagnostics. -t and -d for trace and debug respectively.")
+    print("--buffered selects the buffer-based network transport.")
+    print("--shm selects the buffer-based transport with shared memory between ranks on a host.")
+    print("--collective selects collective date change detection.")
+    print("--ring connects the patches in a ring rather than all to all.")
+    print("--deltaclocks sends vector clocks as deltas.")
+    print("--balance migrates patches between ranks to balance the load; implies --collective.")
+    print("--workaware gives busy patches extra ticks per cycle, and with --collective skips")
+    print("    idle patches.")
+    print("--pipelined delivers messages as they arrive and keeps busy patches running while")
+    print("    messages are in flight; implies --collective.")
+    print("--nompi runs a single rank without MPI; set QUILT_NOMPI to skip loading it at all.")
+    print("--procs=N runs N ranks in separate processes without MPI.")
+    print("--checkpoint=DIR writes a checkpoint to DIR every 5 days; implies --collective.")
+    print("--restart=DIR restarts from the newest checkpoint in DIR, and continues to write")
+    print("    checkpoints there; implies --collective.")
 
 
 def main():
     trace = False
     debug = False
     deterministic = False
+    netInterfaceClass = None
+    collectiveDateChange = False
+    balanceInterval = None
+    pipelined = False
+    ring = False
     locCapacity = 100
     agentsPerPatch = 35
     locsPerPatch = 5
     patchesPerRank = 2
     runDuration = 30
+    noMPI = False
+    nProcs = None
+    ckptDir = None
+    restart = False
+    deltaClocks = False
+    maxTicksPerPass = 1
+    maxSliceSeconds = None
+    maxIdlePasses = 0
 
     for a in sys.argv[1:]:
         if a == '-d':
@@ -246,6 +294,37 @@ def main():
             trace = True
         elif a == '--deterministic':
             deterministic = True
+        elif a == '--buffered':
+            netInterfaceClass = netinterface.BufferedNetworkInterface
+        elif a == '--shm':
+            netInterfaceClass = netinterface.SharedMemoryNetworkInterface
+        elif a == '--collective':
+            collectiveDateChange = True
+        elif a == '--ring':
+            ring = True
+        elif a == '--deltaclocks':
+            deltaClocks = True
+        elif a == '--balance':
+            collectiveDateChange = True
+            balanceInterval = 5
+        elif a == '--pipelined':
+            collectiveDateChange = True
+            pipelined = True
+        elif a == '--nompi':
+            noMPI = True
+        elif a.startswith('--procs='):
+            nProcs = int(a[len('--procs='):])
+        elif a.startswith('--checkpoint='):
+            collectiveDateChange = True
+            ckptDir = a[len('--checkpoint='):]
+        elif a.startswith('--restart='):
+            collectiveDateChange = True
+            ckptDir = a[len('--restart='):]
+            restart = True
+        elif a == '--workaware':
+            maxTicksPerPass = 4
+            maxSliceSeconds = 0.05
+            maxIdlePasses = 8
         else:
             describeSelf()
             sys.exit('unrecognized argument %s' % a)
@@ -255,7 +334,29 @@ def main():
     else:
         logLevel = 'INFO'
 
-    comm = patches.getCommWorld()
+    runFun = functools.partial(runWalk, logLevel=logLevel, trace=trace,
+                               deterministic=deterministic, netInterfaceClass=netInterfaceClass,
+                               collectiveDateChange=collectiveDateChange,
+                               balanceInterval=balanceInterval, pipelined=pipelined, ring=ring,
+                               locCapacity=locCapacity, agentsPerPatch=agentsPerPatch,
+                               locsPerPatch=locsPerPatch, patchesPerRank=patchesPerRank,
+                               runDuration=runDuration, ckptDir=ckptDir, restart=restart,
+                               deltaClocks=deltaClocks, maxTicksPerPass=maxTicksPerPass,
+                               maxSliceSeconds=maxSliceSeconds, maxIdlePasses=maxIdlePasses)
+    if nProcs is not None:
+        codes = communicator.runProcesses(nProcs, runFun)
+        if any(codes):
+            sys.exit('exit codes %s' % codes)
+    elif noMPI:
+        runFun(communicator.LocalCommunicator())
+    else:
+        runFun(patches.getCommWorld())
+
+
+def runWalk(comm, logLevel, trace, deterministic, netInterfaceClass, collectiveDateChange,
+            balanceInterval, pipelined, ring, locCapacity, agentsPerPatch, locsPerPatch,
+            patchesPerRank, runDuration, ckptDir=None, restart=False, deltaClocks=False,
+            maxTicksPerPass=1, maxSliceSeconds=None, maxIdlePasses=0):
     rank = comm.rank
     logging.basicConfig(format="%%(levelname)s:%%(name)s:rank%s:%%(message)s" % rank,
                         level=logLevel)
@@ -263,8 +364,25 @@ def main():
     if deterministic:
         seed(1234)
 
-    patchGroup = patches.PatchGroup(comm, trace=trace, deterministic=deterministic)
-    for j in range(patchesPerRank):
+    if ckptDir is None:
+        checkpointer = None
+    else:
+        checkpointer = checkpoint.Checkpointer(ckptDir, interval=5)
+    patchGroup = patches.PatchGroup(comm, trace=trace, deterministic=deterministic,
+                                    netInterfaceClass=netInterfaceClass,
+                                    collectiveDateChange=collectiveDateChange,
+                                    balanceInterval=balanceInterval,
+                                    pipelined=pipelined, checkpointer=checkpointer,
+                                    deltaClocks=deltaClocks, maxTicksPerPass=maxTicksPerPass,
+                                    maxSliceSeconds=maxSliceSeconds,
+                                    maxIdlePasses=maxIdlePasses)
+    if restart:
+        day = checkpointer.restore(patchGroup)
+        logger.info('%d restarting at day %d' % (rank, day))
+        nNewPatches = 0
+    else:
+        nNewPatches = patchesPerRank
+    for j in range(nNewPatches):
 
         patch = MyPatch(patchGroup)
 
@@ -287,10 +405,14 @@ def main():
         patch.addAgents(agentList)
 
         # Use a PerTick callback rather than PerDay to make sure we catch the exact edge of the day
+        patch.runDuration = runDuration
         patch.loop.addPerTickCallback(createPerTickCB(patch, runDuration))
         patchGroup.addPatch(patch)
     logger.info('starting main loop')
-    msg = patchGroup.start()
+    if ring:
+        msg = patchGroup.start(neighbors=ringNeighbors(comm.size, patchesPerRank))
+    else:
+        msg = patchGroup.start()
     logger.info('%d all done (from main) with msg "%s"' % (rank, msg))
     logging.shutdown()
 